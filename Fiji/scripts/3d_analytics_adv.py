@@ -3,13 +3,17 @@
 # @Integer(label = "Select Channel", value=1, persist=True) CHANNEL2ANAlYSE
 # @Boolean(label = "Correct Background", value=False, persist=True) CORRECT_BACKGROUND
 # @Integer(label = "Rolling Ball - Disk Radius", value=30) RB_RADIUS
+# @Integer(label = "Rolling Ball - Binning (1 = exact)", value=1, persist=True) RB_BINNING
 # @ String (choices={"2D", "3D"}, style="radioButtonHorizontal") FILTERDIM
 # @String(label = "Select Filter 2D", choices={"NONE", "MEDIAN", "MIN", "MAX", "MEAN", "VARIANCE", "OPEN", "DESPECKLE"}, style="listBox", value="NONE", persist=True) RANKFILTER
 # @Integer(label = "Filter Radius", value=5.0, persist=False) RADIUS
-# @String(label = "Select 3D Filter", choices={"NONE", "MEDIAN", "MIN", "MAX", "MEAN", "VAR"}, style="listBox", value="NONE", persist=True) FILTER3D
+# @String(label = "Select 3D Filter", choices={"NONE", "MEDIAN", "MIN", "MAX", "MEAN", "VAR", "GAUSS"}, style="listBox", value="NONE", persist=True) FILTER3D
 # @Integer(label = "Radius X", value=5.0, persist=False) RADIUSX
 # @Integer(label = "Radius Y", value=5.0, persist=False) RADIUSY
 # @Integer(label = "Radius Z", value=5.0, persist=False) RADIUSZ
+# @Integer(label = "3D Filter Slab Size (0 = whole stack)", value=0, persist=True) SLABSIZE
+# @Float(label = "Gaussian Sigma [scaled units]", value=1.0, persist=True) SIGMA
+# @String(label = "Median, Min, Max Engine", choices={"default", "histogram", "auto"}, style="listBox", value="default", persist=True) RANK_ENGINE
 # @String(label = "Select Threshold", choices={"NONE", "Otsu", "Triangle", "IJDefault", "Huang", "MaxEntropy", "Mean", "Shanbhag", "Yen", "Li"}, style="listBox", value="NONE", persist=True) THRESHOLD
 # @Float(label = "Threshold Correction Factor", value=1.00,persist=True) CORRFACTOR
 # @Boolean(label = "Use whole stack for histogram", value=True, persist=True) TH_STACKOPT
@@ -20,13 +24,18 @@
 # @Boolean(label = "Colorize Labels", value=True, persist=True) LABEL_COLORIZE
 # @Boolean(label = "Save Particle Stack", value=True, persist=True) PASAVE
 # @String(label = "Choose Save Format", choices={"ome.tiff", "png", "jpeg", "tiff"}, style="listBox", value="ome.tiff", persist=True) SAVEFORMAT
-# @Boolean(label = "Save Result File as TXT", value=True, persist=True) RESULTSAVE
+# @String(label = "OME-TIFF Compression", choices={"Uncompressed", "LZW", "zlib"}, style="listBox", value="Uncompressed", persist=True) COMPRESSION
+# @Boolean(label = "Save Result File", value=True, persist=True) RESULTSAVE
+# @String(label = "Result File Format", choices={"txt", "rtb"}, style="listBox", value="txt", persist=True) RESULTFORMAT
+# @Boolean(label = "Skip if Output is up to date", value=False, persist=True) INCREMENTAL
+# @Integer(label = "Number of Threads", value=4, persist=True) NTHREADS
 # @Boolean(label = "Run in headless mode", value=False, persist=False) HEADLESS
 # @OUTPUT String FILENAME
 # @OUTPUT Boolean EXTRACT_CHANNEL
 # @OUTPUT Integer CHANNEL2ANAlYSE
 # @OUTPUT Boolean CORRECT_BACKGROUND
 # @OUTPUT Integer RB_RADIUS
+# @OUTPUT Integer RB_BINNING
 # @OUTPUT String FILTERDIM
 # @OUTPUT String RANKFILTER
 # @OUTPUT Integer RADIUS
@@ -34,6 +43,9 @@
 # @OUTPUT Integer RADIUSX
 # @OUTPUT Integer RADIUSY
 # @OUTPUT Integer RADIUSZ
+# @OUTPUT Integer SLABSIZE
+# @OUTPUT Float SIGMA
+# @OUTPUT String RANK_ENGINE
 # @OUTPUT String THRESHOLD
 # @OUTPUT Boolean TH_STACKOPT
 # @OUTPUT String CORRFACTOR
@@ -44,7 +56,11 @@
 # @OUTPUT Boolean LABEL_COLORIZE
 # @OUTPUT Boolean PASAVE
 # @OUTPUT String SAVEFORMAT
+# @OUTPUT String COMPRESSION
 # @OUTPUT Boolean RESULTSAVE
+# @OUTPUT String RESULTFORMAT
+# @OUTPUT Boolean INCREMENTAL
+# @OUTPUT Integer NTHREADS
 # @OUTPUT Boolean HEADLESS
 
 # @UIService uiService
@@ -69,7 +85,9 @@ from java.lang.System import getProperty
 path.append(getProperty('fiji.dir') + '/scripts')
 
 from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
-from fijipytools import AnalyzeTools, RoiTools, MiscTools, ThresholdTools
+from fijipytools import AnalyzeTools, RoiTools, MiscTools
+from fijipytools import MetadataCache, WriteBehindQueue, SlicePipeline
+from fijipytools import BackendRegistry
 from java.lang import Double, Integer
 from ij import IJ, ImagePlus, ImageStack, Prefs
 from ij.process import ImageProcessor, ImageConverter, LUT, ColorProcessor
@@ -80,10 +98,8 @@ from ij.plugin.frame import RoiManager
 from ij.io import FileSaver
 from ij.gui import Roi, Overlay
 from ij.measure import ResultsTable
-from ij.plugin import ChannelSplitter
 
 import json
-import os
 import urllib
 from java.awt import Color
 from java.util import Random
@@ -114,8 +130,15 @@ def run(imagefile):
     # Opening the image
     log.log(LogLevel.INFO, 'Opening Image: ' + imagefile)
 
+    # read only the channel to analyse
+    crange = None
+    if EXTRACT_CHANNEL:
+        crange = (CHINDEX, CHINDEX, 1)
+
     # open image file and get a specific series
-    imp, MetaInfo = ImportTools.openfile(imagefile)
+    imp, MetaInfo = ImportTools.openfile(imagefile,
+                                         metacache=METACACHE,
+                                         crange=crange)
 
     log.log(LogLevel.INFO, 'File Extension   : ' + MetaInfo['Extension'])
     if 'ResolutionCount' in MetaInfo:
@@ -129,54 +152,81 @@ def run(imagefile):
     log.log(LogLevel.INFO, 'Start Processing ...')
 
     if EXTRACT_CHANNEL:
-        # get the correct channel
+        # the channel was already extracted while reading the file
         if MetaInfo['SizeC'] > 1:
             log.log(LogLevel.INFO, 'Extract Channel  : ' + str(CHINDEX))
-            imps = ChannelSplitter.split(imp)
-            imp = imps[CHINDEX - 1]
+
+    # all steps up to the threshold run as fused slice pipeline, the
+    # stack histogram and the 3D filter are passes over the whole stack
+    pipeline = SlicePipeline()
 
     # correct background using rolling ball
     if CORRECT_BACKGROUND:
 
         log.log(LogLevel.INFO, 'Rolling Ball Background subtraction...')
-        imp = FilterTools.apply_rollingball(imp,
-                                            radius=RB_RADIUS,
-                                            createBackground=CREATEBACKGROUND,
-                                            lightBackground=LIGHTBACKGROUND,
-                                            useParaboloid=USEPARABOLOID,
-                                            doPresmooth=DOPRESMOOTH,
-                                            correctCorners=CORRECTCORNERS)
+        if RB_BINNING > 1:
+            # compare the binned and the exact background on a few slices
+            error = FilterTools.getrollingballerror(imp, radius=RB_RADIUS,
+                                                    binning=RB_BINNING,
+                                                    lightBackground=LIGHTBACKGROUND,
+                                                    useParaboloid=USEPARABOLOID,
+                                                    doPresmooth=DOPRESMOOTH,
+                                                    correctCorners=CORRECTCORNERS)
+            log.log(LogLevel.INFO, 'Rolling Ball Max. Error : ' + str(round(error['Max. Error'], 2))
+                    + ' (' + str(round(error['Max. Error [%]'], 2)) + ' %)')
+        pipeline.add_rollingball(radius=RB_RADIUS,
+                                 createBackground=CREATEBACKGROUND,
+                                 lightBackground=LIGHTBACKGROUND,
+                                 useParaboloid=USEPARABOLOID,
+                                 doPresmooth=DOPRESMOOTH,
+                                 correctCorners=CORRECTCORNERS,
+                                 binning=RB_BINNING)
 
     if FILTERDIM == '2D':
         if RANKFILTER != 'NONE':
             # apply filter
             log.log(LogLevel.INFO, 'Apply 2D Filter   : ' + RANKFILTER)
-            imp = FilterTools.apply_filter(imp,
-                                           radius=RADIUS,
-                                           filtertype=RANKFILTER)
+            engine = RANK_ENGINE
+            if RANK_ENGINE == 'auto':
+                # fastest engine on this machine - calibrated on first use
+                engine = BackendRegistry.getbackend('filter', imp, radius=RADIUS, filtertype=RANKFILTER)
+                log.log(LogLevel.INFO, 'Rank Filter Engine : ' + engine)
+            pipeline.add_filter(radius=RADIUS,
+                                filtertype=RANKFILTER,
+                                engine=engine)
     if FILTERDIM == '3D':
-        if FILTER3D != 'NONE':
+        if FILTER3D == 'GAUSS':
+            # anisotropic gaussian - the sigmas in pixels follow the scaling
+            log.log(LogLevel.INFO, 'Apply 3D Gaussian : ' + str(FilterTools.getgaussiansigmas(SIGMA, MetaInfo)))
+            pipeline.add_gaussian3d(sigma=SIGMA, metainfo=MetaInfo, nthreads=NTHREADS)
+        if FILTER3D not in ['NONE', 'GAUSS']:
             # apply filter
             log.log(LogLevel.INFO, 'Apply 3D Filter   : ' + FILTER3D)
-            imp = FilterTools.apply_filter3d(imp,
-                                             radiusx=RADIUSX,
-                                             radiusy=RADIUSY,
-                                             radiusz=RADIUSZ,
-                                             filtertype=FILTER3D)
+            engine = RANK_ENGINE
+            if RANK_ENGINE == 'auto':
+                engine = BackendRegistry.getbackend('filter3d', imp, radiusx=RADIUSX, radiusy=RADIUSY,
+                                                    radiusz=RADIUSZ, filtertype=FILTER3D)
+                log.log(LogLevel.INFO, 'Rank Filter Engine : ' + engine)
+            pipeline.add_filter3d(radiusx=RADIUSX,
+                                  radiusy=RADIUSY,
+                                  radiusz=RADIUSZ,
+                                  filtertype=FILTER3D,
+                                  engine=engine,
+                                  slabsize=SLABSIZE if SLABSIZE > 0 else None,
+                                  nthreads=NTHREADS)
 
     if THRESHOLD != 'NONE':
         # apply threshold
         log.log(LogLevel.INFO, 'Apply Threshold   : ' + THRESHOLD)
         log.log(LogLevel.INFO, 'Correction Factor : ' + str(CORRFACTOR))
 
-        imp = ThresholdTools.apply_threshold(imp,
-                                             method=THRESHOLD,
-                                             background_threshold='dark',
-                                             stackopt=TH_STACKOPT,
-                                             corrf=CORRFACTOR)
+        pipeline.add_threshold(method=THRESHOLD,
+                               background_threshold='dark',
+                               stackopt=TH_STACKOPT,
+                               corrf=CORRFACTOR)
 
-        # imp_t = imp.duplicate()
-        # imp_t.show("Threshold")
+    imp = pipeline.run(imp, nthreads=NTHREADS)
+    log.log(LogLevel.INFO, 'Pipeline          : ' + str(pipeline.stats))
 
     if FILL_HOLES:
         # 3D fill holes
@@ -193,7 +243,7 @@ def run(imagefile):
         dynamic = 2
         connectivity = LABEL_CONNECT
         log.log(LogLevel.INFO, 'Run Watershed to separate particles ...')
-        #dist = BinaryImages.distanceMap(imp.getImageStack(), weights, normalize) 
+        #dist = BinaryImages.distanceMap(imp.getImageStack(), weights, normalize)
         dist = BinaryImages.distanceMap(imp, weights, normalize)
         Images3D.invert(dist)
         #imp = ExtendedMinimaWatershed.extendedMinimaWatershed(dist, imp.getImageStack(), dynamic, connectivity, 32, False )
@@ -216,7 +266,7 @@ def run(imagefile):
     log.log(LogLevel.INFO, 'Filtering VoxelSize - Minimum : ' + str(MINVOXSIZE))
     pastack = BinaryImages.volumeOpening(pastack.getStack(), MINVOXSIZE)
     imp = ImagePlus('Particles Filtered', pastack)
-    pastack = BinaryImages.componentsLabeling(imp, LABEL_CONNECT, LABEL_BITDEPTH)
+    pastack = BackendRegistry.run('labeling', imp, connectivity=LABEL_CONNECT, bitdepth=LABEL_BITDEPTH)
 
     # get the labels
     labels = LabelImages.findAllLabels(pastack)
@@ -263,12 +313,18 @@ MAXSIZE = Double.POSITIVE_INFINITY
 CHINDEX = Integer.valueOf(CHANNEL2ANAlYSE)
 SUFFIX_PA = '_PA'
 SUFFIX_RT = '_RESULTS'
-SAVEFORMAT_RT = 'txt'
+SAVEFORMAT_RT = RESULTFORMAT
 IMAGESERIES = 0
 LABEL_BITDEPTH = 16
 LABEL_CONNECT = Integer.valueOf(LABEL_CONNECT)
 EXB = 1
 
+# cache for the metadata and the Bio-Formats memo files
+METACACHE = MetadataCache()
+
+# writes the outputs in the background while the script continues
+WRITER = WriteBehindQueue()
+
 # parameters for Rolling Ball
 CREATEBACKGROUND = False
 CORRECTCORNERS = True
@@ -289,6 +345,7 @@ log.log(LogLevel.INFO, 'Channel to Analyse     : ' + str(CHINDEX))
 log.log(LogLevel.INFO, '-----------------------------------------')
 log.log(LogLevel.INFO, 'Correct Background     : ' + str(CORRECT_BACKGROUND))
 log.log(LogLevel.INFO, 'Rolling Ball Radius    : ' + str(RB_RADIUS))
+log.log(LogLevel.INFO, 'Rolling Ball Binning   : ' + str(RB_BINNING))
 log.log(LogLevel.INFO, 'Light Background       : ' + str(LIGHTBACKGROUND))
 log.log(LogLevel.INFO, 'Use paraboloid         : ' + str(USEPARABOLOID))
 log.log(LogLevel.INFO, 'Doing PreSmooth        : ' + str(DOPRESMOOTH))
@@ -301,6 +358,9 @@ if FILTERDIM == '2D':
 if FILTERDIM == '3D':
     log.log(LogLevel.INFO, 'Filter Type 3D         : ' + FILTER3D)
     log.log(LogLevel.INFO, 'Radius XYZ             : ' + str(RADIUSX) + ', ' + str(RADIUSY) + ', ' + str(RADIUSZ))
+    log.log(LogLevel.INFO, 'Slab Size              : ' + str(SLABSIZE))
+    log.log(LogLevel.INFO, 'Gaussian Sigma         : ' + str(SIGMA))
+log.log(LogLevel.INFO, 'Rank Filter Engine     : ' + RANK_ENGINE)
 log.log(LogLevel.INFO, '-----------------------------------------')
 log.log(LogLevel.INFO, 'Threshold Method       : ' + THRESHOLD)
 log.log(LogLevel.INFO, 'Threshold Histo Calc   : ' + str(TH_STACKOPT))
@@ -311,17 +371,24 @@ log.log(LogLevel.INFO, 'Colorize Labels        : ' + str(LABEL_COLORIZE))
 log.log(LogLevel.INFO, 'Minimum Voxel Size     : ' + str(MINVOXSIZE))
 log.log(LogLevel.INFO, '-----------------------------------------')
 log.log(LogLevel.INFO, 'Save Format used       : ' + SAVEFORMAT)
-log.log(LogLevel.INFO, '------------  START IMAGE ANALYSIS ------------')
-
-# run image analysis pipeline
-objstack, results, labels = run(imagefile)
-
-# show objects
-log.log(LogLevel.INFO, 'Show Objects inside stack ...')
-objstack.show()
-
-log.log(LogLevel.INFO, 'Show ResultsTable ...')
-results.show('3D Objects')
+log.log(LogLevel.INFO, 'Compression            : ' + COMPRESSION)
+log.log(LogLevel.INFO, 'Skip if up to date     : ' + str(INCREMENTAL))
+log.log(LogLevel.INFO, 'Number of Threads      : ' + str(NTHREADS))
+
+# all parameters which change the outputs
+PARAMS = {'EXTRACT_CHANNEL': EXTRACT_CHANNEL, 'CHANNEL2ANAlYSE': CHANNEL2ANAlYSE,
+          'IMAGESERIES': IMAGESERIES,
+          'CORRECT_BACKGROUND': CORRECT_BACKGROUND, 'RB_RADIUS': RB_RADIUS, 'RB_BINNING': RB_BINNING,
+          'CREATEBACKGROUND': CREATEBACKGROUND, 'CORRECTCORNERS': CORRECTCORNERS,
+          'USEPARABOLOID': USEPARABOLOID, 'DOPRESMOOTH': DOPRESMOOTH, 'LIGHTBACKGROUND': LIGHTBACKGROUND,
+          'FILTERDIM': FILTERDIM, 'RANKFILTER': RANKFILTER, 'RADIUS': RADIUS,
+          'FILTER3D': FILTER3D, 'RADIUSX': RADIUSX, 'RADIUSY': RADIUSY, 'RADIUSZ': RADIUSZ,
+          'SLABSIZE': SLABSIZE, 'SIGMA': SIGMA, 'RANK_ENGINE': RANK_ENGINE,
+          'THRESHOLD': THRESHOLD, 'CORRFACTOR': CORRFACTOR, 'TH_STACKOPT': TH_STACKOPT,
+          'FILL_HOLES': FILL_HOLES, 'WATERSHED': WATERSHED, 'LABEL_CONNECT': LABEL_CONNECT,
+          'LABEL_BITDEPTH': LABEL_BITDEPTH, 'EXB': EXB,
+          'MINVOXSIZE': MINVOXSIZE, 'LABEL_COLORIZE': LABEL_COLORIZE,
+          'SAVEFORMAT': SAVEFORMAT, 'COMPRESSION': COMPRESSION, 'RESULTFORMAT': RESULTFORMAT}
 
 basename = os.path.splitext(imagefile)[0]
 # remove the extra .ome before reassembling the filename
@@ -329,26 +396,59 @@ if basename[-4:] == '.ome':
     basename = basename[:-4]
 
 outputimagepath = basename + SUFFIX_PA + '.' + SAVEFORMAT
+rtsavelocation = basename + SUFFIX_RT + '.' + SAVEFORMAT_RT
 
+outputs = []
 if PASAVE:
-    log.log(LogLevel.INFO, 'Start Saving ...')
-    savepath_objstack = ExportTools.savedata(objstack,
-                                             outputimagepath,
-                                             extension=SAVEFORMAT,
-                                             replace=True)
-
-    log.log(LogLevel.INFO, 'Saved Processed Image to : ' + savepath_objstack)
-
-# save the result file
+    outputs.append(outputimagepath)
 if RESULTSAVE:
-    # save the result table
-    # rtsavelocation = AnalyzeTools.create_resultfilename(imagefile,
-    #                                                    suffix=SUFFIX_RT,
-    #                                                    extension=SAVEFORMAT_RT)
-    # saving the result table
-    rtsavelocation = basename + SUFFIX_RT + '.' + SAVEFORMAT_RT
-    results.saveAs(rtsavelocation)
-    log.log(LogLevel.INFO, 'Save Results to : ' + rtsavelocation)
+    outputs.append(rtsavelocation)
+
+uptodate = INCREMENTAL and outputs and all([ExportTools.isuptodate(output, [imagefile], PARAMS) for output in outputs])
+
+if uptodate:
+    log.log(LogLevel.INFO, 'Outputs are up to date - skip analysis : ' + str(outputs))
+
+if not uptodate:
+    log.log(LogLevel.INFO, '------------  START IMAGE ANALYSIS ------------')
+
+    # run image analysis pipeline
+    objstack, results, labels = run(imagefile)
+
+    log.log(LogLevel.INFO, 'Metadata Cache         : ' + str(METACACHE.stats()))
+
+    # export in the background
+    if PASAVE:
+        log.log(LogLevel.INFO, 'Start Saving ...')
+        savepath_objstack = WRITER.submit(objstack,
+                                          outputimagepath,
+                                          extension=SAVEFORMAT,
+                                          replace=True,
+                                          compression=COMPRESSION,
+                                          incremental=INCREMENTAL,
+                                          inputs=[imagefile],
+                                          params=PARAMS)
+
+    # save the result file
+    if RESULTSAVE:
+        WRITER.submit(results, rtsavelocation,
+                      incremental=INCREMENTAL,
+                      inputs=[imagefile],
+                      params=PARAMS)
+
+    # show objects while the outputs are written
+    log.log(LogLevel.INFO, 'Show Objects inside stack ...')
+    objstack.show()
+
+    log.log(LogLevel.INFO, 'Show ResultsTable ...')
+    results.show('3D Objects')
+
+# wait until everything is written and stop the writer thread
+for savepath, status in WRITER.close().items():
+    if status is True:
+        log.log(LogLevel.INFO, 'Saved to : ' + savepath)
+    if status is not True:
+        log.log(LogLevel.INFO, 'Saving did not work for : ' + savepath)
 
 # finish
 log.log(LogLevel.INFO, 'Done.')
@@ -216,6 +216,11 @@ def AddLabels(table, labels, numrows, col2insert):
     
 def ReadResultTable(filename, rowoffset, delim, tablename, table):
     
+    # binary result tables (*.rtb) are read by FijiTools without parsing
+    if filename.lower().endswith('.rtb'):
+        from FijiTools import ReadResultTableBinary
+        return ReadResultTableBinary(filename, tablename, table)
+
     # Get the Results Table from Fiji
     ValuesArray, Legends, numvar, entries, coltypelist = Conv2Array(filename, rowoffset, delim)
     table = CreateTable(ValuesArray, numvar, entries, Legends, 1, tablename, coltypelist, table)
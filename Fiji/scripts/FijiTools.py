@@ -1,11 +1,14 @@
 """  
 Author: Sebastian Rhode
 File: FijiTools.py
-Version: 1.1
+Version: 1.2
 """
 
 import csv
-from System import Array
+import clr
+from System import Array, BitConverter, Buffer
+from System.IO import File
+from System.Text import Encoding
 
 
 def Conv2Array(filename, rowoffset, delim):
@@ -118,8 +121,77 @@ def AddLabels(table, labels, numrows, col2insert):
     return table
 
 
+def ReadColumnar(filename):
+
+    # read a binary result table (*.rtb) written by AnalyzeTools.save_columnar
+    # the layout is described in fijipytools.py - no string parsing is needed
+    # the JSON header reader is only loaded when a binary table is read
+    clr.AddReference('System.Web.Extensions')
+    from System.Web.Script.Serialization import JavaScriptSerializer
+
+    data = File.ReadAllBytes(filename)
+    if Encoding.ASCII.GetString(data, 0, 4) != 'FJRT':
+        raise ValueError('Not a binary result table : ' + filename)
+
+    headerlength = BitConverter.ToInt32(data, 8)
+    header = JavaScriptSerializer().DeserializeObject(Encoding.UTF8.GetString(data, 12, headerlength))
+    datastart = 12 + headerlength
+    numrows = header['rows']
+
+    columns = []
+    legnames = []
+    typelist = []
+    for column in header['columns']:
+        start = datastart + column['offset']
+        legnames.append(column['name'])
+
+        if column['type'] == 'float64':
+            # copy the whole column at once
+            values = Array.CreateInstance(float, numrows)
+            Buffer.BlockCopy(data, start, values, 0, numrows * 8)
+            typelist.append('float')
+        else:
+            offsets = Array.CreateInstance(int, numrows + 1)
+            Buffer.BlockCopy(data, start, offsets, 0, (numrows + 1) * 4)
+            textstart = start + (numrows + 1) * 4
+            values = [Encoding.UTF8.GetString(data, textstart + offsets[i], offsets[i + 1] - offsets[i]) for i in range(numrows)]
+            typelist.append('str')
+
+        columns.append(values)
+
+    print('Number of Vars    :', len(legnames))
+    print('Number of Entries :', numrows)
+
+    return columns, legnames, numrows, typelist
+
+
+def ReadResultTableBinary(filename, tablename, table):
+
+    columns, legends, numrows, typelist = ReadColumnar(filename)
+
+    for i in range(0, len(legends), 1):
+        if (typelist[i] == 'float'):
+            table.Columns.Add(legends[i], float)
+        if (typelist[i] == 'str'):
+            table.Columns.Add(legends[i], str)
+
+    # Write values in table
+    for r in range(0, numrows, 1):
+        table.Rows.Add()
+        for c in range(0, len(columns), 1):
+            table.SetValue(r, c, columns[c][r])
+
+    print('Table created.')
+
+    return table
+
+
 def ReadResultTable(filename, rowoffset, delim, tablename, table):
 
+    # binary result tables do not need to be parsed
+    if filename.lower().endswith('.rtb'):
+        return ReadResultTableBinary(filename, tablename, table)
+
     # Get the Results Table from Fiji
     ValuesArray, Legends, numvar, entries, coltypelist = Conv2Array(filename, rowoffset, delim)
     table = CreateTable(ValuesArray, numvar, entries, Legends, 1, tablename, coltypelist, table)
@@ -26,6 +26,7 @@ log.info('Fiji Script Directory : ' + scriptdir)
 
 from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
 from fijipytools import AnalyzeTools, RoiTools, MiscTools, ThresholdTools
+from fijipytools import MetadataCache
 from java.lang import Double, System
 from ij import IJ, ImagePlus, ImageStack, Prefs
 from ij.process import ImageProcessor, ImageConverter
@@ -68,7 +69,8 @@ def run(imagefile):
                                          openallseries=True,
                                          showomexml=False,
                                          attach=False,
-                                         autoscale=True)
+                                         autoscale=True,
+                                         metacache=METACACHE)
 
     # Opening the image
     log.info('Opening Image: ' + imagefile)
@@ -124,9 +126,13 @@ def run(imagefile):
 MAXSIZE = Double.POSITIVE_INFINITY
 SUFFIX_PA = '_PA'
 SUFFIX_RT = '_RESULTS'
-SAVEFORMAT_RT = 'txt'
+# 'txt' or the binary columnar format 'rtb', optional in the JSON parameters
+SAVEFORMAT_RT = INPUT_JSON.get('SAVEFORMAT_RT', 'txt')
 IMAGESERIES = 0
 
+# cache for the metadata and the Bio-Formats memo files
+METACACHE = MetadataCache()
+
 # for rolling ball
 CREATEBACKGROUND = False
 LIGHTBACKGROUND = False
@@ -207,7 +213,7 @@ if RESULTSAVE:
                                                         suffix=SUFFIX_RT,
                                                         extension=SAVEFORMAT_RT)
 
-    results.saveAs(rtsavelocation)
+    AnalyzeTools.save_results(results, rtsavelocation)
     log.info('Save Results to: ' + rtsavelocation)
 
 
@@ -114,7 +114,7 @@ for id in ids:
 # initialize ZenTable object
 SingleObj = ZenTable()
 # read the result table and convert into a ZenTable
-SingleObj = ct.ReadResultTable(md_out['RESULTTABLE'], 1, '\t', 'FijiTable', SingleObj)
+SingleObj = ft.ReadResultTable(md_out['RESULTTABLE'], 1, '\t', 'FijiTable', SingleObj)
 # change the name of the table
 SingleObj.Name = Path.GetFileNameWithoutExtension(Path.GetFileName(md_out['RESULTTABLE']))
 # show and save data tables to the specified folder
@@ -0,0 +1,112 @@
+# @File(label = "Image File", persist=True) FILENAME
+# @String(label = "Codecs", value="Uncompressed,LZW,zlib,zstd", persist=True) CODECS
+# @String(label = "Threshold", choices={"Otsu", "Triangle", "IJDefault", "Huang", "MaxEntropy", "Mean", "Shanbhag", "Yen", "Li"}, style="listBox", value="Otsu", persist=True) THRESHOLD
+# @OUTPUT String FILENAME
+# @OUTPUT String CODECS
+# @OUTPUT String THRESHOLD
+
+# @LogService log
+
+"""
+File: benchmark_compression.py
+Date: 2026_10_18
+Version: 0.1
+
+Writes raw 16-bit, binary and label stacks as OME-TIFF using different
+compression codecs and reports the write time and the bytes on disk.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+from sys import path
+from java.lang.System import getProperty
+path.append(getProperty('fiji.dir') + '/scripts')
+
+from fijipytools import ExportTools, ImageTools, ImportTools, ThresholdTools
+from ij.measure import ResultsTable
+from org.scijava.log import LogLevel
+from inra.ijpb.binary import BinaryImages
+
+
+def create_testdata(imagefile):
+
+    # raw data - first channel of the image
+    imp, MetaInfo = ImportTools.openfile(imagefile, crange=(1, 1, 1))
+    imp.setTitle('raw')
+
+    # binary mask
+    binary = ThresholdTools.apply_threshold(imp.duplicate(),
+                                            method=THRESHOLD,
+                                            background_threshold='dark',
+                                            stackopt=True,
+                                            corrf=1.0)
+    binary.setTitle('binary')
+
+    # label image
+    connectivity = 8
+    if binary.getStackSize() > 1:
+        connectivity = 26
+    labels = BinaryImages.componentsLabeling(binary, connectivity, 16)
+    labels.setTitle('labels')
+
+    return [imp, binary, labels]
+
+
+def run_benchmark(testdata, codecs, outputdir):
+
+    results = ResultsTable()
+
+    for imp in testdata:
+        for codec in codecs:
+            savepath = os.path.join(outputdir, imp.getTitle() + '_' + codec + '.ome.tiff')
+
+            # check the codec before timing the export
+            compression = ExportTools.getcompression(savepath, compression=codec)
+            if compression.lower() != codec.lower():
+                log.log(LogLevel.INFO, 'Skip not supported codec : ' + codec)
+                continue
+
+            start = time.time()
+            ExportTools.savedata(imp, savepath,
+                                 extension='ome.tiff',
+                                 replace=True,
+                                 compression=compression)
+            duration = time.time() - start
+
+            results.incrementCounter()
+            results.addValue('Data', imp.getTitle())
+            results.addValue('Codec', compression)
+            results.addValue('Write Time [s]', duration)
+            results.addValue('Bytes on Disk', os.path.getsize(savepath))
+            results.addValue('Bytes in Memory', ImageTools.getbytes(imp))
+
+            log.log(LogLevel.INFO, imp.getTitle() + ' - ' + compression
+                    + ' : ' + str(round(duration, 3)) + ' s, '
+                    + str(os.path.getsize(savepath)) + ' bytes')
+
+    return results
+
+############################################################################
+
+
+imagefile = FILENAME.toString()
+codecs = [codec.strip() for codec in CODECS.split(',') if codec.strip()]
+
+log.log(LogLevel.INFO, 'Image Filename : ' + imagefile)
+log.log(LogLevel.INFO, 'Codecs         : ' + str(codecs))
+log.log(LogLevel.INFO, 'Supported      : ' + str(ExportTools.getcompressiontypes('test.ome.tiff')))
+
+outputdir = tempfile.mkdtemp(prefix='benchmark_compression_')
+
+try:
+    testdata = create_testdata(imagefile)
+    results = run_benchmark(testdata, codecs, outputdir)
+finally:
+    shutil.rmtree(outputdir, True)
+
+results.show('Compression Benchmark')
+
+# finish
+log.log(LogLevel.INFO, 'Done.')
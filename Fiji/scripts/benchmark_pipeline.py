@@ -0,0 +1,106 @@
+# @File(label = "Image File", persist=True) FILENAME
+# @Integer(label = "Select Channel", value=1, persist=True) CHANNEL
+# @Integer(label = "Rolling Ball - Disk Radius", value=30, persist=True) RB_RADIUS
+# @Integer(label = "Rolling Ball - Binning (1 = exact)", value=1, persist=True) RB_BINNING
+# @String(label = "Select Filter 2D", choices={"MEDIAN", "MIN", "MAX", "MEAN", "VARIANCE"}, style="listBox", value="MEDIAN", persist=True) RANKFILTER
+# @Integer(label = "Filter Radius", value=5, persist=True) RADIUS
+# @String(label = "Select Threshold", choices={"Otsu", "Triangle", "IJDefault", "Huang", "MaxEntropy", "Mean", "Shanbhag", "Yen", "Li"}, style="listBox", value="Otsu", persist=True) THRESHOLD
+# @Boolean(label = "Use whole stack for histogram", value=True, persist=True) TH_STACKOPT
+# @Integer(label = "Number of Threads", value=4, persist=True) NTHREADS
+# @OUTPUT String FILENAME
+# @OUTPUT Integer CHANNEL
+# @OUTPUT Integer RB_RADIUS
+# @OUTPUT Integer RB_BINNING
+# @OUTPUT String RANKFILTER
+# @OUTPUT Integer RADIUS
+# @OUTPUT String THRESHOLD
+# @OUTPUT Boolean TH_STACKOPT
+# @OUTPUT Integer NTHREADS
+
+# @LogService log
+
+"""
+File: benchmark_pipeline.py
+Date: 2026_10_18
+Version: 0.1
+
+Compares rolling ball, rank filter and threshold run as separate passes over
+the stack with the same steps run as fused SlicePipeline. Reports the wall
+time, the number of passes over the stack and the estimated memory traffic.
+"""
+
+import time
+from sys import path
+from java.lang.System import getProperty
+path.append(getProperty('fiji.dir') + '/scripts')
+
+from fijipytools import FilterTools, ImageTools, ImportTools, ThresholdTools
+from fijipytools import SlicePipeline, TileTools
+from ij.measure import ResultsTable
+from org.scijava.log import LogLevel
+
+
+def run_separate(imp):
+
+    imp = FilterTools.apply_rollingball(imp, radius=RB_RADIUS, nthreads=NTHREADS, binning=RB_BINNING)
+    imp = FilterTools.apply_filter(imp, radius=RADIUS, filtertype=RANKFILTER, nthreads=NTHREADS)
+    imp = ThresholdTools.apply_threshold(imp, method=THRESHOLD,
+                                         background_threshold='dark',
+                                         stackopt=TH_STACKOPT,
+                                         corrf=1.0,
+                                         nthreads=NTHREADS)
+
+    return imp
+
+
+def create_pipeline():
+
+    pipeline = SlicePipeline()
+    pipeline.add_rollingball(radius=RB_RADIUS, binning=RB_BINNING)
+    pipeline.add_filter(radius=RADIUS, filtertype=RANKFILTER)
+    pipeline.add_threshold(method=THRESHOLD,
+                           background_threshold='dark',
+                           stackopt=TH_STACKOPT,
+                           corrf=1.0)
+
+    return pipeline
+
+
+############################################################################
+
+
+imagefile = FILENAME.toString()
+imp, MetaInfo = ImportTools.openfile(imagefile, crange=(CHANNEL, CHANNEL, 1))
+stackbytes = ImageTools.getbytes(imp)
+
+log.log(LogLevel.INFO, 'Image Filename : ' + imagefile)
+log.log(LogLevel.INFO, 'Slices         : ' + str(imp.getStackSize()))
+
+# separate passes - every step streams the whole stack
+start = time.time()
+separate = run_separate(imp.duplicate())
+time_separate = time.time() - start
+
+# fused pipeline - only the global steps are separate passes
+pipeline = create_pipeline()
+start = time.time()
+fused = pipeline.run(imp.duplicate(), nthreads=NTHREADS)
+time_fused = time.time() - start
+
+results = ResultsTable()
+for mode, duration, passes in [('Separate', time_separate, pipeline.stats['Steps']),
+                               ('Fused', time_fused, pipeline.stats['Passes'])]:
+    results.incrementCounter()
+    results.addValue('Mode', mode)
+    results.addValue('Time [s]', duration)
+    results.addValue('Passes', passes)
+    # estimate - every pass reads and writes the stack once, caches are not counted
+    results.addValue('Est. Memory Traffic [MB]', 2.0 * passes * stackbytes / 1024 ** 2)
+
+log.log(LogLevel.INFO, 'Speedup         : ' + str(round(time_separate / max(time_fused, 1e-6), 2)))
+log.log(LogLevel.INFO, 'Max. Difference : ' + str(TileTools.maxstackdifference(separate, fused)))
+
+results.show('Pipeline Benchmark')
+
+# finish
+log.log(LogLevel.INFO, 'Done.')
@@ -0,0 +1,87 @@
+# @File(label = "Image File", persist=True) FILENAME
+# @Integer(label = "Select Channel", value=1, persist=True) CHANNEL
+# @String(label = "Radii 2D", value="5,10,15", persist=True) RADII
+# @String(label = "Radii 3D", value="2,3,5", persist=True) RADII3D
+# @Integer(label = "Number of Threads", value=4, persist=True) NTHREADS
+# @OUTPUT String FILENAME
+# @OUTPUT Integer CHANNEL
+# @OUTPUT String RADII
+# @OUTPUT String RADII3D
+# @OUTPUT Integer NTHREADS
+
+# @LogService log
+
+"""
+File: benchmark_rank.py
+Date: 2026_10_18
+Version: 0.1
+
+Compares the sliding histogram rank filters of RankTools with RankFilters
+(2D) and Filters3D (3D) for MEDIAN, MIN and MAX. Reports the time of both
+engines and the max. difference between the outputs, which should be 0.
+"""
+
+import time
+from sys import path
+from java.lang.System import getProperty
+path.append(getProperty('fiji.dir') + '/scripts')
+
+from fijipytools import FilterTools, ImportTools, TileTools
+from ij.measure import ResultsTable
+from org.scijava.log import LogLevel
+
+
+def timed(func):
+
+    start = time.time()
+    result = func()
+
+    return result, time.time() - start
+
+
+def compare(results, name, radius, default, histogram):
+
+    imp_default, time_default = timed(default)
+    imp_histogram, time_histogram = timed(histogram)
+
+    results.incrementCounter()
+    results.addValue('Filter', name)
+    results.addValue('Radius', radius)
+    results.addValue('Time Default [s]', time_default)
+    results.addValue('Time Histogram [s]', time_histogram)
+    results.addValue('Speedup', time_default / max(time_histogram, 1e-6))
+    results.addValue('Max. Difference', TileTools.maxstackdifference(imp_default, imp_histogram))
+
+    log.log(LogLevel.INFO, name + ' r=' + str(radius) + ' : '
+            + str(round(time_default, 3)) + ' s / ' + str(round(time_histogram, 3)) + ' s')
+
+############################################################################
+
+
+imagefile = FILENAME.toString()
+imp, MetaInfo = ImportTools.openfile(imagefile, crange=(CHANNEL, CHANNEL, 1))
+
+log.log(LogLevel.INFO, 'Image Filename : ' + imagefile)
+log.log(LogLevel.INFO, 'Bit Depth      : ' + str(imp.getBitDepth()))
+
+results = ResultsTable()
+
+for radius in [float(r) for r in RADII.split(',') if r.strip()]:
+    for filtertype in ['MEDIAN', 'MIN', 'MAX']:
+        compare(results, '2D ' + filtertype, radius,
+                lambda: FilterTools.apply_filter(imp.duplicate(), radius=radius, filtertype=filtertype,
+                                                 nthreads=NTHREADS),
+                lambda: FilterTools.apply_filter(imp.duplicate(), radius=radius, filtertype=filtertype,
+                                                 nthreads=NTHREADS, engine='histogram'))
+
+for radius in [float(r) for r in RADII3D.split(',') if r.strip()]:
+    compare(results, '3D MEDIAN', radius,
+            lambda: FilterTools.apply_filter3d(imp.duplicate(), radius, radius, radius, 'MEDIAN',
+                                               nthreads=NTHREADS),
+            lambda: FilterTools.apply_filter3d(imp.duplicate(), radius, radius, radius, 'MEDIAN',
+                                               engine='histogram', nthreads=NTHREADS))
+
+results.show('Rank Filter Benchmark')
+
+# finish
+log.log(LogLevel.INFO, 'Done.')
@@ -0,0 +1,94 @@
+# @File(label = "Image File", persist=True) FILENAME
+# @Integer(label = "Select Channel", value=1, persist=True) CHANNEL
+# @Integer(label = "Rolling Ball - Disk Radius", value=30, persist=True) RB_RADIUS
+# @String(label = "Binning Factors", value="2,4,8", persist=True) BINNINGS
+# @Integer(label = "Number of Threads", value=4, persist=True) NTHREADS
+# @OUTPUT String FILENAME
+# @OUTPUT Integer CHANNEL
+# @OUTPUT Integer RB_RADIUS
+# @OUTPUT String BINNINGS
+# @OUTPUT Integer NTHREADS
+
+# @LogService log
+
+"""
+File: benchmark_rollingball.py
+Date: 2026_10_18
+Version: 0.1
+
+Compares the exact rolling ball background subtraction with the binned mode
+of FilterTools.apply_rollingball for different binning factors. Reports the
+wall time, the speedup and the max. and mean absolute error versus the exact
+result for all slices.
+"""
+
+import time
+from sys import path
+from java.lang.System import getProperty
+path.append(getProperty('fiji.dir') + '/scripts')
+
+from fijipytools import FilterTools, ImportTools
+from ij.measure import ResultsTable
+from ij.process import Blitter
+from org.scijava.log import LogLevel
+
+
+def geterror(imp1, imp2):
+
+    # max. and mean absolute difference over all slices
+    stack1, stack2 = imp1.getStack(), imp2.getStack()
+    maxerror, meanerror = 0.0, 0.0
+    for i in range(1, stack1.getSize() + 1):
+        diff = stack1.getProcessor(i).convertToFloat().duplicate()
+        diff.copyBits(stack2.getProcessor(i).convertToFloat(), 0, 0, Blitter.DIFFERENCE)
+        stats = diff.getStatistics()
+        maxerror = max(maxerror, stats.max)
+        meanerror += stats.mean / stack1.getSize()
+
+    return maxerror, meanerror
+
+
+def run_rollingball(imp, binning):
+
+    start = time.time()
+    imp = FilterTools.apply_rollingball(imp, radius=RB_RADIUS, nthreads=NTHREADS, binning=binning)
+
+    return imp, time.time() - start
+
+############################################################################
+
+
+imagefile = FILENAME.toString()
+binnings = [int(b) for b in BINNINGS.split(',') if b.strip()]
+
+imp, MetaInfo = ImportTools.openfile(imagefile, crange=(CHANNEL, CHANNEL, 1))
+
+log.log(LogLevel.INFO, 'Image Filename : ' + imagefile)
+log.log(LogLevel.INFO, 'Dimensions     : ' + str(imp.getWidth()) + ' x ' + str(imp.getHeight())
+        + ' x ' + str(imp.getStackSize()))
+
+exact, time_exact = run_rollingball(imp.duplicate(), 1)
+valuerange = imp.getStatistics().max - imp.getStatistics().min
+
+results = ResultsTable()
+for binning in [1] + binnings:
+    fast, duration = exact, time_exact
+    if binning > 1:
+        fast, duration = run_rollingball(imp.duplicate(), binning)
+    maxerror, meanerror = geterror(exact, fast)
+
+    results.incrementCounter()
+    results.addValue('Binning', binning)
+    results.addValue('Time [s]', duration)
+    results.addValue('Speedup', time_exact / max(duration, 1e-6))
+    results.addValue('Max. Error', maxerror)
+    results.addValue('Max. Error [%]', 100.0 * maxerror / max(valuerange, 1e-6))
+    results.addValue('Mean Error', meanerror)
+
+    log.log(LogLevel.INFO, 'Binning ' + str(binning) + ' : ' + str(round(duration, 3))
+            + ' s, max. error ' + str(round(maxerror, 2)))
+
+results.show('Rolling Ball Benchmark')
+
+# finish
+log.log(LogLevel.INFO, 'Done.')
@@ -0,0 +1,98 @@
+# @File(label = "Image File", persist=True) FILENAME
+# @Integer(label = "Select Channel", value=1, persist=True) CHANNEL
+# @String(label = "Select Filter 2D", choices={"MEDIAN", "MIN", "MAX", "MEAN", "VARIANCE"}, style="listBox", value="MEDIAN", persist=True) RANKFILTER
+# @Integer(label = "Filter Radius", value=5, persist=True) RADIUS
+# @Integer(label = "Rolling Ball - Disk Radius", value=30, persist=True) RB_RADIUS
+# @Integer(label = "Rolling Ball - Binning (1 = exact)", value=1, persist=True) RB_BINNING
+# @String(label = "Threads", value="1,2,4,8,16,32", persist=True) THREADS
+# @OUTPUT String FILENAME
+# @OUTPUT Integer CHANNEL
+# @OUTPUT String RANKFILTER
+# @OUTPUT Integer RADIUS
+# @OUTPUT Integer RB_RADIUS
+# @OUTPUT Integer RB_BINNING
+# @OUTPUT String THREADS
+
+# @LogService log
+
+"""
+File: benchmark_slices.py
+Date: 2026_10_18
+Version: 0.1
+
+Measures how the slice-wise filters of fijipytools scale with the number of
+threads used by ParallelTools.process_slices. Every result is compared to
+the single-threaded result, which must be identical.
+"""
+
+import time
+from sys import path
+from java.lang.System import getProperty
+path.append(getProperty('fiji.dir') + '/scripts')
+
+from fijipytools import FilterTools, ImportTools, ThresholdTools, TileTools
+from ij.measure import ResultsTable
+from org.scijava.log import LogLevel
+
+
+def run_filter(imp, nthreads):
+    return FilterTools.apply_filter(imp, radius=RADIUS, filtertype=RANKFILTER, nthreads=nthreads)
+
+
+def run_rollingball(imp, nthreads):
+    return FilterTools.apply_rollingball(imp, radius=RB_RADIUS, nthreads=nthreads, binning=RB_BINNING)
+
+
+def run_threshold(imp, nthreads):
+    return ThresholdTools.apply_threshold(imp, method='Otsu', stackopt=False, nthreads=nthreads)
+
+
+def run_benchmark(imp, operations, threads):
+
+    results = ResultsTable()
+
+    for name, operation in operations:
+        reference = None
+        for nthreads in threads:
+            data = imp.duplicate()
+
+            start = time.time()
+            data = operation(data, nthreads)
+            duration = time.time() - start
+
+            if reference is None:
+                reference = (data, duration)
+
+            results.incrementCounter()
+            results.addValue('Operation', name)
+            results.addValue('Threads', nthreads)
+            results.addValue('Time [s]', duration)
+            results.addValue('Speedup', reference[1] / max(duration, 1e-6))
+            results.addValue('Max. Difference', TileTools.maxstackdifference(reference[0], data))
+
+            log.log(LogLevel.INFO, name + ' - ' + str(nthreads) + ' threads : '
+                    + str(round(duration, 3)) + ' s')
+
+    return results
+
+############################################################################
+
+
+imagefile = FILENAME.toString()
+threads = [int(n) for n in THREADS.split(',') if n.strip()]
+
+log.log(LogLevel.INFO, 'Image Filename : ' + imagefile)
+log.log(LogLevel.INFO, 'Threads        : ' + str(threads))
+
+imp, MetaInfo = ImportTools.openfile(imagefile, crange=(CHANNEL, CHANNEL, 1))
+log.log(LogLevel.INFO, 'Slices         : ' + str(imp.getStackSize()))
+
+operations = [('Rank Filter ' + RANKFILTER, run_filter),
+              ('Rolling Ball', run_rollingball),
+              ('Threshold', run_threshold)]
+
+results = run_benchmark(imp, operations, threads)
+results.show('Slice Engine Benchmark')
+
+# finish
+log.log(LogLevel.INFO, 'Done.')
@@ -19,9 +19,9 @@ path.append(getProperty('fiji.dir') + '/scripts')
 
 from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
 from fijipytools import RoiTools, MiscTools, ThresholdTools, AnalyzeTools
+from fijipytools import CPUBackend
 
 from ij import IJ
-from net.haesleinhuepf.clij import CLIJ
 
 import inspect
 def getResource(file):
@@ -37,8 +37,8 @@ imp, MetaInfo = ImportTools.openfile(imagefile)
 imp.show();
 
 
-# init GPU
-clij = CLIJ.getInstance()
+# init GPU - or the CPU backend without OpenCL device
+clij = CPUBackend.getbackend()
 
 # push image to GPU
 input = clij.push(imp)
@@ -52,6 +52,15 @@ clij.op().automaticThreshold(input, output, "Otsu")
 # show result
 clij.pull(output).show()
 IJ.setMinAndMax(0, 1)
+
+# background subtraction - blur and subtract the blurred image
+background = clij.create(input)
+background_subtracted = clij.create(input)
+clij.op().blur(input, background, 10.0, 10.0, 1.0)
+clij.op().addImagesWeighted(input, background, background_subtracted, 1.0, -1.0)
+
+# show result
+clij.pull(background_subtracted).show()
 """
 
 #########################
@@ -19,9 +19,9 @@ path.append(getProperty('fiji.dir') + '/scripts')
 
 from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
 from fijipytools import RoiTools, MiscTools, ThresholdTools, AnalyzeTools
+from fijipytools import CPUBackend
 
 from ij import IJ
-from net.haesleinhuepf.clij import CLIJ
 
 import inspect
 def getResource(file):
@@ -32,8 +32,8 @@ imagefile = r"/datadisk1/tuxedo/Github/Tools_and_Scripts/Fiji/scripts/Osteosarco
 imp, MetaInfo = ImportTools.openfile(imagefile)
 
 
-# init GPU
-clij = CLIJ.getInstance();
+# init GPU - or the CPU backend without OpenCL device
+clij = CPUBackend.getbackend();
 
 # push image to GPU
 input = clij.push(imp);
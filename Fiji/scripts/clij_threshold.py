@@ -1,7 +1,9 @@
 # @File(label = "Image File", persist=True) FILENAME
 # @String(label = "Method", choices={"Otsu", "Triangle", "IJDefault", "Huang", "MaxEntropy", "Mean", "Shanbhag", "Yen", "Li"}, style="listBox", value="Otsu", persist=True) threshold_method
+# @Boolean(label = "Use GPU (CLIJ) if available", value=True, persist=True) USE_GPU
 # @OUTPUT String FILENAME
 # @OUTPUT String threshold_method
+# @OUTPUT Boolean USE_GPU
 
 # @UIService uiService
 # @LogService log
@@ -21,9 +23,10 @@ path.append(getProperty('fiji.dir') + '/scripts')
 
 from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
 from fijipytools import RoiTools, MiscTools, ThresholdTools, AnalyzeTools
+from fijipytools import CPUBackend
 
 from ij import IJ
-from net.haesleinhuepf.clij import CLIJ
+from ij.process import Blitter
 
 import inspect
 def getResource(file):
@@ -48,22 +51,23 @@ imp, MetaInfo = ImportTools.openfile(imagefile)
 
 start = time.clock()
 
-# init GPU
-clij = CLIJ.getInstance();
+# init GPU - or the CPU backend without OpenCL device
+clij = CPUBackend.getbackend(usegpu=USE_GPU)
+log.info('Backend                : ' + clij.getName())
 
 # push image to GPU
 input = clij.push(imp);
 
 # reserve memory for output, same size and type as input
 output = clij.create(input);
-	
+
 # apply threshold method on GPU
-if threshold_method == 'Otsu':
-	clij.op().automaticThreshold(input, output, threshold_method);
+clij.op().automaticThreshold(input, output, threshold_method);
 
-	# show result
-	clij.pull(output).show();
-	IJ.setMinAndMax(0, 1);
+# show result
+clij_image = clij.pull(output)
+clij_image.show();
+IJ.setMinAndMax(0, 1);
 
 end = time.clock()
 
@@ -85,6 +89,17 @@ th_image = ThresholdTools.apply_threshold(imp,
 end2 = time.clock()
 
 log.info('Duration of Processing Fiji: ' + str(end2 - start2))
+log.info('Speedup CLIJ vs. Fiji      : ' + str(round((end2 - start2) / max(end - start, 1e-6), 2)))
+
+# fraction of voxels where both binary results differ, the histogram
+# bins of both paths are not the same, so small differences are expected
+differ = 0
+for index in range(1, imp.getStackSize() + 1):
+    diff = th_image.getStack().getProcessor(index).duplicate()
+    diff.multiply(1.0 / 255.0)
+    diff.copyBits(clij_image.getStack().getProcessor(index).convertToByte(False), 0, 0, Blitter.DIFFERENCE)
+    differ += diff.getStatistics().mean
+log.info('Voxels different [%]       : ' + str(round(100.0 * differ / imp.getStackSize(), 3)))
 
 # finish
 log.info('Done.')
@@ -18,13 +18,35 @@
 
 import os
 import json
-from java.lang import Double, Integer
+import socket
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import Queue
+import itertools
+import math
+from collections import OrderedDict
+from java.io import File, RandomAccessFile
+from java.io import FileOutputStream, BufferedOutputStream
+from java.io import ByteArrayOutputStream, ByteArrayInputStream
+from java.lang import Double, Integer, Throwable, System
+from java.lang import String, Object
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.file import Files, Paths, StandardCopyOption
+from java.util.zip import Deflater, Inflater, GZIPOutputStream, GZIPInputStream
+from jarray import zeros, array
+from java.util.concurrent import Callable, Executors
 from java.awt import GraphicsEnvironment
-from ij import IJ, ImagePlus, ImageStack, Prefs
+from ij import IJ, ImagePlus, ImageStack, Prefs, CompositeImage
+from ij import VirtualStack
 from ij.process import ImageProcessor, ImageConverter
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
+from ij.process import Blitter
 from ij.process import StackStatistics
 from ij.process import AutoThresholder
-from ij.plugin import Thresholder, Duplicator
+from ij.plugin import Thresholder, Duplicator, Binner
 from ij.plugin.filter import GaussianBlur, RankFilters
 from ij.plugin.filter import BackgroundSubtracter, Binary
 from ij.plugin.filter import ParticleAnalyzer as PA
@@ -32,7 +54,7 @@ from ij.plugin.filter import EDM
 from ij.plugin import Filters3D
 from ij.plugin.frame import RoiManager
 from ij.plugin import ChannelSplitter
-from ij.io import FileSaver
+from ij.io import FileSaver, FileInfo, TiffEncoder
 from ij.gui import Roi
 from ij.gui import Overlay
 from ij.io import Opener
@@ -41,15 +63,22 @@ from ij.measure import Calibration
 from fiji.threshold import Auto_Threshold
 from loci.plugins import BF
 from loci.common import Region
-from loci.plugins.in import ImporterOptions
+from loci.common import DataTools
 from loci.plugins.util import LociPrefs
+from loci.plugins.util import ImageProcessorReader
 from loci.plugins.out import Exporter
 from loci.plugins import LociExporter
 from loci.formats import ImageReader
+from loci.formats import ImageWriter
 from loci.formats import MetadataTools
+from loci.formats import ChannelSeparator
+from loci.formats import Memoizer
 from loci.formats.in import ZeissCZIReader
 from loci.formats.in import DynamicMetadataOptions
+from loci.formats.out import PyramidOMETiffWriter
 from ome.units import UNITS
+from ome.units.quantity import Length
+from ome.xml.model.primitives import PositiveInteger
 
 # MorphoLibJ imports
 from inra.ijpb.binary import BinaryImages, ChamferWeights3D, ChamferWeights
@@ -69,35 +98,130 @@ from inra.ijpb.morphology import Reconstruction
 from inra.ijpb.morphology import Reconstruction3D
 
 
-class ImportTools:
+class ReaderSession:
+    """
+    Initializes the Bio-Formats reader for an image file only once.
+    Metadata and pixel data are read from the same initialized reader,
+    so opening a file pays for the header parsing (setId) only once.
+    Call close() when done.
+    """
 
-    @staticmethod
-    def openfile(imagefile,
+    def __init__(self, imagefile,
                  stitchtiles=True,
                  setflatres=False,
-                 readpylevel=0,
-                 setconcat=True,
-                 openallseries=True,
-                 showomexml=False,
                  attach=False,
-                 autoscale=True,
-                 imageID=0):
+                 memodir=None):
 
-        # stitchtiles = option of CZIReader to return the raw tiles as
-        # individual series rather than the auto-stitched images
+        self.imagefile = imagefile
+        self.extension = MiscTools.getextension(MiscTools.splitext_recurse(imagefile))
+        self.stitchtiles = stitchtiles
+        self.setflatres = setflatres
+
+        # the OME metadata store is filled during setId
+        self.omeMeta = MetadataTools.createOMEXMLMetadata()
+
+        if self.extension == '.czi':
+
+            # stitchtiles = option of CZIReader to return the raw tiles as
+            # individual series rather than the auto-stitched images
+            options = DynamicMetadataOptions()
+            options.setBoolean("zeissczi.autostitch", stitchtiles)
+            options.setBoolean("zeissczi.attachments", attach)
+
+            reader = ZeissCZIReader()
+            reader.setMetadataOptions(options)
+
+            # Set the preferences in the ImageJ plugin
+            # Note although these preferences are applied, they are not refreshed in the UI
+            Prefs.set("bioformats.zeissczi.allow.autostitch", str(stitchtiles).lower())
+            Prefs.set("bioformats.zeissczi.include.attachments", str(attach).lower())
+
+        else:
+            reader = ImageReader()
+
+        # optional Bio-Formats memo file - a repeated setId restores the
+        # initialized reader from the memo instead of parsing the header again
+        if memodir is not None:
+            reader = Memoizer(reader, 0, File(memodir))
+
+        reader.setFlattenedResolutions(setflatres)
+        reader.setMetadataStore(self.omeMeta)
+        reader.setId(imagefile)
+
+        # keep the format specific reader (e.g. ZeissCZIReader) and wrap it
+        # to get separated RGB channels as ImageProcessors
+        if memodir is not None:
+            self.basereader = reader.getReader()
+        if memodir is None:
+            self.basereader = reader
+        self.reader = ImageProcessorReader(ChannelSeparator(reader))
+        self.levels = None
+
+        # the reader has a state (series, resolution) - reading planes from
+        # several threads must be serialized
+        self.lock = threading.RLock()
+
+    def close(self):
+
+        self.reader.close()
+
+    def getlevels(self):
+
+        # list of (series, resolution) in the order of the flattened series,
+        # which is the order used by the Bio-Formats importer
+        if self.levels is None:
+            levels = []
+            for s in range(self.reader.getSeriesCount()):
+                self.reader.setSeries(s)
+                for r in range(self.reader.getResolutionCount()):
+                    levels.append((s, r))
+
+            self.reader.setSeries(0)
+            self.levels = levels
+
+        return self.levels
+
+    def setlevel(self, pylevel=0):
+
+        levels = self.getlevels()
+        if pylevel < 0 or pylevel >= len(levels):
+            # fallback option
+            print('PyLevel = ' + str(pylevel) + ' does not exist.')
+            print('Using Pyramid Level = 0 as fallback.')
+            pylevel = 0
+
+        series, resolution = levels[pylevel]
+        self.reader.setSeries(series)
+        self.reader.setResolution(resolution)
+
+        return pylevel
+
+    def getmetainfo(self, imageID=0, metacache=None):
+
+        # reuse the metainfo from the MetadataCache if available
+        if metacache is not None:
+            metainfo = metacache.get(self.imagefile,
+                                     stitchtiles=self.stitchtiles,
+                                     setflatres=self.setflatres,
+                                     imageID=imageID)
+            if metainfo is not None:
+                return metainfo
+
+            metainfo = self.getmetainfo(imageID=imageID)
+            metacache.put(self.imagefile, metainfo,
+                          stitchtiles=self.stitchtiles,
+                          setflatres=self.setflatres,
+                          imageID=imageID)
+
+            return metainfo
 
         metainfo = {}
         # checking for thr file Extension
-        metainfo['Extension'] = MiscTools.getextension(MiscTools.splitext_recurse(imagefile))
+        metainfo['Extension'] = self.extension
+        metainfo['ImageCount_OME'] = self.omeMeta.getImageCount()
+        metainfo['SeriesCount_BF'] = len(self.getlevels())
 
-        # initialite the reader and get the OME metadata
-        reader = ImageReader()
-        omeMeta = MetadataTools.createOMEXMLMetadata()
-        metainfo['ImageCount_OME'] = omeMeta.getImageCount()
-        reader.setMetadataStore(omeMeta)
-        reader.setId(imagefile)
-        metainfo['SeriesCount_BF'] = reader.getSeriesCount()
-        reader.close()
+        omeMeta = self.omeMeta
 
         # read dimensions TZCXY from OME metadata
         metainfo['SizeT'] = omeMeta.getPixelsSizeT(imageID).getValue()
@@ -112,14 +236,17 @@ class ImportTools:
         elif metainfo['SizeZ'] > 1:
             metainfo['is3d'] = True
 
-        # get the scaling for XYZ
-        physSizeX = omeMeta.getPixelsPhysicalSizeX(0)
-        physSizeY = omeMeta.getPixelsPhysicalSizeY(0)
-        physSizeZ = omeMeta.getPixelsPhysicalSizeZ(0)
+        # get the scaling for XYZ of the same image (scene)
+        physSizeX = omeMeta.getPixelsPhysicalSizeX(imageID)
+        physSizeY = omeMeta.getPixelsPhysicalSizeY(imageID)
+        physSizeZ = omeMeta.getPixelsPhysicalSizeZ(imageID)
 
         if physSizeX is not None:
             metainfo['ScaleX'] = round(physSizeX.value(), 3)
             metainfo['ScaleY'] = round(physSizeX.value(), 3)
+            # square pixels are assumed when only X is calibrated
+            if physSizeY is not None:
+                metainfo['ScaleY'] = round(physSizeY.value(), 3)
         if physSizeX is None:
             metainfo['ScaleX'] = None
             metainfo['ScaleY'] = None
@@ -129,41 +256,853 @@ class ImportTools:
         if physSizeZ is None:
             metainfo['ScaleZ'] = None
 
-        # if image file is Carl Zeiss Image - CZI
-        if metainfo['Extension'] == '.czi':
-
-            # read the CZI file using the CZIReader
-            # pylevel = 0 - read the full resolution image
-
-            imp, metainfo = ImportTools.readCZI(imagefile, metainfo,
-                                                stitchtiles=stitchtiles,
-                                                setflatres=setflatres,
-                                                readpylevel=readpylevel,
-                                                setconcat=setconcat,
-                                                openallseries=openallseries,
-                                                showomexml=showomexml,
-                                                attach=attach,
-                                                autoscale=autoscale)
-
-        # if image file is not Carl Zeiss Image - CZI
-        if metainfo['Extension'] != '.czi':
-
-            # read the imagefile using the correct method
-            if metainfo['Extension'].lower() == ('.jpg' or '.jpeg'):
-                # use dedicated method for jpg
-                imp, metainfo = ImageTools.openjpg(imagefile, method='IJ')
+        # XY size of all series and resolution levels (flattened order)
+        pyramidsizes = []
+        for series, resolution in self.getlevels():
+            self.reader.setSeries(series)
+            self.reader.setResolution(resolution)
+            pyramidsizes.append([self.reader.getSizeX(), self.reader.getSizeY()])
+
+        self.reader.setSeries(0)
+        metainfo['Pyramid Sizes'] = pyramidsizes
+
+        if self.extension == '.czi':
+            metainfo.update(self.getczimetainfo(series=imageID))
+
+        return metainfo
+
+    def getczimetainfo(self, series=0):
+
+        # the sizes are read from the series of the requested scene
+        czireader = self.basereader
+        if series < 0 or series >= czireader.getSeriesCount():
+            series = 0
+        czireader.setSeries(series)
+
+        metainfo = {}
+        metainfo['rescount'] = czireader.getResolutionCount()
+        metainfo['SeriesCount_CZI'] = czireader.getSeriesCount()
+        metainfo['flatres'] = czireader.hasFlattenedResolutions()
+        # metainfo['getreslevel'] = czireader.getResolution()
+
+        # Dimensions
+        metainfo['SizeT'] = czireader.getSizeT()
+        metainfo['SizeZ'] = czireader.getSizeZ()
+        metainfo['SizeC'] = czireader.getSizeC()
+        metainfo['SizeX'] = czireader.getSizeX()
+        metainfo['SizeY'] = czireader.getSizeY()
+
+        # check for autostitching and possibility to read attachment
+        metainfo['AllowAutoStitching'] = czireader.allowAutostitching()
+        metainfo['CanReadAttachments'] = czireader.canReadAttachments()
+
+        czireader.setSeries(0)
+
+        return metainfo
+
+    def getgroups(self, openallseries=True, setconcat=False):
+
+        # group the flattened series the way the Bio-Formats importer returns
+        # them as ImagePlus - only the metadata is used, no pixels are read
+        levels = self.getlevels()
+        if not openallseries:
+            levels = levels[:1]
+
+        groups = []
+        lastdims = None
+        for pylevel in range(len(levels)):
+            series, resolution = levels[pylevel]
+            self.reader.setSeries(series)
+            self.reader.setResolution(resolution)
+            dims = (self.reader.getSizeX(),
+                    self.reader.getSizeY(),
+                    self.reader.getSizeC(),
+                    self.reader.getSizeZ(),
+                    self.reader.getPixelType())
+
+            # concatenate consecutive series with identical XY, C, Z and
+            # pixel type along T - same as the "concatenate" importer option
+            if setconcat and groups and dims == lastdims:
+                groups[-1].append(pylevel)
+            else:
+                groups.append([pylevel])
+            lastdims = dims
+
+        self.reader.setSeries(0)
+
+        return groups
+
+    @staticmethod
+    def getindices(dimrange, size, fallback=True):
+
+        # convert a (begin, end, step) range into 0-based plane indices
+        # begin and end are 1-based and inclusive like for the Duplicator
+        # fallback=False returns an empty list for a range outside of the size
+        if dimrange is None:
+            return range(size)
+
+        begin, end, step = dimrange
+        indices = range(max(begin, 1) - 1, min(end, size), max(step, 1))
+
+        if not indices and fallback:
+            # fallback option
+            print('Range ' + str(dimrange) + ' does not exist.')
+            print('Using Index = 1 as fallback.')
+            indices = [0]
+
+        return indices
+
+    def getplanes(self, pylevels,
+                  crange=None,
+                  zrange=None,
+                  trange=None,
+                  region=None):
+
+        # list the planes of one or more compatible series / resolution levels
+        # in the ImageJ plane order without reading any pixel data
+        # several levels are concatenated along T
+        # region = optional loci.common.Region to read only an XY crop box
+        planes = []
+        sizeT = 0
+        offsetT = 0
+
+        for pylevel in pylevels:
+            self.setlevel(pylevel)
+            reader = self.reader
+
+            cindices = ReaderSession.getindices(crange, reader.getSizeC())
+            zindices = ReaderSession.getindices(zrange, reader.getSizeZ())
+
+            # clip the crop box to the image bounds of the current level
+            crop = Region(0, 0, reader.getSizeX(), reader.getSizeY())
+            if region is not None:
+                if not crop.intersects(region):
+                    print('Region ' + str(region) + ' is outside of the image.')
+                    return None
+                crop = crop.intersection(region)
+
+            # T is counted over all concatenated levels
+            # an empty range is fine for a single level, the fallback is
+            # only used when no level contains the range
+            tindices = ReaderSession.getindices(trange, offsetT + reader.getSizeT(), fallback=False)
+            tindices = [t - offsetT for t in tindices if t >= offsetT]
+
+            # C is the fastest moving dimension
+            for t in tindices:
+                for z in zindices:
+                    for c in cindices:
+                        planes.append((pylevel, reader.getIndex(z, c, t), c, z, offsetT + t))
+
+            offsetT += reader.getSizeT()
+            sizeT += len(tindices)
+
+        if sizeT == 0:
+            # fallback option
+            print('Range ' + str(trange) + ' does not exist.')
+            print('Using Index = 1 as fallback.')
+            return self.getplanes(pylevels, crange=crange, zrange=zrange, trange=(1, 1, 1), region=region)
+
+        dims = (len(cindices), len(zindices), sizeT)
+
+        return planes, dims, crop
+
+    @staticmethod
+    def getplanelabel(plane):
+
+        pylevel, index, c, z, t = plane
+
+        return 'c:' + str(c + 1) + ' z:' + str(z + 1) + ' t:' + str(t + 1)
+
+    def readplane(self, plane, crop):
+
+        # read a single plane (entry of getplanes) as ImageProcessor
+        pylevel, index, c, z, t = plane
+
+        with self.lock:
+            self.setlevel(pylevel)
+            ip = self.reader.openProcessors(index, crop.x, crop.y, crop.width, crop.height)[0]
+
+        return ip
+
+    def createimp(self, pylevel, stack, dims, autoscale=True):
+
+        sizeC, sizeZ, sizeT = dims
+
+        title = os.path.basename(self.imagefile)
+        if pylevel > 0:
+            title = title + ' #' + str(pylevel + 1)
+
+        imp = ImagePlus(title, stack)
+        imp.setDimensions(sizeC, sizeZ, sizeT)
+        imp.setOpenAsHyperStack(True)
+
+        if sizeC > 1:
+            imp = CompositeImage(imp, CompositeImage.COLOR)
+            if autoscale:
+                imp.resetDisplayRanges()
+
+        if sizeC == 1 and autoscale:
+            imp.resetDisplayRange()
+
+        return imp
+
+    def readlevels(self, pylevels, autoscale=True,
+                   crange=None,
+                   zrange=None,
+                   trange=None,
+                   region=None,
+                   virtual=False,
+                   cacheplanes=16):
+
+        # read one or more compatible series / resolution levels into an
+        # ImagePlus - only the planes inside the C, Z and T ranges are decoded
+        # virtual = read the planes on demand using a PlaneCacheStack
+        result = self.getplanes(pylevels,
+                                crange=crange,
+                                zrange=zrange,
+                                trange=trange,
+                                region=region)
+        if result is None:
+            return None
+
+        planes, dims, crop = result
+
+        if virtual:
+            stack = PlaneCacheStack(self, planes, crop, cacheplanes=cacheplanes)
+
+        if not virtual:
+            stack = ImageStack(crop.width, crop.height)
+            for plane in planes:
+                stack.addSlice(ReaderSession.getplanelabel(plane), self.readplane(plane, crop))
+
+        return self.createimp(pylevels[0], stack, dims, autoscale=autoscale)
+
+    def openlevel(self, pylevel=0,
+                  openallseries=True,
+                  setconcat=False,
+                  autoscale=True,
+                  crange=None,
+                  zrange=None,
+                  trange=None,
+                  region=None,
+                  virtual=False,
+                  cacheplanes=16):
+
+        # decode only the requested series / pyramid level
+        groups = self.getgroups(openallseries=openallseries, setconcat=setconcat)
+
+        if pylevel < 0 or pylevel >= len(groups):
+            # fallback option
+            print('PyLevel = ' + str(pylevel) + ' does not exist.')
+            print('Using Pyramid Level = 0 as fallback.')
+            pylevel = 0
+
+        imp = self.readlevels(groups[pylevel],
+                              autoscale=autoscale,
+                              crange=crange,
+                              zrange=zrange,
+                              trange=trange,
+                              region=region,
+                              virtual=virtual,
+                              cacheplanes=cacheplanes)
+
+        return imp, pylevel
+
+    def openimps(self, openallseries=True, setconcat=False, autoscale=True):
+
+        # read all series like the Bio-Formats importer does
+        imps = []
+        for group in self.getgroups(openallseries=openallseries, setconcat=setconcat):
+            imps.append(self.readlevels(group, autoscale=autoscale))
+
+        return imps
+
+
+class PlaneCacheStack(VirtualStack):
+    """
+    Virtual stack that reads the planes on demand from a ReaderSession.
+    At most cacheplanes planes are kept in memory and the least recently
+    used plane is evicted. Planes written back with setProcessor or
+    setPixels (ParallelTools.process_slices does this) are marked as
+    modified and written to a spill folder when evicted and read back from
+    there. Unmodified planes are dropped and read again from the session.
+    Use readonly=True to drop modified planes as well.
+    Call close() to close the reader and remove the spill folder.
+    """
+
+    def __init__(self, session, planes, crop,
+                 cacheplanes=16,
+                 readonly=False,
+                 spilldir=None):
+
+        VirtualStack.__init__(self, crop.width, crop.height, None, None)
+
+        self.session = session
+        self.planes = planes
+        self.crop = crop
+        self.cacheplanes = max(cacheplanes, 1)
+        self.readonly = readonly
+        self.cache = OrderedDict()
+        self.spilled = {}
+        self.dirty = set()
+        self.lock = threading.RLock()
+
+        if spilldir is None:
+            spilldir = tempfile.mkdtemp(prefix='fijipytools_')
+        self.spilldir = spilldir
+
+        self.bitdepth = self.getProcessor(1).getBitDepth()
+
+    def getSize(self):
+
+        return len(self.planes)
+
+    def getSliceLabel(self, n):
+
+        return ReaderSession.getplanelabel(self.planes[n - 1])
+
+    def getProcessor(self, n):
+
+        with self.lock:
+            if n in self.cache:
+                # mark as most recently used
+                ip = self.cache.pop(n)
+                self.cache[n] = ip
+                return ip
+
+            if n in self.spilled:
+                ip = Opener().openImage(self.spilled[n]).getProcessor()
             else:
-                # if not jpg - use BioFormats
-                imp, metainfo = ImportTools.readbf(imagefile, metainfo,
-                                                   setflatres=setflatres,
-                                                   readpylevel=readpylevel,
-                                                   setconcat=setconcat,
-                                                   openallseries=openallseries,
-                                                   showomexml=showomexml,
-                                                   autoscale=autoscale)
+                ip = self.session.readplane(self.planes[n - 1], self.crop)
+
+            self.putplane(n, ip)
+
+        return ip
+
+    def setProcessor(self, ip, n):
+
+        with self.lock:
+            self.cache.pop(n, None)
+            self.dirty.add(n)
+            self.putplane(n, ip)
+            self.bitdepth = ip.getBitDepth()
+
+    def getPixels(self, n):
+
+        return self.getProcessor(n).getPixels()
+
+    def setPixels(self, pixels, n):
+
+        with self.lock:
+            self.getProcessor(n).setPixels(pixels)
+            self.dirty.add(n)
+
+    def getBitDepth(self):
+
+        return self.bitdepth
+
+    def putplane(self, n, ip):
+
+        self.cache[n] = ip
+
+        while len(self.cache) > self.cacheplanes:
+            oldn, oldip = self.cache.popitem(last=False)
+            # only modified planes differ from the file or the spill folder
+            if oldn in self.dirty and not self.readonly:
+                self.spill(oldn, oldip)
+            self.dirty.discard(oldn)
+
+    def spill(self, n, ip):
+
+        spillpath = os.path.join(self.spilldir, 'plane_' + str(n) + '.tif')
+        FileSaver(ImagePlus('plane_' + str(n), ip)).saveAsTiff(spillpath)
+        self.spilled[n] = spillpath
+
+    def close(self):
+
+        self.cache.clear()
+        self.dirty.clear()
+        self.session.close()
+        shutil.rmtree(self.spilldir, True)
+
+
+class MetadataCache:
+    """
+    Persistent on-disk cache for the metainfo dictionary of image files.
+    Entries are keyed by the file path, size and modification time, so a
+    changed file is never served from the cache. The number of entries is
+    bounded and the least recently used entries are evicted.
+    Optionally the Bio-Formats memo files are stored inside the cache folder.
+    """
+
+    def __init__(self, cachedir=None, maxentries=1000, usememo=True):
+
+        if cachedir is None:
+            cachedir = os.path.join(os.path.expanduser('~'), '.fijipytools', 'metacache')
+
+        self.cachedir = cachedir
+        self.maxentries = maxentries
+        self.memodir = None
+
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        if usememo:
+            self.memodir = os.path.join(cachedir, 'memo')
+            if not os.path.isdir(self.memodir):
+                os.makedirs(self.memodir)
+
+        # counters for the current session
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getkey(self, imagefile, **options):
+
+        # the key changes when the file or the reader options change
+        filestat = os.stat(imagefile)
+        keydata = [os.path.abspath(imagefile),
+                   filestat.st_size,
+                   int(filestat.st_mtime * 1000),
+                   sorted(options.items())]
+
+        return hashlib.sha1(json.dumps(keydata)).hexdigest()
+
+    def getentrypath(self, key):
+
+        return os.path.join(self.cachedir, key + '.json')
+
+    def get(self, imagefile, **options):
+
+        entrypath = self.getentrypath(self.getkey(imagefile, **options))
+
+        try:
+            with open(entrypath, 'r') as f:
+                metainfo = json.load(f)
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+
+        # update the access time used for the eviction
+        os.utime(entrypath, None)
+        self.hits += 1
+
+        # json returns unicode strings
+        return dict((str(k), v) for k, v in metainfo.items())
+
+    def put(self, imagefile, metainfo, **options):
+
+        entrypath = self.getentrypath(self.getkey(imagefile, **options))
+
+        # write to a temporary file first - an aborted run never leaves
+        # a broken entry behind
+        tmppath = entrypath + '.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump(metainfo, f, indent=4)
+
+        if os.path.exists(entrypath):
+            os.remove(entrypath)
+        os.rename(tmppath, entrypath)
+
+        self.evict()
+
+    def getentries(self):
+
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith('.json'):
+                entrypath = os.path.join(self.cachedir, name)
+                entries.append((os.path.getmtime(entrypath), entrypath))
+
+        # oldest entries first
+        entries.sort()
+
+        return entries
+
+    def getmemofiles(self):
+
+        # the Memoizer keeps the folder structure of the image files
+        memofiles = []
+        if self.memodir is not None and os.path.isdir(self.memodir):
+            for dirpath, dirnames, filenames in os.walk(self.memodir):
+                for name in filenames:
+                    memopath = os.path.join(dirpath, name)
+                    memofiles.append((os.path.getmtime(memopath), memopath))
+
+        # oldest files first
+        memofiles.sort()
+
+        return memofiles
+
+    def evict(self):
+
+        entries = self.getentries()
+        numevict = len(entries) - self.maxentries
+
+        for mtime, entrypath in entries[:max(numevict, 0)]:
+            os.remove(entrypath)
+            self.evictions += 1
+
+        # the memo files are bounded by the same number of entries
+        memofiles = self.getmemofiles()
+        for mtime, memopath in memofiles[:max(len(memofiles) - self.maxentries, 0)]:
+            os.remove(memopath)
+
+    def clear(self):
+
+        for mtime, entrypath in self.getentries():
+            os.remove(entrypath)
+
+        for mtime, memopath in self.getmemofiles():
+            os.remove(memopath)
+
+    def stats(self):
+
+        stats = {}
+        stats['Hits'] = self.hits
+        stats['Misses'] = self.misses
+        stats['Evictions'] = self.evictions
+        stats['Entries'] = len(self.getentries())
+        stats['Memo Files'] = len(self.getmemofiles())
+
+        return stats
+
+
+class ImportTools:
+
+    @staticmethod
+    def openfile(imagefile,
+                 stitchtiles=True,
+                 setflatres=False,
+                 readpylevel=0,
+                 setconcat=True,
+                 openallseries=True,
+                 showomexml=False,
+                 attach=False,
+                 autoscale=True,
+                 imageID=0,
+                 metacache=None,
+                 crange=None,
+                 zrange=None,
+                 trange=None,
+                 virtual=False,
+                 cacheplanes=16):
+
+        # stitchtiles = option of CZIReader to return the raw tiles as
+        # individual series rather than the auto-stitched images
+
+        # crange, zrange, trange = (begin, end, step) for C, Z and T
+        # 1-based and inclusive - only those planes will be read
+
+        # virtual = return a PlaneCacheStack that reads the planes on demand
+        # and keeps at most cacheplanes planes in memory. The stack keeps the
+        # reader open - call imp.getStack().close() when done
+
+        # metacache = optional MetadataCache to reuse the metainfo and the
+        # Bio-Formats memo files from previous runs
+        memodir = None
+        if metacache is not None:
+            memodir = metacache.memodir
+
+        # initialize the reader only once and get the OME metadata
+        session = ReaderSession(imagefile,
+                                stitchtiles=stitchtiles,
+                                setflatres=setflatres,
+                                attach=attach,
+                                memodir=memodir)
+
+        try:
+            metainfo = session.getmetainfo(imageID=imageID, metacache=metacache)
+
+            # if image file is Carl Zeiss Image - CZI
+            if metainfo['Extension'] == '.czi':
+
+                # read the CZI file using the CZIReader
+                # pylevel = 0 - read the full resolution image
+
+                imp, metainfo = ImportTools.readCZI(imagefile, metainfo,
+                                                    stitchtiles=stitchtiles,
+                                                    setflatres=setflatres,
+                                                    readpylevel=readpylevel,
+                                                    setconcat=setconcat,
+                                                    openallseries=openallseries,
+                                                    showomexml=showomexml,
+                                                    attach=attach,
+                                                    autoscale=autoscale,
+                                                    session=session,
+                                                    crange=crange,
+                                                    zrange=zrange,
+                                                    trange=trange,
+                                                    virtual=virtual,
+                                                    cacheplanes=cacheplanes,
+                                                    imageID=imageID)
+
+            # if image file is not Carl Zeiss Image - CZI
+            if metainfo['Extension'] != '.czi':
+
+                # read the imagefile using the correct method
+                if metainfo['Extension'].lower() == ('.jpg' or '.jpeg'):
+                    # use dedicated method for jpg
+                    imp, metainfo = ImageTools.openjpg(imagefile, method='IJ')
+                else:
+                    # if not jpg - use BioFormats
+                    imp, metainfo = ImportTools.readbf(imagefile, metainfo,
+                                                       setflatres=setflatres,
+                                                       readpylevel=readpylevel,
+                                                       setconcat=setconcat,
+                                                       openallseries=openallseries,
+                                                       showomexml=showomexml,
+                                                       autoscale=autoscale,
+                                                       session=session,
+                                                       crange=crange,
+                                                       zrange=zrange,
+                                                       trange=trange,
+                                                       virtual=virtual,
+                                                       cacheplanes=cacheplanes)
+        finally:
+            # a virtual stack still needs the reader
+            if not virtual:
+                session.close()
+
+        return imp, metainfo
+
+    @staticmethod
+    def getmetainfo(imagefile,
+                    stitchtiles=True,
+                    setflatres=False,
+                    attach=False,
+                    imageID=0,
+                    metacache=None):
+
+        # read only the metainfo without reading any pixel data
+        # in case of a cache hit the file is not touched at all
+        if metacache is not None:
+            metainfo = metacache.get(imagefile,
+                                     stitchtiles=stitchtiles,
+                                     setflatres=setflatres,
+                                     imageID=imageID)
+            if metainfo is not None:
+                return metainfo
+
+        memodir = None
+        if metacache is not None:
+            memodir = metacache.memodir
+
+        session = ReaderSession(imagefile,
+                                stitchtiles=stitchtiles,
+                                setflatres=setflatres,
+                                attach=attach,
+                                memodir=memodir)
+        try:
+            metainfo = session.getmetainfo(imageID=imageID, metacache=metacache)
+        finally:
+            session.close()
+
+        return metainfo
+
+    @staticmethod
+    def readregion(imagefile, x, y, width, height,
+                   readpylevel=0,
+                   stitchtiles=True,
+                   setflatres=False,
+                   setconcat=True,
+                   autoscale=True,
+                   imageID=0,
+                   metacache=None,
+                   crange=None,
+                   zrange=None,
+                   trange=None):
+
+        # read only a XY crop box from the file without decoding the full plane
+        # x, y, width, height are pixel coordinates of the selected pyramid level
+        memodir = None
+        if metacache is not None:
+            memodir = metacache.memodir
+
+        session = ReaderSession(imagefile,
+                                stitchtiles=stitchtiles,
+                                setflatres=setflatres,
+                                memodir=memodir)
+
+        try:
+            metainfo = session.getmetainfo(imageID=imageID, metacache=metacache)
+            region = Region(x, y, width, height)
+
+            imp, pylevel = session.openlevel(pylevel=readpylevel,
+                                             setconcat=setconcat,
+                                             autoscale=autoscale,
+                                             crange=crange,
+                                             zrange=zrange,
+                                             trange=trange,
+                                             region=region)
+
+            # full width of the selected level
+            levelsizeX = session.reader.getSizeX()
+        finally:
+            session.close()
+
+        metainfo['Pyramid Level Output'] = pylevel
+        metainfo['Region'] = [x, y, width, height]
+
+        if imp is None:
+            return None, metainfo
+
+        # get the stack and some info
+        imgstack = imp.getImageStack()
+        metainfo['Output Slices'] = imgstack.getSize()
+        metainfo['Output SizeX'] = imgstack.getWidth()
+        metainfo['Output SizeY'] = imgstack.getHeight()
+
+        # calc scaling in case of pyramid
+        scale = float(metainfo['SizeX']) / float(levelsizeX)
+        metainfo['Pyramid Scale Factor'] = scale
+
+        if metainfo['ScaleX'] is not None:
+            metainfo['ScaleX Output'] = metainfo['ScaleX'] * scale
+            metainfo['ScaleY Output'] = metainfo['ScaleY'] * scale
+            imp = MiscTools.setscale(imp, scaleX=metainfo['ScaleX Output'],
+                                     scaleY=metainfo['ScaleY Output'],
+                                     scaleZ=metainfo['ScaleZ'],
+                                     unit="micron")
 
         return imp, metainfo
 
+    @staticmethod
+    def readzarr(zarrpath, crange=None, zrange=None, trange=None, region=None):
+        """
+        Reads a sub-volume of a Zarr v2 array as ImagePlus, e.g. one object or
+        slab of a label stack written by ExportTools.save_zarr. Only the chunks
+        overlapping the requested ranges are read from disk.
+        zarrpath = array directory or OME-Zarr group (uses the array '0').
+        crange, zrange, trange = 1-based (begin, end, step), region = (x, y, w, h).
+        Arrays with 2 to 5 dimensions are read as (t, c, z, y, x).
+        """
+        scale = None
+        if not os.path.exists(os.path.join(zarrpath, '.zarray')):
+            with open(os.path.join(zarrpath, '.zattrs')) as jsonfile:
+                dataset = json.load(jsonfile)['multiscales'][0]['datasets'][0]
+            for transform in dataset.get('coordinateTransformations', []):
+                if transform['type'] == 'scale':
+                    scale = transform['scale']
+            zarrpath = os.path.join(zarrpath, dataset['path'])
+
+        with open(os.path.join(zarrpath, '.zarray')) as jsonfile:
+            zarray = json.load(jsonfile)
+
+        # only the numcodecs compressors available in plain Java are supported
+        compressor = zarray['compressor']
+        compression = None
+        if compressor is not None:
+            compression = compressor['id']
+        dtype = zarray['dtype']
+        if compression not in [None, 'zlib', 'gzip'] or dtype[1:] not in ['u1', 'i1', 'u2', 'i2', 'f4'] or zarray['order'] != 'C':
+            print('Zarr array not supported : ' + str(dtype) + ' ' + str(compression) + ' ' + zarray['order'])
+            return None
+
+        ndim = len(zarray['shape'])
+        sizeT, sizeC, sizeZ, sizeY, sizeX = [1] * (5 - ndim) + zarray['shape']
+        ct, cc, cz, cy, cx = [1] * (5 - ndim) + zarray['chunks']
+        separator = zarray.get('dimension_separator', '.')
+        bpp = int(dtype[2])
+        little = dtype[0] == '<'
+        isfloat = dtype[1] == 'f'
+
+        if region is None:
+            region = (0, 0, sizeX, sizeY)
+        rx, ry = max(region[0], 0), max(region[1], 0)
+        rw, rh = min(region[2], sizeX - rx), min(region[3], sizeY - ry)
+
+        tind = ReaderSession.getindices(trange, sizeT)
+        cind = ReaderSession.getindices(crange, sizeC)
+        zind = ReaderSession.getindices(zrange, sizeZ)
+
+        planes = {}
+        for t in tind:
+            for c in cind:
+                for z in zind:
+                    planes[(t, c, z)] = zeros(rw * rh, {1: 'b', 2: 'h', 4: 'f'}[bpp])
+
+        # read every chunk overlapping the requested sub-volume once
+        chunkindices = [sorted(set([i // csize for i in indices])) for indices, csize in [(tind, ct), (cind, cc), (zind, cz)]]
+        chunkindices.append(range(ry // cy, (ry + rh - 1) // cy + 1))
+        chunkindices.append(range(rx // cx, (rx + rw - 1) // cx + 1))
+
+        for tc, cc_, zc, yc, xc in itertools.product(*chunkindices):
+            key = separator.join([str(i) for i in [tc, cc_, zc, yc, xc][5 - ndim:]])
+            chunkpath = os.path.join(zarrpath, *key.split('/'))
+            if not os.path.exists(chunkpath):
+                # missing chunks contain only the fill value
+                continue
+
+            data = ImportTools.readchunk(chunkpath, compression)
+            chunk = DataTools.makeDataArray(data, bpp, isfloat, little)
+
+            y0, x0 = max(ry, yc * cy), max(rx, xc * cx)
+            y1, x1 = min(ry + rh, (yc + 1) * cy), min(rx + rw, (xc + 1) * cx)
+            for t in [t for t in tind if t // ct == tc]:
+                for c in [c for c in cind if c // cc == cc_]:
+                    for z in [z for z in zind if z // cz == zc]:
+                        plane = planes[(t, c, z)]
+                        offset = (((t % ct) * cc + c % cc) * cz + z % cz) * cy
+                        for y in range(y0, y1):
+                            System.arraycopy(chunk, (offset + y - yc * cy) * cx + x0 - xc * cx,
+                                             plane, (y - ry) * rw + x0 - rx,
+                                             x1 - x0)
+
+        processor = {1: ByteProcessor, 2: ShortProcessor, 4: FloatProcessor}[bpp]
+        stack = ImageStack(rw, rh)
+        for t in tind:
+            for z in zind:
+                for c in cind:
+                    stack.addSlice('c:' + str(c + 1) + ' z:' + str(z + 1) + ' t:' + str(t + 1),
+                                   processor(rw, rh, planes[(t, c, z)], None))
+
+        imp = ImagePlus(os.path.basename(os.path.normpath(zarrpath)), stack)
+        imp.setDimensions(len(cind), len(zind), len(tind))
+        imp.setOpenAsHyperStack(True)
+
+        if scale is not None and len(scale) >= 3:
+            cal = imp.getCalibration()
+            cal.pixelDepth, cal.pixelHeight, cal.pixelWidth = scale[-3:]
+            cal.setUnit('micron')
+
+        return imp
+
+    @staticmethod
+    def readchunk(chunkpath, compression=None):
+
+        data = zeros(os.path.getsize(chunkpath), 'b')
+        stream = RandomAccessFile(chunkpath, 'r')
+        try:
+            stream.readFully(data)
+        finally:
+            stream.close()
+
+        out = ByteArrayOutputStream(len(data) * 4)
+        buf = zeros(65536, 'b')
+
+        if compression == 'zlib':
+            inflater = Inflater()
+            inflater.setInput(data)
+            while not inflater.finished():
+                n = inflater.inflate(buf)
+                if n == 0 and inflater.needsInput():
+                    break
+                out.write(buf, 0, n)
+            inflater.end()
+            return out.toByteArray()
+
+        if compression == 'gzip':
+            gz = GZIPInputStream(ByteArrayInputStream(data))
+            n = gz.read(buf)
+            while n > 0:
+                out.write(buf, 0, n)
+                n = gz.read(buf)
+            gz.close()
+            return out.toByteArray()
+
+        return data
+
     @staticmethod
     def readbf(imagefile, metainfo,
                setflatres=False,
@@ -171,15 +1110,18 @@ class ImportTools:
                setconcat=False,
                openallseries=True,
                showomexml=False,
-               autoscale=True):
-
-        # initialize the importer options
-        options = ImporterOptions()
-        options.setOpenAllSeries(openallseries)
-        options.setShowOMEXML(showomexml)
-        options.setConcatenate(setconcat)
-        options.setAutoscale(autoscale)
-        options.setId(imagefile)
+               autoscale=True,
+               session=None,
+               crange=None,
+               zrange=None,
+               trange=None,
+               virtual=False,
+               cacheplanes=16):
+
+        # use the reader session from openfile or create a new one
+        ownsession = session is None
+        if ownsession:
+            session = ReaderSession(imagefile, setflatres=setflatres)
 
         # in case of concat=True all series set number of series = 1
         # and set pyramidlevel = 0 (1st level) since there will be only one
@@ -192,15 +1134,37 @@ class ImportTools:
 
         metainfo['Pyramid Level Output'] = readpylevel
 
-        # open the ImgPlus
-        imps = BF.openImagePlus(options)
-
         # read image data using the specified pyramid level
-        imp, slices, width, height, pylevel = ImageTools.getImageSeries(imps, series=readpylevel)
+        # only this level is decoded from the already initialized reader
+        imp, pylevel = session.openlevel(pylevel=readpylevel,
+                                         openallseries=openallseries,
+                                         setconcat=setconcat,
+                                         autoscale=autoscale,
+                                         crange=crange,
+                                         zrange=zrange,
+                                         trange=trange,
+                                         virtual=virtual,
+                                         cacheplanes=cacheplanes)
+
+        if ownsession and not virtual:
+            session.close()
 
-        metainfo['Output Slices'] = slices
-        metainfo['Output SizeX'] = width
-        metainfo['Output SizeY'] = height
+        # get the stack and some info
+        imgstack = imp.getImageStack()
+        metainfo['Output Slices'] = imgstack.getSize()
+        metainfo['Output SizeX'] = imgstack.getWidth()
+        metainfo['Output SizeY'] = imgstack.getHeight()
+        metainfo['Output SizeC'] = imp.getNChannels()
+        metainfo['Output SizeZ'] = imp.getNSlices()
+        metainfo['Output SizeT'] = imp.getNFrames()
+
+        # the Bio-Formats importer sets the calibration from the OME metadata
+        if metainfo['ScaleX'] is not None:
+            scale = float(metainfo['SizeX']) / float(metainfo['Output SizeX'])
+            imp = MiscTools.setscale(imp, scaleX=metainfo['ScaleX'] * scale,
+                                     scaleY=metainfo['ScaleY'] * scale,
+                                     scaleZ=metainfo['ScaleZ'],
+                                     unit="micron")
 
         return imp, metainfo
 
@@ -243,67 +1207,57 @@ class ImportTools:
                 openallseries=True,
                 showomexml=False,
                 attach=False,
-                autoscale=True):
+                autoscale=True,
+                session=None,
+                crange=None,
+                zrange=None,
+                trange=None,
+                virtual=False,
+                cacheplanes=16,
+                imageID=0):
+
+        # use the reader session from openfile or create a new one
+        # the metainfo of a session from openfile already contains the
+        # CZI specific metadata of the scene (see ReaderSession.getmetainfo)
+        ownsession = session is None
+        if ownsession:
+            session = ReaderSession(imagefile,
+                                    stitchtiles=stitchtiles,
+                                    setflatres=setflatres,
+                                    attach=attach)
+
+            # CZI specific metadata from the CZIReader for the scene
+            metainfo.update(session.getczimetainfo(series=imageID))
 
-        options = DynamicMetadataOptions()
-        options.setBoolean("zeissczi.autostitch", stitchtiles)
-        options.setBoolean("zeissczi.attachments", attach)
+        metainfo['Pyramid Level Output'] = readpylevel
 
-        czireader = ZeissCZIReader()
-        czireader.setFlattenedResolutions(setflatres)
-        czireader.setMetadataOptions(options)
-        czireader.setId(imagefile)
+        # read image data using the specified pyramid level
+        # only this level is decoded from the already initialized reader
+        imp, pylevel = session.openlevel(pylevel=readpylevel,
+                                         openallseries=openallseries,
+                                         setconcat=setconcat,
+                                         autoscale=autoscale,
+                                         crange=crange,
+                                         zrange=zrange,
+                                         trange=trange,
+                                         virtual=virtual,
+                                         cacheplanes=cacheplanes)
+        metainfo['Pyramid Level Output'] = pylevel
 
-        # Set the preferences in the ImageJ plugin
-        # Note although these preferences are applied, they are not refreshed in the UI
-        Prefs.set("bioformats.zeissczi.allow.autostitch", str(stitchtiles).lower())
-        Prefs.set("bioformats.zeissczi.include.attachments", str(attach).lower())
+        # get the stack and some info
+        imgstack = imp.getImageStack()
+        metainfo['Output Slices'] = imgstack.getSize()
+        metainfo['Output SizeX'] = imgstack.getWidth()
+        metainfo['Output SizeY'] = imgstack.getHeight()
+        metainfo['Output SizeC'] = imp.getNChannels()
+        metainfo['Output SizeZ'] = imp.getNSlices()
+        metainfo['Output SizeT'] = imp.getNFrames()
 
-        # metainfo = {}
-        metainfo['rescount'] = czireader.getResolutionCount()
-        metainfo['SeriesCount_CZI'] = czireader.getSeriesCount()
-        metainfo['flatres'] = czireader.hasFlattenedResolutions()
-        # metainfo['getreslevel'] = czireader.getResolution()
-
-        # Dimensions
-        metainfo['SizeT'] = czireader.getSizeT()
-        metainfo['SizeZ'] = czireader.getSizeZ()
-        metainfo['SizeC'] = czireader.getSizeC()
-        metainfo['SizeX'] = czireader.getSizeX()
-        metainfo['SizeY'] = czireader.getSizeY()
-
-        # check for autostitching and possibility to read attachment
-        metainfo['AllowAutoStitching'] = czireader.allowAutostitching()
-        metainfo['CanReadAttachments'] = czireader.canReadAttachments()
-
-        # read in and display ImagePlus(es) with arguments
-        options = ImporterOptions()
-        options.setOpenAllSeries(openallseries)
-        options.setShowOMEXML(showomexml)
-        options.setConcatenate(setconcat)
-        options.setAutoscale(autoscale)
-        options.setId(imagefile)
-
-        # open the ImgPlus
-        imps = BF.openImagePlus(options)
-
-        metainfo['Pyramid Level Output'] = readpylevel
-
-        # read image data using the specified pyramid level
-        imp, slices, width, height, pylevel = ImageTools.getImageSeries(imps, series=readpylevel)
-        metainfo['Pyramid Level Output'] = pylevel
-
-        metainfo['Output Slices'] = slices
-        metainfo['Output SizeX'] = width
-        metainfo['Output SizeY'] = height
-
-        # calc scaling in case of pyramid
-        # scale = float(metainfo['Output SizeX']) / float(metainfo['SizeX'])
-        scale = float(metainfo['SizeX']) / float(metainfo['Output SizeX'])
+        # calc scaling in case of pyramid
+        # scale = float(metainfo['Output SizeX']) / float(metainfo['SizeX'])
+        scale = float(metainfo['SizeX']) / float(metainfo['Output SizeX'])
 
         metainfo['Pyramid Scale Factor'] = scale
-        metainfo['ScaleX Output'] = metainfo['ScaleX'] * scale
-        metainfo['ScaleY Output'] = metainfo['ScaleY'] * scale
 
         """
         imp = MiscTools.setproperties(imp, scaleX=metainfo['ScaleX Output'],
@@ -315,25 +1269,379 @@ class ImportTools:
                                       sizeT=metainfo['SizeT'])
         """
 
-        imp = MiscTools.setscale(imp, scaleX=metainfo['ScaleX Output'],
-                                 scaleY=metainfo['ScaleX Output'],
-                                 scaleZ=metainfo['ScaleZ'],
-                                 unit="micron")
+        # the CZI may have no physical size
+        if metainfo['ScaleX'] is not None:
+            metainfo['ScaleX Output'] = metainfo['ScaleX'] * scale
+            metainfo['ScaleY Output'] = metainfo['ScaleY'] * scale
+            imp = MiscTools.setscale(imp, scaleX=metainfo['ScaleX Output'],
+                                     scaleY=metainfo['ScaleY Output'],
+                                     scaleZ=metainfo['ScaleZ'],
+                                     unit="micron")
 
         # close czireader
-        czireader.close()
+        if ownsession and not virtual:
+            session.close()
 
         return imp, metainfo
 
 
+class PrefetchReader:
+    """
+    Iterates over a list of image files and opens the next files with
+    ImportTools.openfile on a background thread while the current image
+    is processed. At most prefetch images are waiting in the queue and
+    their pixel data will not exceed maxbytes (at least one image is always
+    prefetched). The size of a file is only known after decoding, so the
+    reader waits before decoding until the size of the previous file fits,
+    for files of different sizes the image being decoded can come on top.
+    Iterating yields (imagefile, imp, metainfo).
+    Files that can not be opened are skipped and listed in self.failed.
+    """
+
+    def __init__(self, files, prefetch=2, maxbytes=2 * 1024 ** 3, **openoptions):
+
+        self.files = files
+        self.prefetch = max(prefetch, 1)
+        self.maxbytes = maxbytes
+        self.openoptions = openoptions
+
+        self.queue = Queue.Queue(maxsize=self.prefetch)
+        self.condition = threading.Condition()
+        self.queuedbytes = 0
+        self.stopped = False
+
+        # timing - waittime is the time the consumer waited for the reader
+        self.waittime = 0.0
+        self.readtime = 0.0
+        self.failed = []
+
+    def waitforbytes(self, nbytes):
+
+        # bounded memory - wait until the consumer took enough images
+        with self.condition:
+            while not self.stopped and self.queuedbytes > 0 and self.queuedbytes + nbytes > self.maxbytes:
+                self.condition.wait()
+
+    def put(self, item):
+
+        # never block forever on a full queue, stop() may have been called
+        while not self.stopped:
+            try:
+                self.queue.put(item, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def get(self):
+
+        # returns None (end marker) as well when stopped
+        while True:
+            try:
+                return self.queue.get(True, 0.1)
+            except Queue.Empty:
+                if self.stopped:
+                    return None
+
+    def run(self):
+
+        lastbytes = 0
+        try:
+            for imagefile in self.files:
+                if self.stopped:
+                    break
+
+                # check the memory before decoding using the previous file
+                self.waitforbytes(lastbytes)
+
+                start = time.time()
+                try:
+                    imp, metainfo = ImportTools.openfile(imagefile, **self.openoptions)
+                except (Exception, Throwable), e:
+                    print('Could not open ' + imagefile + ' : ' + str(e))
+                    self.failed.append(imagefile)
+                    continue
+                self.readtime += time.time() - start
+
+                # the file may be larger than the previous one
+                nbytes = ImageTools.getbytes(imp)
+                self.waitforbytes(nbytes)
+                with self.condition:
+                    self.queuedbytes += nbytes
+                lastbytes = nbytes
+
+                if not self.put((imagefile, imp, metainfo, nbytes)):
+                    break
+
+        finally:
+            # end marker - also when reading failed unexpectedly
+            self.put(None)
+
+    def __iter__(self):
+
+        thread = threading.Thread(target=self.run, name='PrefetchReader')
+        thread.setDaemon(True)
+        thread.start()
+
+        while True:
+            start = time.time()
+            item = self.get()
+            self.waittime += time.time() - start
+
+            if item is None:
+                break
+
+            imagefile, imp, metainfo, nbytes = item
+            with self.condition:
+                self.queuedbytes -= nbytes
+                self.condition.notifyAll()
+
+            yield imagefile, imp, metainfo
+
+    def stop(self):
+
+        # stop reading further files, e.g. when leaving the loop early
+        # the reader thread does not block on the queue after this
+        self.stopped = True
+        while not self.queue.empty():
+            self.queue.get()
+        with self.condition:
+            self.queuedbytes = 0
+            self.condition.notifyAll()
+
+    def stats(self):
+
+        stats = {}
+        stats['Files'] = len(self.files)
+        stats['Failed'] = len(self.failed)
+        stats['Read Time'] = round(self.readtime, 3)
+        stats['Wait Time'] = round(self.waittime, 3)
+
+        return stats
+
+
+class PlaneTools:
+
+    @staticmethod
+    def iterplanes(source, order='TZC',
+                   crange=None,
+                   zrange=None,
+                   trange=None,
+                   pylevel=0):
+        """
+        Generator yielding (t, z, c, ip) with 0-based t, z, c for all planes
+        of an ImagePlus or directly from a ReaderSession, so the hyperstack
+        does not have to be in memory. order = nesting of the loops from the
+        outermost to the innermost dimension, e.g. 'TZC' or 'CTZ'.
+        crange, zrange, trange = optional 1-based (begin, end, step).
+        """
+        if isinstance(source, ReaderSession):
+            source.setlevel(pylevel)
+            reader = source.reader
+            sizes = {'C': reader.getSizeC(), 'Z': reader.getSizeZ(), 'T': reader.getSizeT()}
+            crop = Region(0, 0, reader.getSizeX(), reader.getSizeY())
+
+        if not isinstance(source, ReaderSession):
+            stack = source.getStack()
+            sizes = {'C': source.getNChannels(), 'Z': source.getNSlices(), 'T': source.getNFrames()}
+
+        indices = {'C': ReaderSession.getindices(crange, sizes['C']),
+                   'Z': ReaderSession.getindices(zrange, sizes['Z']),
+                   'T': ReaderSession.getindices(trange, sizes['T'])}
+
+        order = order.upper()
+        for position in itertools.product(*[indices[dim] for dim in order]):
+            pos = dict(zip(order, position))
+            t, z, c = pos['T'], pos['Z'], pos['C']
+
+            if isinstance(source, ReaderSession):
+                index = source.reader.getIndex(z, c, t)
+                ip = source.readplane((pylevel, index, c, z, t), crop)
+            else:
+                ip = stack.getProcessor(source.getStackIndex(c + 1, z + 1, t + 1))
+
+            yield t, z, c, ip
+
+    @staticmethod
+    def stream(planes, funcs=None, sink=None, queuesize=4):
+        """
+        Streaming pipeline - reading, processing and writing run on separate
+        threads and overlap plane-by-plane. planes = iterable of (t, z, c, ip),
+        e.g. from iterplanes. Each function in funcs is called as
+        func(t, z, c, ip) and returns the processed ImageProcessor.
+        sink(t, z, c, ip) is called for every processed plane.
+        The queues hold at most queuesize planes. Returns the number of planes.
+        """
+        if funcs is None:
+            funcs = []
+
+        endmarker = None
+        readqueue = Queue.Queue(maxsize=queuesize)
+        processqueue = Queue.Queue(maxsize=queuesize)
+        errors = []
+
+        def read():
+            try:
+                for plane in planes:
+                    readqueue.put(plane)
+            except (Exception, Throwable), e:
+                errors.append(e)
+            readqueue.put(endmarker)
+
+        def process():
+            while True:
+                plane = readqueue.get()
+                if plane is endmarker:
+                    break
+                if errors:
+                    continue
+                try:
+                    t, z, c, ip = plane
+                    for func in funcs:
+                        ip = func(t, z, c, ip)
+                    processqueue.put((t, z, c, ip))
+                except (Exception, Throwable), e:
+                    errors.append(e)
+            processqueue.put(endmarker)
+
+        threads = [threading.Thread(target=read, name='PlaneReader'),
+                   threading.Thread(target=process, name='PlaneProcessor')]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        # write the planes on the calling thread
+        numplanes = 0
+        while True:
+            plane = processqueue.get()
+            if plane is endmarker:
+                break
+            if sink is not None and not errors:
+                sink(*plane)
+            numplanes += 1
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return numplanes
+
+
+class SceneTools:
+
+    @staticmethod
+    def getscenes(imagefile, stitchtiles=True):
+
+        # list of the series indices (scenes for CZI) of an image file
+        # the pyramid levels of a series are not counted
+        session = ReaderSession(imagefile, stitchtiles=stitchtiles)
+        try:
+            scenes = sorted(set([series for series, resolution in session.getlevels()]))
+        finally:
+            session.close()
+
+        return scenes
+
+    @staticmethod
+    def process_scenes(imagefile, func,
+                       scenes=None,
+                       nthreads=4,
+                       stitchtiles=True,
+                       autoscale=True,
+                       metacache=None,
+                       column='Scene'):
+        """
+        Opens and processes every series / scene of an image file on its own
+        worker thread with its own reader. func(imp, metainfo) is called for
+        every scene and must return a ResultsTable (or None) - it must not
+        use shared state like the RoiManager. The ResultsTables of all scenes
+        are merged into one with an additional column for the scene index.
+        """
+        if scenes is None:
+            scenes = SceneTools.getscenes(imagefile, stitchtiles=stitchtiles)
+
+        memodir = None
+        if metacache is not None:
+            memodir = metacache.memodir
+
+        def runscene(scene):
+            session = ReaderSession(imagefile,
+                                    stitchtiles=stitchtiles,
+                                    memodir=memodir)
+            try:
+                metainfo = session.getmetainfo(imageID=scene)
+                metainfo['Scene'] = scene
+
+                # read the full resolution of the scene
+                pylevel = session.getlevels().index((scene, 0))
+                imp = session.readlevels([pylevel], autoscale=autoscale)
+            finally:
+                session.close()
+
+            if metainfo['ScaleX'] is not None:
+                imp = MiscTools.setscale(imp, scaleX=metainfo['ScaleX'],
+                                         scaleY=metainfo['ScaleY'],
+                                         scaleZ=metainfo['ScaleZ'],
+                                         unit="micron")
+
+            return func(imp, metainfo)
+
+        tasks = [lambda scene=scene: runscene(scene) for scene in scenes]
+        tables = ParallelTools.run_tasks(tasks, nthreads=nthreads)
+
+        return AnalyzeTools.merge_results(tables, column=column, values=scenes)
+
+
 class ExportTools:
 
+    # common names for the Bio-Formats compression types
+    COMPRESSION = {'uncompressed': 'Uncompressed',
+                   'none': 'Uncompressed',
+                   'lzw': 'LZW',
+                   'zlib': 'zlib',
+                   'deflate': 'zlib',
+                   'zstd': 'zstd',
+                   'jpeg': 'JPEG',
+                   'jpeg-2000': 'J2K',
+                   'j2k': 'J2K'}
+
+    @staticmethod
+    def getcompressiontypes(savepath):
+
+        # compression types supported by the Bio-Formats writer for this file type
+        writer = ImageWriter().getWriter(savepath)
+
+        return list(writer.getCompressionTypes())
+
+    @staticmethod
+    def getcompression(savepath, compression='Uncompressed'):
+
+        # check if the bundled Bio-Formats supports the compression, e.g. zstd
+        compression = ExportTools.COMPRESSION.get(compression.lower(), compression)
+        supported = ExportTools.getcompressiontypes(savepath)
+
+        # the TIFF writers list J2K by its long name
+        if compression == 'J2K' and compression not in supported and 'JPEG-2000' in supported:
+            compression = 'JPEG-2000'
+
+        if compression not in supported:
+            print('Compression ' + compression + ' is not supported. Supported : ' + str(supported))
+            print('Using Uncompressed as fallback.')
+            compression = 'Uncompressed'
+
+        return compression
+
     @staticmethod
-    def bfexporter(imp, savepath, useLOCI=True):
+    def bfexporter(imp, savepath, useLOCI=True, compression='Uncompressed'):
+
+        compression = ExportTools.getcompression(savepath, compression=compression)
 
         if useLOCI:
 
-            paramstring = "outfile=[" + savepath + "] windowless=true compression=Uncompressed saveROI=false"
+            paramstring = "outfile=[" + savepath + "] windowless=true compression=" + compression + " saveROI=false"
             plugin = LociExporter()
             plugin.arg = paramstring
             exporter = Exporter(plugin, imp)
@@ -343,23 +1651,63 @@ class ExportTools:
         if not useLOCI:
 
             # 2019-04-25: This does not seem to work in headless anymore
-            paramstring = "save=[" + savepath + "] compression=Uncompressed"
+            paramstring = "save=[" + savepath + "] compression=" + compression
             IJ.run(imp, "Bio-Formats Exporter", paramstring)
 
         return paramstring
 
     @staticmethod
-    def savedata(imp, savepath, extension='ome.tiff', replace=False):
+    def savedata(imp, savepath, extension='ome.tiff', replace=False,
+                 compression='Uncompressed',
+                 pyramid=False,
+                 tilesize=512,
+                 interpolation=None,
+                 incremental=False,
+                 inputs=None,
+                 params=None):
 
         # general function for saving image data in different formats
+        # interpolation = downsampling of the pyramid levels (see save_pyramid)
+        # by default 'none' for 8-bit binary masks and label images, so no
+        # new values are created, and 'bilinear' for all other bit depths
+        if pyramid and interpolation is None:
+            interpolation = 'bilinear'
+            if imp.getBitDepth() == 8:
+                interpolation = 'none'
+
+        # incremental mode - skip outputs whose inputs and parameters did not
+        # change and write new outputs atomically (see ExportTools.isuptodate)
+        if incremental:
+            options = {'extension': extension,
+                       'compression': compression,
+                       'pyramid': pyramid,
+                       'tilesize': tilesize,
+                       'interpolation': interpolation}
+
+            if ExportTools.isuptodate(savepath, inputs, params, **options):
+                print('Output is up to date : ' + savepath)
+                return savepath
+
+            return ExportTools.writeatomic(savepath,
+                                           lambda tmppath: ExportTools.savedata(imp, tmppath,
+                                                                                replace=True,
+                                                                                **options),
+                                           inputs, params, **options)
 
         # check if file already exists and delete if replace is true
         if os.path.exists(savepath):
             if replace:
-                os.remove(savepath)
+                ExportTools.removepath(savepath)
             if not replace:
+                print('Output exists and replace is False : ' + savepath)
                 return None
 
+        # in case of a chunked Zarr directory store
+        if extension == 'zarr':
+            if compression in [None, 'Uncompressed']:
+                return ExportTools.save_zarr(imp, savepath, compression=None)
+            return ExportTools.save_zarr(imp, savepath, compression='zlib')
+
         # general safety check
         # if not extension:
         #    extension = 'ome.tiff'
@@ -377,145 +1725,1551 @@ class ExportTools:
                 if nslices == 1:
                     fs.saveAsTiff(savepath)
 
+            # in case of tiled, pyramidal OME-TIFF
+            elif (extension == 'ome.tiff' or extension == 'ome.tif') and pyramid:
+                ExportTools.save_pyramid(imp, savepath, tilesize=tilesize, compression=compression,
+                                         interpolation=interpolation)
+
             # in case of OME-TIFF
             elif extension == 'ome.tiff' or extension == 'ome.tif':
-                pstr = ExportTools.bfexporter(imp, savepath, useLOCI=True)
+                pstr = ExportTools.bfexporter(imp, savepath, useLOCI=True, compression=compression)
 
             # in case of PNG
             elif extension == ('png' or 'PNG'):
                 fs.saveAsPng(savepath)
 
-            # in case
-            elif extension == ('jpeg' or 'jpg' or 'JPEG' or 'JPG'):
-                fs.saveAsJpeg(savepath)
+            # in case
+            elif extension == ('jpeg' or 'jpg' or 'JPEG' or 'JPG'):
+                fs.saveAsJpeg(savepath)
+
+        else:
+            extension = 'ome.tiff'
+            print("save as OME-TIFF: ")  # savepath
+            pstr = ExportTools.bfexporter(imp, savepath, useLOCI=True, compression=compression)
+
+        return savepath
+
+    @staticmethod
+    def removepath(path):
+
+        # remove a file or a directory store like Zarr
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def getmanifestpath(savepath):
+
+        # sidecar file next to the output
+        return savepath + '.manifest.json'
+
+    @staticmethod
+    def getmanifest(inputs=None, params=None, **options):
+
+        # fingerprint of the input files plus hashes of the parameters
+        # and the save options
+        if isinstance(inputs, basestring):
+            inputs = [inputs]
+
+        fingerprints = []
+        for inputfile in inputs or []:
+            filestat = os.stat(inputfile)
+            fingerprints.append([os.path.abspath(inputfile),
+                                 filestat.st_size,
+                                 int(filestat.st_mtime * 1000)])
+
+        return {'inputs': fingerprints,
+                'params': hashlib.sha1(json.dumps(sorted((params or {}).items()))).hexdigest(),
+                'options': hashlib.sha1(json.dumps(sorted(options.items()))).hexdigest()}
+
+    @staticmethod
+    def isuptodate(savepath, inputs=None, params=None, **options):
+        """
+        True when savepath exists and its manifest was written for the same
+        input files (path, size, mtime) and parameters. The save options are
+        only compared when they are given, so a script can check its outputs
+        with its own parameters before running the analysis.
+        """
+        manifestpath = ExportTools.getmanifestpath(savepath)
+        if not os.path.exists(savepath) or not os.path.exists(manifestpath):
+            return False
+
+        try:
+            with open(manifestpath, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return False
+
+        current = ExportTools.getmanifest(inputs, params, **options)
+        if not options:
+            current.pop('options')
+            manifest.pop('options', None)
+
+        return manifest == current
+
+    @staticmethod
+    def writeatomic(savepath, writefunc, inputs=None, params=None, **options):
+
+        # write to a temporary folder in the same directory first and rename it,
+        # so partial outputs never count as done, the manifest comes last
+        # the file keeps its final name, because OME-TIFF writers store the
+        # file name in the OME-XML (TiffData / UUID FileName)
+        tmpdir = tempfile.mkdtemp(prefix='~tmp_', dir=os.path.dirname(os.path.abspath(savepath)))
+        tmppath = os.path.join(tmpdir, os.path.basename(savepath))
+        manifestpath = ExportTools.getmanifestpath(savepath)
+
+        try:
+            if writefunc(tmppath) is None:
+                return None
+
+            ExportTools.removepath(manifestpath)
+            ExportTools.removepath(savepath)
+            os.rename(tmppath, savepath)
+        finally:
+            ExportTools.removepath(tmpdir)
+
+        with open(manifestpath + '.tmp', 'w') as f:
+            json.dump(ExportTools.getmanifest(inputs, params, **options), f, indent=4)
+        os.rename(manifestpath + '.tmp', manifestpath)
+
+        return savepath
+
+    @staticmethod
+    def getplanebytes(ip, littleEndian=False):
+
+        # pixel data of an ImageProcessor as byte array for Bio-Formats
+        pixels = ip.getPixels()
+
+        if ip.getBitDepth() == 16:
+            return DataTools.shortsToBytes(pixels, littleEndian)
+        if ip.getBitDepth() == 32:
+            return DataTools.floatsToBytes(pixels, littleEndian)
+
+        return pixels
+
+    @staticmethod
+    def save_pyramid(imp, savepath,
+                     levels=None,
+                     tilesize=512,
+                     compression='Uncompressed',
+                     interpolation='bilinear'):
+        """
+        Writes a tiled OME-TIFF with sub-resolution levels (scaled by 2).
+        The levels are created plane-by-plane from the stack while writing,
+        so no downsampled copy of the whole stack is kept in memory.
+        levels = number of resolution levels, by default levels are added
+        until the image fits into a single tile.
+        interpolation = 'bilinear' (with averaging) for raw data and 'none'
+        for label images and binary masks.
+        """
+        pixeltypes = {8: 'uint8', 16: 'uint16', 32: 'float'}
+        if imp.getBitDepth() not in pixeltypes:
+            print('Pyramid export is not supported for RGB. Using the flat OME-TIFF.')
+            return ExportTools.bfexporter(imp, savepath, useLOCI=True, compression=compression)
+
+        stack = imp.getStack()
+        width = imp.getWidth()
+        height = imp.getHeight()
+
+        if levels is None:
+            levels = 1
+            while max(width, height) // (2 ** levels) >= tilesize:
+                levels += 1
+
+        # OME metadata for all levels - XYCZT is the ImageJ plane order
+        meta = MetadataTools.createOMEXMLMetadata()
+        MetadataTools.populateMetadata(meta, 0, imp.getTitle(), False, 'XYCZT',
+                                       pixeltypes[imp.getBitDepth()],
+                                       width, height,
+                                       imp.getNSlices(), imp.getNChannels(), imp.getNFrames(), 1)
+
+        cal = imp.getCalibration()
+        meta.setPixelsPhysicalSizeX(Length(cal.pixelWidth, UNITS.MICROMETER), 0)
+        meta.setPixelsPhysicalSizeY(Length(cal.pixelHeight, UNITS.MICROMETER), 0)
+        meta.setPixelsPhysicalSizeZ(Length(cal.pixelDepth, UNITS.MICROMETER), 0)
+
+        sizes = []
+        for level in range(levels):
+            levelwidth = max(width // (2 ** level), 1)
+            levelheight = max(height // (2 ** level), 1)
+            sizes.append((levelwidth, levelheight))
+            if level > 0:
+                meta.setResolutionSizeX(PositiveInteger(levelwidth), 0, level)
+                meta.setResolutionSizeY(PositiveInteger(levelheight), 0, level)
+
+        writer = PyramidOMETiffWriter()
+        writer.setMetadataRetrieve(meta)
+        writer.setBigTiff(ImageTools.getbytes(imp) > 2 ** 31)
+        writer.setInterleaved(False)
+        writer.setCompression(ExportTools.getcompression(savepath, compression=compression))
+        writer.setId(savepath)
+        tilesizeX = writer.setTileSizeX(tilesize)
+        tilesizeY = writer.setTileSizeY(tilesize)
+
+        try:
+            for level in range(levels):
+                writer.setResolution(level)
+                levelwidth, levelheight = sizes[level]
+
+                for index in range(stack.getSize()):
+                    ip = stack.getProcessor(index + 1)
+
+                    # downsample the current plane only
+                    if level > 0:
+                        if interpolation == 'none':
+                            ip.setInterpolationMethod(ImageProcessor.NONE)
+                            ip = ip.resize(levelwidth, levelheight, False)
+                        else:
+                            ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+                            ip = ip.resize(levelwidth, levelheight, True)
+
+                    # write the plane tile-by-tile
+                    for y in range(0, levelheight, tilesizeY):
+                        for x in range(0, levelwidth, tilesizeX):
+                            w = min(tilesizeX, levelwidth - x)
+                            h = min(tilesizeY, levelheight - y)
+                            ip.setRoi(x, y, w, h)
+                            tile = ip.crop()
+                            writer.saveBytes(index, ExportTools.getplanebytes(tile), x, y, w, h)
+                    ip.resetRoi()
+        finally:
+            writer.close()
+
+        return savepath
+
+    ZARR_DTYPES = {8: '|u1', 16: '>u2', 32: '>f4'}
+
+    @staticmethod
+    def save_zarr(imp, savepath, chunks=(16, 256, 256), compression='zlib',
+                  level=1, nthreads=1):
+        """
+        Writes the stack as Zarr v2 directory store in the OME-Zarr layout
+        (group with the array '0', dimension order TCZYX), which can be read
+        chunk-wise by napari, zarr-python or ImportTools.readzarr.
+        chunks = chunk shape (z, y, x), t and c are always chunked by 1.
+        compression = 'zlib', 'gzip' or None. The planes are streamed from the
+        ImageStack, only one block of chunks[0] planes is converted at a time.
+        """
+        if imp.getBitDepth() not in ExportTools.ZARR_DTYPES:
+            print('Zarr export supports 8, 16 and 32 bit images only.')
+            return None
+
+        width, height = imp.getWidth(), imp.getHeight()
+        sizeC, sizeZ, sizeT = imp.getNChannels(), imp.getNSlices(), imp.getNFrames()
+        bpp = imp.getBitDepth() // 8
+        cz, cy, cx = [max(1, min(chunk, size)) for chunk, size in zip(chunks, [sizeZ, height, width])]
+
+        if os.path.exists(savepath):
+            shutil.rmtree(savepath)
+        arraydir = os.path.join(savepath, '0')
+        os.makedirs(arraydir)
+
+        compressor = None
+        if compression in ['zlib', 'gzip']:
+            compressor = {'id': compression, 'level': level}
+
+        zarray = {'zarr_format': 2,
+                  'shape': [sizeT, sizeC, sizeZ, height, width],
+                  'chunks': [1, 1, cz, cy, cx],
+                  'dtype': ExportTools.ZARR_DTYPES[imp.getBitDepth()],
+                  'compressor': compressor,
+                  'fill_value': 0,
+                  'order': 'C',
+                  'filters': None,
+                  'dimension_separator': '.'}
+
+        # OME-NGFF metadata with the axes and the pixel sizes
+        cal = imp.getCalibration()
+        unit = {'micron': 'micrometer', 'um': 'micrometer', u'\xb5m': 'micrometer'}.get(cal.getUnit())
+        axes = [{'name': 't', 'type': 'time'}, {'name': 'c', 'type': 'channel'}]
+        for name in ['z', 'y', 'x']:
+            axes.append({'name': name, 'type': 'space'})
+            if unit is not None:
+                axes[-1]['unit'] = unit
+        scale = [1.0, 1.0, cal.pixelDepth, cal.pixelHeight, cal.pixelWidth]
+        zattrs = {'multiscales': [{'version': '0.4',
+                                   'name': imp.getTitle(),
+                                   'axes': axes,
+                                   'datasets': [{'path': '0',
+                                                 'coordinateTransformations': [{'type': 'scale', 'scale': scale}]}]}]}
+
+        for filename, content in [('.zgroup', {'zarr_format': 2}),
+                                  ('.zattrs', zattrs),
+                                  (os.path.join('0', '.zarray'), zarray)]:
+            with open(os.path.join(savepath, filename), 'w') as jsonfile:
+                json.dump(content, jsonfile, indent=2)
+
+        def writerow(t, c, z0, planes, y0):
+            # write all chunks of one row of chunks
+            for x0 in range(0, width, cx):
+                chunk = zeros(cz * cy * cx * bpp, 'b')
+                rowbytes = (min(x0 + cx, width) - x0) * bpp
+                for zi, plane in enumerate(planes):
+                    for y in range(y0, min(y0 + cy, height)):
+                        System.arraycopy(plane, (y * width + x0) * bpp,
+                                         chunk, ((zi * cy + y - y0) * cx) * bpp,
+                                         rowbytes)
+                key = '.'.join([str(t), str(c), str(z0 // cz), str(y0 // cy), str(x0 // cx)])
+                ExportTools.writechunk(os.path.join(arraydir, key), chunk, compression, level)
+
+        stack = imp.getStack()
+        for t in range(sizeT):
+            for c in range(sizeC):
+                for z0 in range(0, sizeZ, cz):
+                    planes = [ExportTools.getplanebytes(stack.getProcessor(imp.getStackIndex(c + 1, z + 1, t + 1)))
+                              for z in range(z0, min(z0 + cz, sizeZ))]
+                    tasks = [lambda t=t, c=c, z0=z0, y0=y0: writerow(t, c, z0, planes, y0)
+                             for y0 in range(0, height, cy)]
+                    ParallelTools.run_tasks(tasks, nthreads=nthreads)
+
+        return savepath
+
+    @staticmethod
+    def writechunk(chunkpath, data, compression=None, level=1):
+
+        if compression == 'zlib':
+            deflater = Deflater(level)
+            deflater.setInput(data)
+            deflater.finish()
+            out = ByteArrayOutputStream(len(data) // 4 + 64)
+            buf = zeros(65536, 'b')
+            while not deflater.finished():
+                out.write(buf, 0, deflater.deflate(buf))
+            deflater.end()
+            data = out.toByteArray()
+
+        elif compression == 'gzip':
+            out = ByteArrayOutputStream(len(data) // 4 + 64)
+            gz = GZIPOutputStream(out)
+            gz.write(data)
+            gz.close()
+            data = out.toByteArray()
+
+        stream = FileOutputStream(chunkpath)
+        try:
+            stream.write(data)
+        finally:
+            stream.close()
+
+    @staticmethod
+    def save_singleplanes(imp, savepath, metainfo, mode='TZC', format='tiff',
+                          template=None, nthreads=4):
+        """
+        Saves every plane as a single image. TIFF planes are written directly
+        from the processors of the stack using several threads, other formats
+        use IJ.saveAs. template = filename with the fields title, t, z, c
+        (0-based) and ext, e.g. '{title}_z{z:04d}.{ext}'.
+        The planes are written in batches of 2 * nthreads, so only a few
+        planes of a virtual stack are held in memory at once.
+        Returns a dict with the number of planes and planes per second.
+        """
+        titleext = imp.getTitle()
+        title = os.path.splitext(titleext)[0]
+
+        if mode == 'TZC':
+            planes = PlaneTools.iterplanes(imp, order='TZC')
+            if template is None:
+                template = '{title}_t{t:02d}_z{z:04d}_c{c:04d}.{ext}'
+
+        if mode == 'Z':
+            # use only the first channel and timepoint
+            planes = PlaneTools.iterplanes(imp, order='TZC', crange=(1, 1, 1), trange=(1, 1, 1))
+            if template is None:
+                template = '{title}_z{z:07d}.{ext}'
+
+        if mode not in ['TZC', 'Z']:
+            raise ValueError('Unknown mode for single planes : ' + str(mode))
+
+        cal = imp.getCalibration()
+        batchsize = 2 * max(nthreads, 1)
+        tasks = []
+        count = 0
+
+        start = time.time()
+        for t, z, c, ip in planes:
+            outputpath = os.path.join(savepath, template.format(title=title, t=t, z=z, c=c, ext=format))
+            tasks.append(lambda ip=ip, outputpath=outputpath: ExportTools.saveplane(ip, outputpath, cal, format=format))
+
+            if len(tasks) == batchsize:
+                ParallelTools.run_tasks(tasks, nthreads=nthreads)
+                count += len(tasks)
+                tasks = []
+
+        ParallelTools.run_tasks(tasks, nthreads=nthreads)
+        count += len(tasks)
+        duration = time.time() - start
+
+        stats = {'Planes': count,
+                 'Time [s]': duration,
+                 'Planes/s': count / max(duration, 1e-6)}
+        print('Saved ' + str(count) + ' planes : ' + str(round(stats['Planes/s'], 1)) + ' planes/s')
+
+        return stats
+
+    @staticmethod
+    def saveplane(ip, outputpath, cal=None, format='tiff'):
+
+        if format.lower() not in ['tif', 'tiff']:
+            IJ.saveAs(ImagePlus(os.path.basename(outputpath), ip), format, outputpath)
+            return outputpath
+
+        # write the TIFF directly from the pixel array
+        fi = FileInfo()
+        fi.width = ip.getWidth()
+        fi.height = ip.getHeight()
+        fi.nImages = 1
+        fi.pixels = ip.getPixels()
+        fi.fileType = {8: FileInfo.GRAY8,
+                       16: FileInfo.GRAY16_UNSIGNED,
+                       24: FileInfo.RGB,
+                       32: FileInfo.GRAY32_FLOAT}[ip.getBitDepth()]
+
+        if cal is not None and cal.scaled():
+            fi.pixelWidth = cal.pixelWidth
+            fi.pixelHeight = cal.pixelHeight
+            fi.unit = cal.getUnit()
+
+        out = BufferedOutputStream(FileOutputStream(outputpath))
+        try:
+            TiffEncoder(fi).write(out)
+        finally:
+            out.close()
+
+        return outputpath
+
+
+class WriteBehindQueue:
+    """
+    Writes ImagePlus and ResultsTable objects on a background thread, so the
+    pipeline can continue with the next image while the data is exported.
+    The queue holds at most maxitems objects and maxbytes of pixel data,
+    submit blocks until there is space (backpressure). Objects must not be
+    modified after they were submitted.
+    flush() waits until everything is written, isdone(savepath) checks if
+    a file was written completely and synced to disk.
+    """
+
+    def __init__(self, maxitems=2, maxbytes=2 * 1024 ** 3):
+
+        self.queue = Queue.Queue(maxsize=max(maxitems, 1))
+        self.maxbytes = maxbytes
+        self.condition = threading.Condition()
+        self.queuedbytes = 0
+
+        # savepath -> True when written and synced, error message otherwise
+        self.status = {}
+
+        self.thread = threading.Thread(target=self.run, name='WriteBehindQueue')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def submit(self, data, savepath, **options):
+
+        # options are passed to ExportTools.savedata for ImagePlus objects
+        # and to AnalyzeTools.save_results for ResultsTables
+        nbytes = 0
+        if isinstance(data, ImagePlus):
+            nbytes = ImageTools.getbytes(data)
+
+        with self.condition:
+            while self.queuedbytes > 0 and self.queuedbytes + nbytes > self.maxbytes:
+                self.condition.wait()
+            self.queuedbytes += nbytes
+            self.status[savepath] = None
+
+        self.queue.put((data, savepath, options, nbytes))
+
+        return savepath
+
+    def run(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            data, savepath, options = item[:3]
+            try:
+                if isinstance(data, ResultsTable):
+                    AnalyzeTools.save_results(data, savepath, **options)
+                elif ExportTools.savedata(data, savepath, **options) is None:
+                    raise IOError('file exists and replace is False')
+
+                WriteBehindQueue.sync(savepath)
+                self.status[savepath] = True
+            except (Exception, Throwable), e:
+                print('Could not write ' + savepath + ' : ' + str(e))
+                self.status[savepath] = str(e)
+            finally:
+                with self.condition:
+                    self.queuedbytes -= item[3]
+                    self.condition.notifyAll()
+                self.queue.task_done()
+
+    @staticmethod
+    def sync(savepath):
+
+        # force the file content to the disk
+        if os.path.isfile(savepath):
+            raf = RandomAccessFile(savepath, 'rw')
+            try:
+                raf.getFD().sync()
+            finally:
+                raf.close()
+
+    def flush(self):
+
+        # wait until all submitted objects are written
+        self.queue.join()
+
+        return dict(self.status)
+
+    def isdone(self, savepath):
+
+        # written without error, synced and not empty
+        return self.status.get(savepath) is True and os.path.exists(savepath) and os.path.getsize(savepath) > 0
+
+    def close(self):
+
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+        return dict(self.status)
+
+
+class FilterTools:
+
+    # filter types of the 2D rank filters
+    RANKFILTERS = {'MEAN': RankFilters.MEAN,
+                   'MIN': RankFilters.MIN,
+                   'MAX': RankFilters.MAX,
+                   'MEDIAN': RankFilters.MEDIAN,
+                   'VARIANCE': RankFilters.VARIANCE,
+                   'OPEN': RankFilters.OPEN,
+                   'DESPECKLE': RankFilters.DESPECKLE}
+
+    @staticmethod
+    def apply_rollingball(imp,
+                          radius=30,
+                          createBackground=False,
+                          lightBackground=False,
+                          useParaboloid=False,
+                          doPresmooth=True,
+                          correctCorners=False,
+                          tilesize=None,
+                          nthreads=1,
+                          binning=1):
+
+        # binning > 1 estimates the background on a binned copy of the plane,
+        # see rollingball_binned and getrollingballerror for the error
+        if binning > 1 and tilesize is not None:
+            print('Tiling is not needed for the binned rolling ball. Using the full plane.')
+            tilesize = None
+
+        # the sliding paraboloid works along complete lines and can not be tiled
+        if tilesize is not None and useParaboloid:
+            print('Tiling is not possible for the sliding paraboloid. Using the full plane.')
+            tilesize = None
+
+        def rollingball(ip, bs):
+            if binning > 1:
+                FilterTools.rollingball_binned(ip, bs, radius, binning,
+                                               createBackground=createBackground,
+                                               lightBackground=lightBackground,
+                                               useParaboloid=useParaboloid,
+                                               doPresmooth=doPresmooth,
+                                               correctCorners=correctCorners)
+                return
+
+            # Run public method rollingBallBackground
+            bs.rollingBallBackground(ip,
+                                     radius,
+                                     createBackground,
+                                     lightBackground,
+                                     useParaboloid,
+                                     doPresmooth,
+                                     correctCorners)
+
+        # BackgroundSubtracter has a state - one instance per thread
+        if tilesize is None:
+            ParallelTools.process_slices(imp, rollingball,
+                                         factory=BackgroundSubtracter,
+                                         nthreads=nthreads)
+
+        # process the slices one by one and the tiles in parallel
+        if tilesize is not None:
+            halo, align = TileTools.getrollingballhalo(radius)
+            # the tiles run in parallel - one BackgroundSubtracter per tile thread
+            getinstance = ParallelTools.getinstance(BackgroundSubtracter)
+            ParallelTools.process_slices(imp,
+                                         lambda ip, bs: TileTools.process_tiled(ip,
+                                                                                lambda tile: rollingball(tile, getinstance()),
+                                                                                tilesize=tilesize,
+                                                                                halo=halo,
+                                                                                align=align,
+                                                                                nthreads=nthreads))
+
+        return imp
+
+    @staticmethod
+    def rollingball_binned(ip, bs, radius, binning,
+                           createBackground=False,
+                           lightBackground=False,
+                           useParaboloid=False,
+                           doPresmooth=True,
+                           correctCorners=False):
+
+        # the background is calculated on a copy binned by averaging with
+        # radius / binning, upsampled with bilinear interpolation and then
+        # subtracted like in BackgroundSubtracter, ip is modified in place
+        small = Binner().shrink(ip, binning, binning, Binner.AVERAGE).convertToFloat()
+        bs.rollingBallBackground(small,
+                                 max(radius / float(binning), 1.0),
+                                 True,
+                                 lightBackground,
+                                 useParaboloid,
+                                 doPresmooth,
+                                 correctCorners)
+
+        small.setInterpolationMethod(ImageProcessor.BILINEAR)
+        background = small.resize(ip.getWidth(), ip.getHeight())
+
+        if createBackground:
+            ip.setPixels(0, background)
+            return ip
+
+        # 8 and 16 bit data are shifted to the max. value for a light
+        # background, setPixels rounds and clips the values
+        fp = ip.convertToFloat().duplicate()
+        fp.copyBits(background, 0, 0, Blitter.SUBTRACT)
+        if lightBackground and not isinstance(ip, FloatProcessor):
+            fp.add(ip.maxValue())
+        ip.setPixels(0, fp)
+
+        return ip
+
+    @staticmethod
+    def getrollingballerror(imp, radius=30, binning=2, nslices=3,
+                            lightBackground=False,
+                            useParaboloid=False,
+                            doPresmooth=True,
+                            correctCorners=False):
+
+        # compares the binned and the exact rolling ball for nslices planes
+        # spread over the stack and returns the max. and mean absolute error,
+        # the max. error is also given in % of the value range of the planes
+        stack = imp.getStack()
+        indices = sorted(set([1 + i * (stack.getSize() - 1) // max(nslices - 1, 1)
+                              for i in range(min(nslices, stack.getSize()))]))
+
+        maxerror, meanerror, valuerange = 0.0, 0.0, 0.0
+        for index in indices:
+            exact = stack.getProcessor(index).duplicate()
+            fast = exact.duplicate()
+            valuerange = max(valuerange, exact.getStatistics().max - exact.getStatistics().min)
+
+            BackgroundSubtracter().rollingBallBackground(exact, radius, False, lightBackground,
+                                                         useParaboloid, doPresmooth, correctCorners)
+            FilterTools.rollingball_binned(fast, BackgroundSubtracter(), radius, binning,
+                                           lightBackground=lightBackground,
+                                           useParaboloid=useParaboloid,
+                                           doPresmooth=doPresmooth,
+                                           correctCorners=correctCorners)
+
+            diff = exact.convertToFloat().duplicate()
+            diff.copyBits(fast.convertToFloat(), 0, 0, Blitter.DIFFERENCE)
+            stats = diff.getStatistics()
+            maxerror = max(maxerror, stats.max)
+            meanerror += stats.mean / len(indices)
+
+        error = {'Max. Error': maxerror,
+                 'Mean Error': meanerror,
+                 'Max. Error [%]': 100.0 * maxerror / max(valuerange, 1e-6),
+                 'Slices': len(indices)}
+
+        return error
+
+    @staticmethod
+    def getrankfunction(radius=5, filtertype='MEDIAN', engine='rankfilters', percentile=50.0):
+
+        # returns (function(ip, instance), factory) of a 2D rank filter
+        # or None for an unknown filter type
+        # engine = 'rankfilters' or 'histogram' for MEDIAN, MIN and MAX
+        # see RankTools, PERCENTILE always uses the histogram engine
+        percentiles = {'MIN': 0.0, 'MEDIAN': 50.0, 'MAX': 100.0, 'PERCENTILE': percentile}
+        if filtertype == 'PERCENTILE' or (filtertype in percentiles and engine == 'histogram'):
+            percentile = percentiles[filtertype]
+            return lambda ip, instance: RankTools.rank2d(ip, radius, percentile=percentile), None
+
+        # RankFilters has a state - one instance per thread
+        if filtertype in FilterTools.RANKFILTERS:
+            filterindex = FilterTools.RANKFILTERS[filtertype]
+            return lambda ip, filter: filter.rank(ip, radius, filterindex), RankFilters
+
+        return None
+
+    @staticmethod
+    def apply_filter(imp, radius=5, filtertype='MEDIAN', tilesize=None, nthreads=1,
+                     engine='rankfilters', percentile=50.0):
+
+        # engine = 'rankfilters' or 'histogram' for MEDIAN, MIN and MAX
+        # see RankTools, PERCENTILE always uses the histogram engine
+        rankfunction = FilterTools.getrankfunction(radius, filtertype, engine=engine, percentile=percentile)
+        if rankfunction is None:
+            print("Argument 'filtertype': {filtertype} not found")
+            return imp
+
+        rank, factory = rankfunction
+
+        # apply filter based on filtertype
+        if tilesize is None:
+            ParallelTools.process_slices(imp, rank, factory=factory, nthreads=nthreads)
+
+        # apply filter tile-by-tile - one instance per tile thread
+        if tilesize is not None:
+            halo = TileTools.getrankhalo(radius, filtertype=filtertype)
+            getinstance = ParallelTools.getinstance(factory)
+            ParallelTools.process_slices(imp,
+                                         lambda ip, instance: TileTools.process_tiled(ip,
+                                                                                      lambda tile: rank(tile, getinstance()),
+                                                                                      tilesize=tilesize,
+                                                                                      halo=halo,
+                                                                                      nthreads=nthreads))
+
+        return imp
+
+    @staticmethod
+    def apply_filter3d(imp,
+                       radiusx=5,
+                       radiusy=5,
+                       radiusz=5,
+                       filtertype='MEDIAN',
+                       engine='filters3d',
+                       percentile=50.0,
+                       nthreads=1,
+                       slabsize=None):
+
+        # engine = 'filters3d' or 'histogram' for MEDIAN, MIN and MAX
+        # see RankTools, PERCENTILE always uses the histogram engine
+        # slabsize = number of slices filtered at once, see filter3d_slabs
+        percentiles = {'MIN': 0.0, 'MEDIAN': 50.0, 'MAX': 100.0, 'PERCENTILE': percentile}
+        if filtertype == 'PERCENTILE' or (filtertype in percentiles and engine == 'histogram'):
+            percentile = percentiles[filtertype]
+
+            def filterstack(stack, nthreads=nthreads):
+                return RankTools.rank3d(stack, radiusx, radiusy, radiusz,
+                                        percentile=percentile,
+                                        nthreads=nthreads)
+
+            if slabsize is not None:
+                return FilterTools.filter3d_slabs(imp, lambda stack: filterstack(stack, nthreads=1),
+                                                  halo=int(math.ceil(radiusz)),
+                                                  slabsize=slabsize,
+                                                  nthreads=nthreads)
+
+            return ImagePlus('Filtered 3D', filterstack(imp.getStack()))
+
+        # initialize filter
+        f3d = Filters3D()
+
+        # create filter dictionary for 3d filters
+        filterdict = {}
+        filterdict['MEAN'] = f3d.MEAN
+        filterdict['MIN'] = f3d.MIN
+        filterdict['MAX'] = f3d.MAX
+        # filterdict['MAXLOCAL'] = f3d.MAXLOCAL # did not work
+        filterdict['MEDIAN'] = f3d.MEDIAN
+        filterdict['VAR'] = f3d.VAR
+
+        # the radii are used as sigmas in pixels for the gaussian
+        if filtertype == 'GAUSS':
+            return FilterTools.apply_gaussian3d(imp, sigma=(radiusx, radiusy, radiusz), nthreads=nthreads)
+
+        if slabsize is not None:
+            return FilterTools.filter3d_slabs(imp,
+                                              lambda stack: f3d.filter(stack, filterdict[filtertype],
+                                                                       radiusx, radiusy, radiusz),
+                                              halo=int(math.ceil(radiusz)),
+                                              slabsize=slabsize,
+                                              nthreads=nthreads)
+
+        stack = imp.getStack()  # get the stack within the ImagePlus
+        newstack = f3d.filter(stack,
+                              filterdict[filtertype],
+                              radiusx,
+                              radiusy,
+                              radiusz)
+
+        imp = ImagePlus('Filtered 3D', newstack)
+
+        return imp
+
+    @staticmethod
+    def getgaussiansigmas(sigma, metainfo=None):
+
+        # sigma in calibrated units is converted to sigmas in pixels for every
+        # axis using ScaleX, ScaleY and ScaleZ, without scaling sigma is used
+        # as sigma in pixels, a tuple (sigmax, sigmay, sigmaz) is not changed
+        if isinstance(sigma, (tuple, list)):
+            return tuple([float(value) for value in sigma])
+
+        sigmas = [float(sigma), float(sigma), float(sigma)]
+        if metainfo is not None:
+            for axis, key in enumerate(['ScaleX', 'ScaleY', 'ScaleZ']):
+                if metainfo.get(key):
+                    sigmas[axis] = sigma / float(metainfo[key])
+
+        return tuple(sigmas)
+
+    @staticmethod
+    def apply_gaussian3d(imp, sigma=1.0, metainfo=None, output='same', nthreads=1, accuracy=0.002):
+
+        # separable 3D gaussian, sigma see getgaussiansigmas
+        # output = 'same' for the bit depth of the input or 'float'
+        sigmax, sigmay, sigmaz = FilterTools.getgaussiansigmas(sigma, metainfo)
+        stack = imp.getStack()
+        width, height, depth = stack.getWidth(), stack.getHeight(), stack.getSize()
+
+        # all passes use float data to avoid rounding between the axes
+        fstack = ImageStack(width, height)
+        for z in range(1, depth + 1):
+            fstack.addSlice(stack.getSliceLabel(z), stack.getProcessor(z).convertToFloat().duplicate())
+
+        # XY - planes in parallel, GaussianBlur has a state - one per thread
+        ParallelTools.process_slices(fstack,
+                                     lambda ip, gb: gb.blurGaussian(ip, sigmax, sigmay, accuracy),
+                                     factory=GaussianBlur,
+                                     nthreads=nthreads)
+
+        # Z - a block of rows from every plane forms one line of a float image,
+        # so the columns of that image are the lines along Z
+        if depth > 1 and sigmaz > 0:
+            planes = [fstack.getPixels(z) for z in range(1, depth + 1)]
+            rows = max(1, min(height, (1 << 20) // max(width * depth, 1)))
+
+            def blurz(y0):
+                n = min(rows, height - y0)
+                block = zeros(n * width * depth, 'f')
+                for z, plane in enumerate(planes):
+                    System.arraycopy(plane, y0 * width, block, z * n * width, n * width)
+                GaussianBlur().blur1Direction(FloatProcessor(n * width, depth, block),
+                                              sigmaz, accuracy, False, 0)
+                for z, plane in enumerate(planes):
+                    System.arraycopy(block, z * n * width, plane, y0 * width, n * width)
+
+            ParallelTools.run_tasks([lambda y0=y0: blurz(y0) for y0 in range(0, height, rows)],
+                                    nthreads=nthreads)
+
+        if output == 'same' and imp.getBitDepth() != 32:
+            # round and clip to the input bit depth
+            newstack = ImageStack(width, height)
+            for z in range(1, depth + 1):
+                ip = stack.getProcessor(z).createProcessor(width, height)
+                ip.setPixels(0, fstack.getProcessor(z))
+                newstack.addSlice(stack.getSliceLabel(z), ip)
+            fstack = newstack
+
+        imp = ImagePlus('Filtered 3D', fstack)
+
+        return imp
+
+    @staticmethod
+    def filter3d_slabs(imp, func, halo=5, slabsize=16, nthreads=1):
+
+        # filters the stack in slabs of slabsize slices, every slab gets halo
+        # slices above and below, so the result matches the whole stack filter
+        # func(substack) returns the filtered substack incl. the halos
+        # the slabs run in waves of nthreads slabs and the filtered slices
+        # replace the slices of the input stack, so only the slabs of one
+        # wave are additional memory. Filters which change the bit depth (VAR)
+        # need a new output stack.
+        stack = imp.getStack()
+        depth = stack.getSize()
+        slabsize = max(1, slabsize)
+        slabs = [(z0, min(z0 + slabsize, depth)) for z0 in range(0, depth, slabsize)]
+        nthreads = max(1, nthreads)
+
+        outstack = None
+        # original planes of the previous wave which are halos of the next wave
+        originals = {}
+
+        def getslab(z0, z1):
+            substack = ImageStack(stack.getWidth(), stack.getHeight())
+            for z in range(max(0, z0 - halo), min(depth, z1 + halo)):
+                pixels = originals.get(z)
+                if pixels is None:
+                    pixels = stack.getPixels(z + 1)
+                substack.addSlice(stack.getSliceLabel(z + 1), pixels)
+
+            return substack
+
+        for w in range(0, len(slabs), nthreads):
+            wave = slabs[w:w + nthreads]
+            # the input planes are collected before any slice is replaced
+            substacks = [getslab(z0, z1) for z0, z1 in wave]
+            filtered = ParallelTools.run_tasks([lambda substack=substack: func(substack)
+                                                for substack in substacks], nthreads=nthreads)
+
+            if outstack is None:
+                outstack = stack
+                if filtered[0].getBitDepth() != imp.getBitDepth():
+                    outstack = ImageStack(stack.getWidth(), stack.getHeight())
+
+            last = wave[-1][1]
+            originals = dict([(z, originals.get(z, stack.getPixels(z + 1)))
+                              for z in range(max(0, last - halo), last)])
+
+            for (z0, z1), result in zip(wave, filtered):
+                offset = z0 - max(0, z0 - halo)
+                for z in range(z0, z1):
+                    if outstack is stack:
+                        stack.setPixels(result.getPixels(z - z0 + offset + 1), z + 1)
+                    else:
+                        outstack.addSlice(stack.getSliceLabel(z + 1), result.getPixels(z - z0 + offset + 1))
+
+        imp = ImagePlus('Filtered 3D', outstack)
+
+        return imp
+
+
+class RankTools:
+    """
+    Sliding histogram (Huang) rank filters for 8 and 16 bit data. When moving
+    the kernel by one pixel only the pixels at the left and right edge of
+    every kernel line are removed or added, so the cost grows with the radius
+    and not with the area (2D) or volume (3D) of the kernel. The rank is found
+    from the previous one with a two-level histogram (256 coarse bins).
+    2D uses the circular kernel and the edge padding of RankFilters, 3D the
+    ellipsoid kernel of Filters3D with the voxels inside the stack only.
+    The result is the value with the index int(percentile / 100 * n) of the
+    sorted kernel values, 50 = MEDIAN, 0 = MIN and 100 = MAX.
+    The inner loops are compiled once with the Groovy bundled with Fiji.
+    """
+
+    SOURCE = """
+import groovy.transform.CompileStatic
+
+@CompileStatic
+class SlidingHistogram {
+
+    private int[] hist = new int[65536]
+    private int[] coarse = new int[256]
+    private int m = 0
+    private int lt = 0
+    private int n = 0
+
+    private void add(int v) {
+        hist[v]++
+        coarse[v >> 8]++
+        n++
+        if (v < m) lt++
+    }
+
+    private void remove(int v) {
+        hist[v]--
+        coarse[v >> 8]--
+        n--
+        if (v < m) lt--
+    }
+
+    // value with the index k of the sorted values, lt = number of values < m
+    private int select(int k) {
+        while (lt > k) {
+            if ((m & 255) == 0 && lt - coarse[(m >> 8) - 1] > k) {
+                lt -= coarse[(m >> 8) - 1]
+                m -= 256
+            } else {
+                m--
+                lt -= hist[m]
+            }
+        }
+        while (lt + hist[m] <= k) {
+            if ((m & 255) == 0 && lt + coarse[m >> 8] <= k) {
+                lt += coarse[m >> 8]
+                m += 256
+            } else {
+                lt += hist[m]
+                m++
+            }
+        }
+        return m
+    }
+
+    private int rank(double q) {
+        int k = (int) (q * n)
+        return select(k < n ? k : n - 1)
+    }
+
+    private static int clamp(int i, int size) {
+        return i < 0 ? 0 : (i >= size ? size - 1 : i)
+    }
+
+    static int[] toInt(Object pixels) {
+        if (pixels instanceof byte[]) {
+            byte[] p = (byte[]) pixels
+            int[] v = new int[p.length]
+            for (int i = 0; i < p.length; i++) v[i] = p[i] & 0xff
+            return v
+        }
+        short[] p = (short[]) pixels
+        int[] v = new int[p.length]
+        for (int i = 0; i < p.length; i++) v[i] = p[i] & 0xffff
+        return v
+    }
+
+    static void fromInt(int[] v, Object pixels) {
+        if (pixels instanceof byte[]) {
+            byte[] p = (byte[]) pixels
+            for (int i = 0; i < p.length; i++) p[i] = (byte) v[i]
+            return
+        }
+        short[] p = (short[]) pixels
+        for (int i = 0; i < p.length; i++) p[i] = (short) v[i]
+    }
+
+    // hw = half widths of the kernel lines dy = -kr .. kr, pixels outside
+    // the image are replaced by the nearest edge pixel like in RankFilters
+    static void rank2d(Object pixels, int width, int height, int[] hw, double q) {
+        int kr = (hw.length - 1) >> 1
+        int[] v = toInt(pixels)
+        int[] out = new int[v.length]
+        SlidingHistogram h = new SlidingHistogram()
+
+        for (int y = 0; y < height; y++) {
+            for (int dy = -kr; dy <= kr; dy++) {
+                int row = clamp(y + dy, height) * width
+                for (int dx = -hw[dy + kr]; dx <= hw[dy + kr]; dx++) h.add(v[row + clamp(dx, width)])
+            }
+            for (int x = 0; x < width; x++) {
+                if (x > 0) {
+                    for (int dy = -kr; dy <= kr; dy++) {
+                        int row = clamp(y + dy, height) * width
+                        int w = hw[dy + kr]
+                        h.remove(v[row + clamp(x - w - 1, width)])
+                        h.add(v[row + clamp(x + w, width)])
+                    }
+                }
+                out[y * width + x] = h.rank(q)
+            }
+            // empty the histogram for the next line
+            for (int dy = -kr; dy <= kr; dy++) {
+                int row = clamp(y + dy, height) * width
+                for (int dx = -hw[dy + kr]; dx <= hw[dy + kr]; dx++) h.remove(v[row + clamp(width - 1 + dx, width)])
+            }
+        }
+        fromInt(out, pixels)
+    }
+
+    // hw = half widths of the kernel lines (dz, dy), -1 = empty line,
+    // only the voxels inside the stack are used like in Filters3D
+    // the output planes z0 .. z1 - 1 are calculated
+    static void rank3d(Object[] planes, Object[] outplanes, int width, int height,
+                       int[] hw, int ky, int kz, double q, int z0, int z1) {
+        int depth = planes.length
+        int lines = 2 * ky + 1
+        // only the planes used by the output planes z0 .. z1 - 1
+        int[][] v = new int[depth][]
+        for (int z = Math.max(0, z0 - kz); z < Math.min(depth, z1 + kz); z++) v[z] = toInt(planes[z])
+        int[] out = new int[width * height]
+        SlidingHistogram h = new SlidingHistogram()
+
+        for (int z = z0; z < z1; z++) {
+            for (int y = 0; y < height; y++) {
+                for (int x = 0; x < width; x++) {
+                    for (int dz = -kz; dz <= kz; dz++) {
+                        int zz = z + dz
+                        if (zz < 0 || zz >= depth) continue
+                        int[] p = v[zz]
+                        for (int dy = -ky; dy <= ky; dy++) {
+                            int yy = y + dy
+                            int w = hw[(dz + kz) * lines + dy + ky]
+                            if (yy < 0 || yy >= height || w < 0) continue
+                            int row = yy * width
+                            if (x == 0) {
+                                for (int xx = 0; xx <= Math.min(w, width - 1); xx++) h.add(p[row + xx])
+                            } else {
+                                if (x - w - 1 >= 0) h.remove(p[row + x - w - 1])
+                                if (x + w < width) h.add(p[row + x + w])
+                            }
+                        }
+                    }
+                    out[y * width + x] = h.rank(q)
+                }
+                // empty the histogram for the next line
+                for (int dz = -kz; dz <= kz; dz++) {
+                    int zz = z + dz
+                    if (zz < 0 || zz >= depth) continue
+                    int[] p = v[zz]
+                    for (int dy = -ky; dy <= ky; dy++) {
+                        int yy = y + dy
+                        int w = hw[(dz + kz) * lines + dy + ky]
+                        if (yy < 0 || yy >= height || w < 0) continue
+                        for (int xx = Math.max(0, width - 1 - w); xx < width; xx++) h.remove(p[yy * width + xx])
+                    }
+                }
+            }
+            fromInt(out, outplanes[z])
+        }
+    }
+}
+"""
+
+    engine = None
+    lock = threading.Lock()
+    warned = False
+
+    @staticmethod
+    def getengine():
+
+        # compile the Groovy class only once
+        with RankTools.lock:
+            if RankTools.engine is None:
+                try:
+                    from groovy.lang import GroovyClassLoader
+                    RankTools.engine = GroovyClassLoader().parseClass(RankTools.SOURCE)
+                except (ImportError, Exception, Throwable), e:
+                    print('Sliding histogram not available : ' + str(e))
+                    RankTools.engine = False
+
+        return RankTools.engine
+
+    @staticmethod
+    def getfallback(percentile):
+
+        # filter type of RankFilters and Filters3D for the same percentile,
+        # the message is printed only once
+        fallback = {0.0: 'MIN', 50.0: 'MEDIAN', 100.0: 'MAX'}.get(float(percentile))
+        if fallback is None:
+            raise ValueError('PERCENTILE needs the sliding histogram and 8 or 16 bit data.')
+
+        if not RankTools.warned:
+            print('Sliding histogram not used. Using ' + fallback + ' as fallback.')
+            RankTools.warned = True
+
+        return fallback
+
+    @staticmethod
+    def getkernel2d(radius):
+
+        # half widths of the kernel lines like RankFilters.makeLineRadii
+        if radius >= 1.5 and radius < 1.75:
+            radius = 1.75
+        elif radius >= 2.5 and radius < 2.85:
+            radius = 2.85
+        r2 = int(radius * radius) + 1
+        kradius = int(math.sqrt(r2 + 1e-10))
+
+        return [int(math.sqrt(r2 - dy * dy + 1e-10)) for dy in range(-kradius, kradius + 1)]
+
+    @staticmethod
+    def getkernel3d(radiusx, radiusy, radiusz):
+
+        # half widths of the kernel lines (dz, dy) of the Filters3D ellipsoid
+        vx, vy, vz = [int(math.ceil(r)) for r in [radiusx, radiusy, radiusz]]
+        rx2, ry2, rz2 = [1.0 / (r * r) if r != 0 else 0.0 for r in [radiusx, radiusy, radiusz]]
+
+        halfwidths = []
+        for dz in range(-vz, vz + 1):
+            for dy in range(-vy, vy + 1):
+                inside = [dx for dx in range(vx + 1) if dx * dx * rx2 + dy * dy * ry2 + dz * dz * rz2 <= 1.0]
+                halfwidths.append(max(inside) if inside else -1)
+
+        return halfwidths, vy, vz
+
+    @staticmethod
+    def rank2d(ip, radius, percentile=50.0):
+
+        # percentile of the circular kernel, the processor is changed in place
+        engine = RankTools.getengine()
+        if not engine or ip.getBitDepth() not in [8, 16]:
+            fallback = RankTools.getfallback(percentile)
+            RankFilters().rank(ip, radius, getattr(RankFilters, fallback))
+            return ip
+
+        engine.rank2d(ip.getPixels(), ip.getWidth(), ip.getHeight(),
+                      array(RankTools.getkernel2d(radius), 'i'),
+                      min(max(percentile, 0.0), 100.0) / 100.0)
+
+        return ip
+
+    @staticmethod
+    def rank3d(stack, radiusx, radiusy, radiusz, percentile=50.0, nthreads=1):
+
+        # percentile of the ellipsoid kernel, returns a new stack
+        # the slices are split into nthreads blocks
+        engine = RankTools.getengine()
+        if not engine or stack.getBitDepth() not in [8, 16]:
+            fallback = RankTools.getfallback(percentile)
+            return Filters3D.filter(stack, getattr(Filters3D, fallback), radiusx, radiusy, radiusz)
+
+        newstack = ImageStack(stack.getWidth(), stack.getHeight())
+        for index in range(1, stack.getSize() + 1):
+            newstack.addSlice(stack.getSliceLabel(index), stack.getProcessor(index).createProcessor(stack.getWidth(), stack.getHeight()))
+
+        halfwidths, ky, kz = RankTools.getkernel3d(radiusx, radiusy, radiusz)
+        planes = array([stack.getPixels(i) for i in range(1, stack.getSize() + 1)], Object)
+        outplanes = array([newstack.getPixels(i) for i in range(1, stack.getSize() + 1)], Object)
+        q = min(max(percentile, 0.0), 100.0) / 100.0
+
+        depth = stack.getSize()
+        n = max(1, min(nthreads, depth))
+        blocks = [(depth * i // n, depth * (i + 1) // n) for i in range(n)]
+        ParallelTools.run_tasks([lambda z0=z0, z1=z1: engine.rank3d(planes, outplanes,
+                                                                    stack.getWidth(), stack.getHeight(),
+                                                                    array(halfwidths, 'i'), ky, kz, q, z0, z1)
+                                 for z0, z1 in blocks], nthreads=nthreads)
+
+        return newstack
+
+
+class TileTools:
+    """
+    Splits a plane into overlapping tiles, processes the tiles and writes
+    back only the tile cores. The halo around each core must be at least the
+    reach of the operation, then the result is identical to the result of
+    the untiled operation. Use getrankhalo and getrollingballhalo to get it.
+    """
+
+    @staticmethod
+    def gettiles(width, height, tilesize=1024, halo=16, align=1):
+
+        # the tile cores start at multiples of align, e.g. for the
+        # shrink factor of the rolling ball algorithm
+        tilesize = max(tilesize // align, 1) * align
+        halo = -(-halo // align) * align
+
+        tiles = []
+        for y in range(0, height, tilesize):
+            for x in range(0, width, tilesize):
+                core = Region(x, y, min(tilesize, width - x), min(tilesize, height - y))
+                px = max(x - halo, 0)
+                py = max(y - halo, 0)
+                padded = Region(px, py,
+                                min(x + core.width + halo, width) - px,
+                                min(y + core.height + halo, height) - py)
+                tiles.append((core, padded))
+
+        return tiles
+
+    @staticmethod
+    def process_tiled(ip, func, tilesize=1024, halo=16, align=1, nthreads=1):
+
+        # func = function that modifies a tile (ImageProcessor) in place
+        out = ip.createProcessor(ip.getWidth(), ip.getHeight())
+
+        def runtile(core, padded):
+            # copy the padded tile - insert only reads from the source
+            tile = ip.createProcessor(padded.width, padded.height)
+            tile.insert(ip, -padded.x, -padded.y)
+
+            func(tile)
+
+            # write back only the core of the tile
+            tile.setRoi(core.x - padded.x, core.y - padded.y, core.width, core.height)
+            out.insert(tile.crop(), core.x, core.y)
+
+        tasks = []
+        for core, padded in TileTools.gettiles(ip.getWidth(), ip.getHeight(),
+                                               tilesize=tilesize,
+                                               halo=halo,
+                                               align=align):
+            tasks.append(lambda core=core, padded=padded: runtile(core, padded))
+
+        ParallelTools.run_tasks(tasks, nthreads=nthreads)
+        ip.setPixels(out.getPixels())
+
+        return ip
+
+    @staticmethod
+    def getrankhalo(radius, filtertype='MEDIAN'):
+
+        # reach of the RankFilters kernel - the kernel radius is
+        # sqrt(radius * radius + 1) rounded down
+        halo = int((radius * radius + 1) ** 0.5) + 1
+
+        # OPEN is a MIN followed by a MAX filter
+        if filtertype == 'OPEN':
+            halo = 2 * halo
+
+        return halo
+
+    @staticmethod
+    def getrollingballhalo(radius):
+
+        # shrink factor used by the BackgroundSubtracter for the ball radius
+        if radius <= 10:
+            shrinkfactor = 1
+        elif radius <= 30:
+            shrinkfactor = 2
+        elif radius <= 100:
+            shrinkfactor = 4
+        else:
+            shrinkfactor = 8
+
+        # the background is an opening with the ball (reach 2 * radius) of
+        # the shrunken, presmoothed image and is interpolated afterwards
+        halo = int(2 * radius) + 3 * shrinkfactor + 2
+
+        return halo, shrinkfactor
+
+    @staticmethod
+    def maxdifference(ip1, ip2):
+
+        # max. absolute pixel difference - 0 means identical
+        diff = ip1.convertToFloatProcessor().duplicate()
+        diff.copyBits(ip2.convertToFloatProcessor(), 0, 0, Blitter.DIFFERENCE)
+
+        return diff.getStatistics().max
+
+    @staticmethod
+    def maxstackdifference(source1, source2):
+
+        # max. absolute pixel difference of all slices of two ImagePlus or
+        # ImageStack objects, different dimensions are never identical
+        stack1, stack2 = source1, source2
+        if isinstance(source1, ImagePlus):
+            stack1 = source1.getStack()
+        if isinstance(source2, ImagePlus):
+            stack2 = source2.getStack()
+
+        if [stack1.getWidth(), stack1.getHeight(), stack1.getSize()] != [stack2.getWidth(), stack2.getHeight(), stack2.getSize()]:
+            return float('inf')
+
+        return max([TileTools.maxdifference(stack1.getProcessor(i), stack2.getProcessor(i))
+                    for i in range(1, stack1.getSize() + 1)])
+
+
+class ParallelTools:
+
+    @staticmethod
+    def process_slices(source, func, factory=None, nthreads=1, indices=None):
+        """
+        Applies func(ip, instance) to every slice of an ImagePlus or ImageStack
+        using a fixed thread pool. factory creates one instance per worker
+        thread, e.g. RankFilters or BackgroundSubtracter, because those keep
+        a state and must not be shared between threads. Modified slices of
+        virtual stacks are written back with setProcessor.
+        indices = optional 1-based slice numbers.
+        Returns the results of func in the order of the slices.
+        """
+        stack = source
+        if isinstance(source, ImagePlus):
+            stack = source.getStack()
+
+        if indices is None:
+            indices = range(1, stack.getSize() + 1)
+
+        local = threading.local()
+
+        def task(index):
+            if factory is not None and not hasattr(local, 'instance'):
+                local.instance = factory()
+            ip = stack.getProcessor(index)
+            result = func(ip, getattr(local, 'instance', None))
+            if stack.isVirtual():
+                stack.setProcessor(ip, index)
+            return result
+
+        return ParallelTools.run_tasks([lambda index=index: task(index) for index in indices],
+                                       nthreads=nthreads)
+
+    @staticmethod
+    def getinstance(factory):
+
+        # returns a function which creates one instance of factory per thread
+        local = threading.local()
+
+        def instance():
+            if factory is None:
+                return None
+            if not hasattr(local, 'instance'):
+                local.instance = factory()
+            return local.instance
+
+        return instance
+
+    @staticmethod
+    def run_tasks(tasks, nthreads=1):
+
+        # tasks = list of functions without arguments
+        # returns the results in the order of the tasks
+        if nthreads <= 1 or len(tasks) <= 1:
+            return [task() for task in tasks]
+
+        pool = Executors.newFixedThreadPool(min(nthreads, len(tasks)))
+        try:
+            futures = pool.invokeAll([TaskCallable(task) for task in tasks])
+            results = [future.get() for future in futures]
+        finally:
+            pool.shutdown()
+
+        return results
+
+
+class TaskCallable(Callable):
+
+    # wraps a python function to be used by a java ExecutorService
+
+    def __init__(self, task):
+        self.task = task
+
+    def call(self):
+        return self.task()
+
+
+class SlicePipeline:
+    """
+    Chain of per-slice operations, which are applied to one plane after the
+    other while it is still in the cache, instead of streaming the whole
+    stack through the memory once per operation. Steps that need the whole
+    stack (e.g. a stack histogram or a 3D filter) are added as global steps
+    and act as barriers - the slice steps before are run as one fused pass.
+
+    pipeline = SlicePipeline()
+    pipeline.add_rollingball(radius=30)
+    pipeline.add_filter(radius=5, filtertype='MEDIAN')
+    pipeline.add_threshold(method='Otsu', stackopt=True)
+    imp = pipeline.run(imp, nthreads=4)
+    """
+
+    def __init__(self):
+
+        # list of (name, kind, func, factory) with kind = 'slice' or 'global'
+        self.steps = []
+        self.stats = {}
+
+    def add_slice(self, name, func, factory=None):
+
+        # func(ip, instance) modifies the processor in place, factory creates
+        # one instance per thread for filters with a state
+        self.steps.append((name, 'slice', func, factory))
+
+        return self
+
+    def add_global(self, name, func):
+
+        # func(imp) works on the whole stack and returns the ImagePlus
+        self.steps.append((name, 'global', func, None))
+
+        return self
+
+    def add_rollingball(self, radius=30,
+                        createBackground=False,
+                        lightBackground=False,
+                        useParaboloid=False,
+                        doPresmooth=True,
+                        correctCorners=False,
+                        binning=1):
+
+        def rollingball(ip, bs):
+            if binning > 1:
+                FilterTools.rollingball_binned(ip, bs, radius, binning,
+                                               createBackground=createBackground,
+                                               lightBackground=lightBackground,
+                                               useParaboloid=useParaboloid,
+                                               doPresmooth=doPresmooth,
+                                               correctCorners=correctCorners)
+                return
+
+            bs.rollingBallBackground(ip, radius, createBackground, lightBackground,
+                                     useParaboloid, doPresmooth, correctCorners)
+
+        return self.add_slice('Rolling Ball', rollingball, factory=BackgroundSubtracter)
+
+    def add_filter(self, radius=5, filtertype='MEDIAN', engine='rankfilters', percentile=50.0):
+
+        # same filter functions as FilterTools.apply_filter
+        rankfunction = FilterTools.getrankfunction(radius, filtertype, engine=engine, percentile=percentile)
+        if rankfunction is None:
+            print('Filter type not found : ' + filtertype)
+            return self
+
+        rank, factory = rankfunction
 
-        else:
-            extension = 'ome.tiff'
-            print("save as OME-TIFF: ")  # savepath
-            pstr = ExportTools.bfexporter(imp, savepath, useLOCI=True)
+        return self.add_slice('Rank Filter ' + filtertype, rank, factory=factory)
 
-        return savepath
+    def add_filter3d(self, radiusx=5, radiusy=5, radiusz=5, filtertype='MEDIAN',
+                     engine='filters3d', percentile=50.0, slabsize=None, nthreads=1):
 
-    @staticmethod
-    def save_singleplanes(imp, savepath, metainfo, mode='TZC', format='tiff'):
-        """
-        This function is still in testing.
-        """
-        titleext = imp.getTitle()
-        title = os.path.splitext(titleext)[0]
+        return self.add_global('3D Filter ' + filtertype,
+                               lambda imp: FilterTools.apply_filter3d(imp, radiusx, radiusy, radiusz, filtertype,
+                                                                      engine=engine, percentile=percentile,
+                                                                      slabsize=slabsize, nthreads=nthreads))
 
-        if mode == 'TZC':
+    def add_gaussian3d(self, sigma=1.0, metainfo=None, output='same', nthreads=1):
 
-            for t in range(metainfo['SizeT']):
-                for z in range(metainfo['SizeZ']):
-                    for c in range(metainfo['SizeC']):
-                        # set position - channel, slice, frame
-                        imp.setPosition(c + 1, z + 1, t + 1)
-                        numberedtitle = title + "_t" + IJ.pad(t, 2) + "_z" + IJ.pad(z, 4) + "_c" + IJ.pad(c, 4) + "." + format
-                        stackindex = imp.getStackIndex(c + 1, z + 1, t + 1)
-                        aframe = ImagePlus(numberedtitle, imp.getStack().getProcessor(stackindex))
-                        outputpath = os.path.join(savepath, numberedtitle)
-                        IJ.saveAs(aframe, "TIFF", outputpath)
+        return self.add_global('3D Gaussian',
+                               lambda imp: FilterTools.apply_gaussian3d(imp, sigma=sigma, metainfo=metainfo,
+                                                                        output=output, nthreads=nthreads))
 
-        if mode == 'Z':
-            c = 0
-            t = 0
-            for z in range(metainfo['SizeZ']):
-                # set position - channel, slice, frame
-                imp.setPosition(c + 1, z + 1, t + 1)
-                znumber = MiscTools.addzeros(z)
-                numberedtitle = title + "_z" + znumber + "." + format
-                stackindex = imp.getStackIndex(c + 1, z + 1, t + 1)
-                aframe = ImagePlus(numberedtitle, imp.getStack().getProcessor(stackindex))
-                outputpath = os.path.join(savepath, numberedtitle)
-                IJ.saveAs(aframe, "TIFF", outputpath)
+    def add_threshold(self, method='Otsu', background_threshold='dark', stackopt=False, corrf=1.0):
 
+        # same threshold functions as ThresholdTools.apply_threshold
+        if stackopt:
+            stackthreshold = {}
 
-class FilterTools:
+            def getstackthreshold(imp):
+                # the stack histogram needs all slices - this is a barrier
+                stackthreshold['value'] = ThresholdTools.getstackthreshold(imp, method=method,
+                                                                           background_threshold=background_threshold,
+                                                                           corrf=corrf)
+                return imp
 
-    @staticmethod
-    def apply_rollingball(imp,
-                          radius=30,
-                          createBackground=False,
-                          lightBackground=False,
-                          useParaboloid=False,
-                          doPresmooth=True,
-                          correctCorners=False):
+            self.add_global('Threshold Histogram', getstackthreshold)
+            self.add_slice('Threshold', lambda ip, instance: ip.threshold(stackthreshold['value']))
 
-        # Create BackgroundSubtracter instance
-        bs = BackgroundSubtracter()
-        stack = imp.getStack()  # get the stack within the ImagePlus
-        nslices = stack.getSize()  # get the number of slices
+        if not stackopt:
+            self.add_slice('Threshold', ThresholdTools.getslicethreshold(method=method, corrf=corrf))
 
-        for index in range(1, nslices + 1):
-            ip = stack.getProcessor(index)
-            # Run public method rollingBallBackground
-            bs.rollingBallBackground(ip,
-                                     radius,
-                                     createBackground,
-                                     lightBackground,
-                                     useParaboloid,
-                                     doPresmooth,
-                                     correctCorners)
+        # the stack type can only be changed as a whole
+        return self.add_global('Convert to 8bit', ThresholdTools.convert2gray8)
 
-        return imp
+    def getpasses(self):
 
-    @staticmethod
-    def apply_filter(imp, radius=5, filtertype='MEDIAN'):
+        # group consecutive slice steps into one fused pass
+        passes = []
+        for name, kind, func, factory in self.steps:
+            if kind == 'slice' and passes and passes[-1][0] == 'slice':
+                passes[-1][1].append((name, func, factory))
+            else:
+                passes.append((kind, [(name, func, factory)]))
 
-        # initialize filter
-        filter = RankFilters()
+        return passes
 
-        # create filter dictionary for 2D rank filters
-        filterdict = {}
-        filterdict['MEAN'] = RankFilters.MEAN
-        filterdict['MIN'] = RankFilters.MIN
-        filterdict['MAX'] = RankFilters.MAX
-        filterdict['MEDIAN'] = RankFilters.MEDIAN
-        filterdict['VARIANCE'] = RankFilters.VARIANCE
-        filterdict['OPEN'] = RankFilters.OPEN
-        filterdict['DESPECKLE'] = RankFilters.DESPECKLE
+    def run(self, imp, nthreads=1):
 
-        stack = imp.getStack()  # get the stack within the ImagePlus
-        nslices = stack.getSize()  # get the number of slices
+        passes = self.getpasses()
+        self.stats = {'Steps': len(self.steps),
+                      'Passes': len(passes),
+                      'Est. Memory Traffic [bytes]': 0,
+                      'Time [s]': 0.0}
+        start = time.time()
 
-        # apply filter based on filtertype
-        if filtertype in filterdict:
-            for index in range(1, nslices + 1):
-                ip = stack.getProcessor(index)
-                filter.rank(ip, radius, filterdict[filtertype])
-        else:
-            print("Argument 'filtertype': {filtertype} not found")
+        for kind, steps in passes:
+            print('Pipeline Pass : ' + ', '.join([step[0] for step in steps]))
 
-        return imp
+            if kind == 'slice':
+                factories = [step[2] for step in steps]
+                funcs = [step[1] for step in steps]
 
-    @staticmethod
-    def apply_filter3d(imp,
-                       radiusx=5,
-                       radiusy=5,
-                       radiusz=5,
-                       filtertype='MEDIAN'):
+                def fused(ip, instances, funcs=funcs):
+                    for func, instance in zip(funcs, instances):
+                        func(ip, instance)
 
-        # initialize filter
-        f3d = Filters3D()
+                ParallelTools.process_slices(imp, fused,
+                                             factory=lambda factories=factories: [f() if f is not None else None for f in factories],
+                                             nthreads=nthreads)
 
-        # create filter dictionary for 3d filters
-        filterdict = {}
-        filterdict['MEAN'] = f3d.MEAN
-        filterdict['MIN'] = f3d.MIN
-        filterdict['MAX'] = f3d.MAX
-        # filterdict['MAXLOCAL'] = f3d.MAXLOCAL # did not work
-        filterdict['MEDIAN'] = f3d.MEDIAN
-        filterdict['VAR'] = f3d.VAR
+            if kind == 'global':
+                imp = steps[0][1](imp)
 
-        stack = imp.getStack()  # get the stack within the ImagePlus
-        newstack = f3d.filter(stack,
-                              filterdict[filtertype],
-                              radiusx,
-                              radiusy,
-                              radiusz)
+            # estimate - every pass reads and writes the complete stack once
+            self.stats['Est. Memory Traffic [bytes]'] += 2 * ImageTools.getbytes(imp)
 
-        imp = ImagePlus('Filtered 3D', newstack)
+        self.stats['Time [s]'] = time.time() - start
 
         return imp
 
@@ -523,16 +3277,13 @@ class FilterTools:
 class BinaryTools:
 
     @staticmethod
-    def fill_holes(imp, is3d=False):
+    def fill_holes(imp, is3d=False, nthreads=1):
 
         if not is3d:
-            # 2D fill holes
-            stack = imp.getStack()  # get the stack within the ImagePlus
-            nslices = stack.getSize()  # get the number of slices
-            for index in range(1, nslices + 1):
-                ip = stack.getProcessor(index)
-                # Reconstruction.fillHoles(imp.getProcessor())
-                Reconstruction.fillHoles(ip)
+            # 2D fill holes - fillHoles returns a new processor
+            ParallelTools.process_slices(imp,
+                                         lambda ip, instance: ip.setPixels(Reconstruction.fillHoles(ip).getPixels()),
+                                         nthreads=nthreads)
 
         if is3d:
             # 3D fill holes
@@ -636,6 +3387,16 @@ class ImageTools:
 
         return imp, slices, width, height, pylevelout
 
+    @staticmethod
+    def getbytes(imp):
+
+        # memory used by the pixel data of an ImagePlus
+        bytesperpixel = imp.getBitDepth() // 8
+        if imp.getBitDepth() == 24:
+            bytesperpixel = 4
+
+        return imp.getWidth() * imp.getHeight() * imp.getStackSize() * bytesperpixel
+
 
 class ThresholdTools:
 
@@ -686,72 +3447,522 @@ class ThresholdTools:
     @staticmethod
     # helper function to apply threshold to whole stack
     # using one corrected value for the stack
-    def apply_threshold_stack_corr(imp, lowth_corr):
+    def apply_threshold_stack_corr(imp, lowth_corr, nthreads=1):
+
+        ParallelTools.process_slices(imp,
+                                     lambda ip, instance: ip.threshold(lowth_corr),
+                                     nthreads=nthreads)
+
+        # convert to 8bit without rescaling
+        imp = ThresholdTools.convert2gray8(imp)
+
+        return imp
+
+    @staticmethod
+    def convert2gray8(imp):
 
-        # get the stacks
         stack = imp.getStack()
-        nslices = stack.getSize()
 
-        for index in range(1, nslices + 1):
-            ip = stack.getProcessor(index)
-            ip.threshold(lowth_corr)
+        # convert a virtual PlaneCacheStack plane-by-plane, so that
+        # the stack is never loaded completely into memory
+        if isinstance(stack, PlaneCacheStack):
+            for index in range(1, stack.getSize() + 1):
+                ip = stack.getProcessor(index).convertToByteProcessor(False)
+                stack.setProcessor(ip, index)
+            imp.setStack(stack)
 
-        # convert to 8bit without rescaling
-        ImageConverter.setDoScaling(False)
-        ImageConverter(imp).convertToGray8()
+        if not isinstance(stack, PlaneCacheStack):
+            ImageConverter.setDoScaling(False)
+            ImageConverter(imp).convertToGray8()
 
         return imp
 
+    @staticmethod
+    def getstackthreshold(imp, method='Otsu', background_threshold='dark', corrf=1.0):
+
+        # create argument string for the IJ.setAutoThreshold
+        thcmd = method + ' ' + background_threshold + ' stack'
+
+        # set threshold and get the lower threshold value
+        IJ.setAutoThreshold(imp, thcmd)
+        ip = imp.getProcessor()
+
+        # get the threshold value and correct it
+        lowth = ip.getMinThreshold()
+        lowth_corr = int(round(lowth * corrf, 0))
+
+        return lowth_corr
+
+    @staticmethod
+    def getslicethreshold(method='Otsu', corrf=1.0):
+
+        # function(ip, instance) thresholding a slice with its own histogram
+        def threshold(ip, instance):
+
+            # get the histogram
+            hist = ip.getHistogram()
+
+            # get the threshold value
+            lowth = ThresholdTools.apply_autothreshold(hist, method=method)
+            lowth_corr = int(round(lowth * corrf, 0))
+            ip.threshold(lowth_corr)
+
+        return threshold
+
     @staticmethod
     # apply threshold either to whole stack or slice-by-slice
     def apply_threshold(imp, method='Otsu',
                         background_threshold='dark',
                         stackopt=False,
-                        corrf=1.0):
+                        corrf=1.0,
+                        nthreads=1):
 
         # one threshold value for the whole stack with correction
         if stackopt:
 
-            # create argument string for the IJ.setAutoThreshold
-            thcmd = method + ' ' + background_threshold + ' stack'
-
-            # set threshold and get the lower threshold value
-            IJ.setAutoThreshold(imp, thcmd)
-            ip = imp.getProcessor()
-
             # get the threshold value and correct it
-            lowth = ip.getMinThreshold()
-            lowth_corr = int(round(lowth * corrf, 0))
+            lowth_corr = ThresholdTools.getstackthreshold(imp, method=method,
+                                                          background_threshold=background_threshold,
+                                                          corrf=corrf)
 
             # process stack with corrected threshold value
-            imp = ThresholdTools.apply_threshold_stack_corr(imp, lowth_corr)
+            imp = ThresholdTools.apply_threshold_stack_corr(imp, lowth_corr, nthreads=nthreads)
 
         # threshold slice-by-slice with correction
         if not stackopt:
 
-            # get the stack
-            stack = imp.getStack()  # get the stack within the ImagePlus
-            nslices = stack.getSize()  # get the number of slices
-            print('Slices: ' + str(nslices))
+            print('Slices: ' + str(imp.getStackSize()))
             print('Thresholding slice-by-slice')
 
+            ParallelTools.process_slices(imp,
+                                         ThresholdTools.getslicethreshold(method=method, corrf=corrf),
+                                         nthreads=nthreads)
+
+            # convert to 8bit without rescaling
+            imp = ThresholdTools.convert2gray8(imp)
+
+        return imp
+
+
+class CPUBackend:
+    """
+    CPU implementation of the CLIJ operations used by the clij_*.py scripts,
+    so they also run on machines without an OpenCL device. Buffers are
+    ImagePlus copies, all operations work on the primitive pixel arrays
+    using the ImageProcessor methods and process the planes in parallel.
+    op() returns the backend itself, like clij.op() for CLIJ.
+    """
+
+    _instance = None
+
+    def __init__(self, nthreads=None):
+        if nthreads is None:
+            nthreads = Prefs.getThreads()
+        self.nthreads = nthreads
+
+    @staticmethod
+    def getInstance():
+
+        if CPUBackend._instance is None:
+            CPUBackend._instance = CPUBackend()
+
+        return CPUBackend._instance
+
+    @staticmethod
+    def getbackend(usegpu=True):
+
+        # CLIJ when it is installed and finds an OpenCL device, otherwise CPU
+        if usegpu:
+            try:
+                from net.haesleinhuepf.clij import CLIJ
+                return CLIJ.getInstance()
+            except (ImportError, Exception, Throwable), e:
+                print('CLIJ not available. Using the CPU backend. ' + str(e))
+
+        return CPUBackend.getInstance()
+
+    def getName(self):
+        return 'CPU (' + str(self.nthreads) + ' threads)'
+
+    def op(self):
+        return self
+
+    def push(self, imp):
+        return imp.duplicate()
+
+    def pull(self, buffer):
+        return buffer.duplicate()
+
+    def create(self, buffer, bitdepth=None):
+
+        # empty buffer with the same dimensions and type or bitdepth
+        if bitdepth is None:
+            bitdepth = buffer.getBitDepth()
+        stack = ImageStack.create(buffer.getWidth(), buffer.getHeight(), buffer.getStackSize(), bitdepth)
+
+        return ImagePlus(buffer.getTitle(), stack)
+
+    def release(self, buffer):
+        # buffers are normal images and freed by the garbage collector
+        pass
+
+    def close(self):
+        pass
+
+    def copyplanes(self, source, destination):
+
+        # float planes are rounded and clipped to the destination type
+        stack, outstack = source.getStack(), destination.getStack()
+        ParallelTools.run_tasks([lambda index=index: outstack.getProcessor(index).setPixels(0, stack.getProcessor(index).convertToFloat())
+                                 for index in range(1, stack.getSize() + 1)],
+                                nthreads=self.nthreads)
+
+    def blur(self, source, destination, sigmaX, sigmaY, sigmaZ=0):
+
+        # gaussian with sigmas in pixels, see FilterTools.apply_gaussian3d
+        blurred = FilterTools.apply_gaussian3d(source, sigma=(sigmaX, sigmaY, sigmaZ),
+                                               output='float', nthreads=self.nthreads)
+        self.copyplanes(blurred, destination)
+
+        return True
+
+    def addImagesWeighted(self, source1, source2, destination, factor1, factor2):
+
+        # destination = factor1 * source1 + factor2 * source2
+        stack1, stack2 = source1.getStack(), source2.getStack()
+        stack = destination.getStack()
+
+        def addweighted(index):
+            fp = stack1.getProcessor(index).convertToFloat().duplicate()
+            fp.multiply(factor1)
+            fp2 = stack2.getProcessor(index).convertToFloat().duplicate()
+            fp2.multiply(factor2)
+            fp.copyBits(fp2, 0, 0, Blitter.ADD)
+            stack.getProcessor(index).setPixels(0, fp)
+
+        ParallelTools.run_tasks([lambda index=index: addweighted(index) for index in range(1, stack.getSize() + 1)],
+                                nthreads=self.nthreads)
+
+        return True
+
+    def automaticThreshold(self, source, destination, method='Otsu'):
+
+        # like CLIJ - a 256 bin histogram between the min. and max. of the
+        # whole stack (0 - 255 for 8bit), the destination is 1 for all pixels
+        # greater or equal to the threshold and 0 otherwise
+        if source.getBitDepth() == 8:
+            minimum, maximum = 0.0, 256.0
+        else:
+            stats = StackStatistics(source)
+            minimum, maximum = stats.min, stats.max
+
+        hist = StackStatistics(source, 256, minimum, maximum).histogram
+        thresholdbin = ThresholdTools.apply_autothreshold([int(value) for value in hist], method=method)
+        threshold = minimum + thresholdbin * (maximum - minimum) / 256.0
+
+        stack, outstack = source.getStack(), destination.getStack()
+
+        def binarize(index):
+            src = stack.getProcessor(index).duplicate()
+            src.setThreshold(threshold, src.maxValue(), ImageProcessor.NO_LUT_UPDATE)
+            mask = src.createMask()
+            if mask is None:
+                mask = ByteProcessor(src.getWidth(), src.getHeight())
+            # mask 255 -> 1
+            mask.multiply(1.0 / 255.0)
+            outstack.getProcessor(index).setPixels(0, mask.convertToFloat())
+
+        ParallelTools.run_tasks([lambda index=index: binarize(index) for index in range(1, stack.getSize() + 1)],
+                                nthreads=self.nthreads)
+
+        return threshold
+
+
+class BackendRegistry:
+    """
+    Registry of the implementations (backends) of the filter, threshold and
+    labeling operations. The first registered backend of an operation is the
+    reference. On first use on a machine every available backend runs on a
+    few slices of the data, backends whose result differs from the reference
+    are rejected and the fastest remaining one is stored per operation, data
+    size class and parameters in ~/.fijipytools/backends/<host>.json.
+    Later calls dispatch directly to the stored backend. An override can be
+    passed to run or stored with setbackend.
+    """
+
+    REGISTRY = OrderedDict()
+    SETTINGSDIR = os.path.join(os.path.expanduser('~'), '.fijipytools', 'backends')
+    _lock = threading.RLock()
+    _settings = None
+
+    @staticmethod
+    def register(operation, name, func, available=None):
+
+        # func(imp, **options) returns the result as ImagePlus
+        # available(**options) returns False if the backend can not be used
+        BackendRegistry.REGISTRY.setdefault(operation, OrderedDict())[name] = (func, available)
+
+    @staticmethod
+    def getbackends(operation, **options):
+
+        backends = []
+        for name, (func, available) in BackendRegistry.REGISTRY.get(operation, {}).items():
+            if available is None or available(**options):
+                backends.append(name)
+
+        return backends
+
+    @staticmethod
+    def getsizeclass(imp):
+
+        voxels = imp.getWidth() * imp.getHeight() * imp.getStackSize()
+        if voxels < 2 ** 22:
+            return 'small'
+        if voxels < 2 ** 27:
+            return 'medium'
+
+        return 'large'
+
+    @staticmethod
+    def getkey(imp, **options):
+
+        # the fastest backend depends on the data size and the parameters
+        params = sorted([(k, v) for k, v in options.items()
+                         if k != 'nthreads' and isinstance(v, (int, long, float, str, unicode, bool))])
+
+        return BackendRegistry.getsizeclass(imp) + ' ' + str(imp.getBitDepth()) + 'bit ' + json.dumps(params)
+
+    @staticmethod
+    def getsettingspath():
+
+        # one file per machine, so nodes with a shared home never overwrite
+        # the settings of each other
+        return os.path.join(BackendRegistry.SETTINGSDIR, socket.gethostname() + '.json')
+
+    @staticmethod
+    def readsettings():
+
+        try:
+            with open(BackendRegistry.getsettingspath(), 'r') as f:
+                settings = json.load(f)
+        except (IOError, ValueError):
+            settings = {}
+
+        settings.setdefault('override', {})
+        settings.setdefault('calibration', {})
+
+        return settings
+
+    @staticmethod
+    def getsettings():
+
+        # settings of this machine, read once per session
+        with BackendRegistry._lock:
+            if BackendRegistry._settings is None:
+                BackendRegistry._settings = BackendRegistry.readsettings()
+
+            return BackendRegistry._settings
+
+    @staticmethod
+    def updatesettings(update):
+
+        # update(settings) changes the settings, which are read again from
+        # the file before, so changes of other processes are kept
+        with BackendRegistry._lock:
+            if not os.path.isdir(BackendRegistry.SETTINGSDIR):
+                os.makedirs(BackendRegistry.SETTINGSDIR)
+
+            settings = BackendRegistry.readsettings()
+            update(settings)
+
+            # unique temporary file, replaced atomically - the settings file
+            # always exists once it was written
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=BackendRegistry.SETTINGSDIR)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(settings, f, indent=4)
+            Files.move(Paths.get(tmppath), Paths.get(BackendRegistry.getsettingspath()),
+                       StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE)
+
+            BackendRegistry._settings = settings
+
+    @staticmethod
+    def setbackend(operation, name=None):
+
+        # stores an override for the operation, name=None removes it
+        if name is not None and name not in BackendRegistry.REGISTRY.get(operation, {}):
+            raise ValueError('Unknown backend ' + str(name) + ' for ' + operation)
+
+        def update(settings):
+            settings['override'].pop(operation, None)
+            if name is not None:
+                settings['override'][operation] = name
+
+        BackendRegistry.updatesettings(update)
+
+    @staticmethod
+    def calibrate(operation, imp, nslices=8, repeats=3, **options):
+
+        # runs all available backends on the first nslices slices, at least
+        # 4 * radiusz + 1 slices for the 3D filters. Every backend runs once
+        # to compare the result with the reference backend and to warm up,
+        # then repeats times, the min. time is used
+        stack = imp.getStack()
+        nslices = min(stack.getSize(), max(nslices, 4 * int(math.ceil(options.get('radiusz', 0))) + 1))
+
+        def getsubstack():
+            substack = ImageStack(stack.getWidth(), stack.getHeight())
             for index in range(1, nslices + 1):
+                substack.addSlice(stack.getSliceLabel(index), stack.getProcessor(index).duplicate())
+            return ImagePlus('Calibration', substack)
+
+        backends = BackendRegistry.getbackends(operation, **options)
+        reference = None
+        times = {}
+        rejected = []
+        for name in backends:
+            func = BackendRegistry.REGISTRY[operation][name][0]
+            try:
+                result = func(getsubstack(), **options)
+                if reference is None:
+                    reference = result
+                elif TileTools.maxstackdifference(reference, result) != 0:
+                    print('Backend ' + name + ' rejected for ' + operation + ' : result differs from the reference')
+                    rejected.append(name)
+                    continue
+
+                runs = []
+                for i in range(repeats):
+                    substack = getsubstack()
+                    start = time.time()
+                    func(substack, **options)
+                    runs.append(time.time() - start)
+            except (Exception, Throwable), e:
+                print('Backend ' + name + ' failed for ' + operation + ' : ' + str(e))
+                rejected.append(name)
+                continue
+            times[name] = min(runs)
+
+        if not times:
+            raise ValueError('No backend available for ' + operation)
+
+        best = min(times, key=times.get)
+        key = BackendRegistry.getkey(imp, **options)
+
+        def update(settings):
+            calibration = settings['calibration'].setdefault(operation, {})
+            calibration[key] = {'backend': best, 'times': times, 'rejected': rejected}
+
+        BackendRegistry.updatesettings(update)
+
+        print('Calibrated ' + operation + ' : ' + best + ' ' + str(times))
+
+        return best
 
-                ip = stack.getProcessor(index)
+    @staticmethod
+    def getbackend(operation, imp, **options):
 
-                # get the histogram
-                hist = ip.getHistogram()
+        # override - stored calibration - new calibration
+        available = BackendRegistry.getbackends(operation, **options)
+        with BackendRegistry._lock:
+            settings = BackendRegistry.getsettings()
+            name = settings['override'].get(operation)
+            if name in available:
+                return name
 
-                # get the threshold value
-                lowth = ThresholdTools.apply_autothreshold(hist, method=method)
-                lowth_corr = int(round(lowth * corrf, 0))
-                ip.threshold(lowth_corr)
+            entry = settings['calibration'].get(operation, {}).get(BackendRegistry.getkey(imp, **options))
+            if entry is not None and entry['backend'] in available:
+                return str(entry['backend'])
 
-            # convert to 8bit without rescaling
-            ImageConverter.setDoScaling(False)
-            ImageConverter(imp).convertToGray8()
+            return BackendRegistry.calibrate(operation, imp, **options)
 
-        return imp
+    @staticmethod
+    def run(operation, imp, backend=None, **options):
+
+        # backend = explicit backend name, otherwise the selected one
+        if backend is None:
+            backend = BackendRegistry.getbackend(operation, imp, **options)
+
+        return BackendRegistry.REGISTRY[operation][backend][0](imp, **options)
+
+    @staticmethod
+    def hasclij():
+
+        # CLIJ is installed and finds an OpenCL device
+        if not hasattr(BackendRegistry, '_clij'):
+            BackendRegistry._clij = not isinstance(CPUBackend.getbackend(), CPUBackend)
+
+        return BackendRegistry._clij
+
+    @staticmethod
+    def threshold_clij(imp, clij, method='Otsu', **options):
+
+        # automaticThreshold returns 0 / 1, the other backends 0 / 255
+        input = clij.push(imp)
+        output = clij.create(input)
+        clij.op().automaticThreshold(input, output, method)
+        result = clij.pull(output)
+        clij.release(input)
+        clij.release(output)
+
+        result = ThresholdTools.convert2gray8(result)
+        ParallelTools.process_slices(result, lambda ip, instance: ip.multiply(255.0),
+                                     nthreads=options.get('nthreads', 1))
+
+        return result
+
+    @staticmethod
+    def label_unionfind(imp, connectivity=6, bitdepth=16, **options):
+
+        from inra.ijpb.label.conncomp import ConnectedComponentsLabeling3D
+        labeling = ConnectedComponentsLabeling3D(connectivity, bitdepth)
+
+        return ImagePlus(imp.getTitle() + '-lbl', labeling.computeLabels(imp.getStack()))
+
+    @staticmethod
+    def hasunionfind(**options):
+
+        # older MorphoLibJ versions have no conncomp package or class
+        try:
+            from inra.ijpb.label import conncomp
+        except ImportError:
+            return False
+
+        if not hasattr(conncomp, 'ConnectedComponentsLabeling3D'):
+            return False
+
+        return options.get('connectivity', 6) in [6, 26]
+
+    @staticmethod
+    def isstackthreshold(**options):
+
+        # CLIJ like thresholds use one histogram for the stack without correction
+        return (options.get('stackopt', False) and options.get('corrf', 1.0) == 1.0
+                and options.get('background_threshold', 'dark') == 'dark')
+
+
+BackendRegistry.register('filter', 'rankfilters',
+                         lambda imp, **options: FilterTools.apply_filter(imp, engine='rankfilters', **options))
+BackendRegistry.register('filter', 'histogram',
+                         lambda imp, **options: FilterTools.apply_filter(imp, engine='histogram', **options),
+                         available=lambda **options: RankTools.getengine() is not False)
+BackendRegistry.register('filter3d', 'filters3d',
+                         lambda imp, **options: FilterTools.apply_filter3d(imp, engine='filters3d', **options))
+BackendRegistry.register('filter3d', 'histogram',
+                         lambda imp, **options: FilterTools.apply_filter3d(imp, engine='histogram', **options),
+                         available=lambda **options: RankTools.getengine() is not False)
+BackendRegistry.register('threshold', 'ij',
+                         lambda imp, **options: ThresholdTools.apply_threshold(imp, **options))
+BackendRegistry.register('threshold', 'cpu',
+                         lambda imp, **options: BackendRegistry.threshold_clij(imp, CPUBackend.getInstance(), **options),
+                         available=BackendRegistry.isstackthreshold)
+BackendRegistry.register('threshold', 'clij',
+                         lambda imp, **options: BackendRegistry.threshold_clij(imp, CPUBackend.getbackend(), **options),
+                         available=lambda **options: BackendRegistry.isstackthreshold(**options) and BackendRegistry.hasclij())
+BackendRegistry.register('labeling', 'morpholibj',
+                         lambda imp, connectivity=6, bitdepth=16, **options: BinaryImages.componentsLabeling(imp, connectivity, bitdepth))
+BackendRegistry.register('labeling', 'unionfind',
+                         BackendRegistry.label_unionfind,
+                         available=BackendRegistry.hasunionfind)
 
 
 class AnalyzeTools:
@@ -834,6 +4045,184 @@ class AnalyzeTools:
 
         return particlestack, results
 
+    @staticmethod
+    def merge_results(tables, column='Scene', values=None):
+
+        # merge several ResultsTables into one and add a column to identify
+        # the source table, e.g. the scene index
+        if values is None:
+            values = range(len(tables))
+
+        merged = ResultsTable()
+
+        for table, value in zip(tables, values):
+            if table is None:
+                continue
+
+            headings = [h for h in table.getHeadings() if h != 'Label']
+            for row in range(table.size()):
+                merged.incrementCounter()
+                merged.addValue(column, value)
+
+                if table.getLabel(row) is not None:
+                    merged.addLabel(table.getLabel(row))
+
+                for heading in headings:
+                    number = table.getValue(heading, row)
+                    text = table.getStringValue(heading, row)
+                    # keep text columns as text
+                    if Double.isNaN(number) and text not in [None, 'NaN']:
+                        merged.addValue(heading, text)
+                    else:
+                        merged.addValue(heading, number)
+
+        return merged
+
+    @staticmethod
+    def save_results(results, savepath, incremental=False, inputs=None, params=None):
+
+        # incremental = atomic write plus manifest, see ExportTools.savedata
+        if incremental:
+            return ExportTools.writeatomic(savepath,
+                                           lambda tmppath: AnalyzeTools.save_results(results, tmppath),
+                                           inputs, params)
+
+        # binary columnar table for *.rtb, otherwise the ImageJ text formats
+        if savepath.lower().endswith('.rtb'):
+            return AnalyzeTools.save_columnar(results, savepath)
+
+        results.saveAs(savepath)
+
+        return savepath
+
+    @staticmethod
+    def save_columnar(results, savepath):
+        """
+        Saves a ResultsTable as binary columnar file (*.rtb), which can be
+        loaded without any string parsing. Layout (little-endian):
+
+        bytes 0-3    magic 'FJRT'
+        bytes 4-7    int32 format version (1)
+        bytes 8-11   int32 length N of the header
+        bytes 12-    N bytes UTF-8 JSON header, e.g.
+                     {"rows": 2, "columns": [{"name": "Area", "type": "float64",
+                      "offset": 0, "nbytes": 16}, ...]}
+        data         column blocks starting at 12 + N, offset is relative to
+                     the data start and every block is aligned to 8 bytes
+
+        float64 = rows doubles, string = (rows + 1) int32 offsets into the
+        following UTF-8 bytes of all values.
+        """
+        nrows = results.size()
+        columns = []
+        blocks = []
+        offset = 0
+
+        for heading in results.getHeadings():
+            if not heading.strip():
+                # column with the row numbers
+                continue
+
+            if heading == 'Label':
+                block = AnalyzeTools.getstringblock([results.getLabel(row) for row in range(nrows)])
+                coltype = 'string'
+            else:
+                index = results.getColumnIndex(heading)
+                numbers = results.getColumnAsDoubles(index)
+                texts = [results.getStringValue(index, row) for row in range(nrows) if Double.isNaN(numbers[row])]
+                # keep text columns as text
+                if [text for text in texts if text not in [None, 'NaN']]:
+                    block = AnalyzeTools.getstringblock([results.getStringValue(index, row) for row in range(nrows)])
+                    coltype = 'string'
+                else:
+                    buf = ByteBuffer.allocate(nrows * 8).order(ByteOrder.LITTLE_ENDIAN)
+                    buf.asDoubleBuffer().put(numbers)
+                    block = buf.array()
+                    coltype = 'float64'
+
+            columns.append({'name': heading, 'type': coltype, 'offset': offset, 'nbytes': len(block)})
+            blocks.append(block)
+            offset += len(block) + (-len(block)) % 8
+
+        header = json.dumps({'rows': nrows, 'columns': columns})
+        header += ' ' * ((-(12 + len(header))) % 8)
+
+        buf = ByteBuffer.allocate(12).order(ByteOrder.LITTLE_ENDIAN)
+        buf.put(String('FJRT').getBytes('US-ASCII')).putInt(1).putInt(len(header))
+
+        stream = BufferedOutputStream(FileOutputStream(savepath))
+        try:
+            stream.write(buf.array())
+            stream.write(String(header).getBytes('UTF-8'))
+            for block in blocks:
+                stream.write(block)
+                stream.write(zeros((-len(block)) % 8, 'b'))
+        finally:
+            stream.close()
+
+        return savepath
+
+    @staticmethod
+    def getstringblock(values):
+
+        # (rows + 1) int32 offsets followed by the UTF-8 bytes of all values
+        encoded = [String(value or '').getBytes('UTF-8') for value in values]
+        buf = ByteBuffer.allocate(4 * (len(encoded) + 1) + sum([len(e) for e in encoded]))
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+
+        position = 0
+        buf.putInt(position)
+        for e in encoded:
+            position += len(e)
+            buf.putInt(position)
+        for e in encoded:
+            buf.put(e)
+
+        return buf.array()
+
+    @staticmethod
+    def read_columnar(filename):
+
+        # read a binary columnar table (*.rtb) back into a ResultsTable
+        data = zeros(os.path.getsize(filename), 'b')
+        stream = RandomAccessFile(filename, 'r')
+        try:
+            stream.readFully(data)
+        finally:
+            stream.close()
+
+        buf = ByteBuffer.wrap(data).order(ByteOrder.LITTLE_ENDIAN)
+        if unicode(String(data, 0, 4, 'US-ASCII')) != u'FJRT':
+            print('Not a binary result table : ' + filename)
+            return None
+
+        headerlength = buf.getInt(8)
+        header = json.loads(unicode(String(data, 12, headerlength, 'UTF-8')))
+        datastart = 12 + headerlength
+        nrows = header['rows']
+
+        results = ResultsTable()
+        for row in range(nrows):
+            results.incrementCounter()
+
+        for column in header['columns']:
+            start = datastart + column['offset']
+            if column['type'] == 'float64':
+                for row in range(nrows):
+                    results.setValue(column['name'], row, buf.getDouble(start + 8 * row))
+                continue
+
+            textstart = start + 4 * (nrows + 1)
+            for row in range(nrows):
+                begin = buf.getInt(start + 4 * row)
+                text = unicode(String(data, textstart + begin, buf.getInt(start + 4 * (row + 1)) - begin, 'UTF-8'))
+                if column['name'] == 'Label':
+                    results.setLabel(text, row)
+                else:
+                    results.setValue(column['name'], row, text)
+
+        return results
+
     @staticmethod
     def create_resultfilename(filename, suffix='_Results', extension='txt'):
 
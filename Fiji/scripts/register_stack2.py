@@ -101,9 +101,11 @@ state_transformdir = MiscTools.createdir(transformdir)
 #### Register Slices ####
 
 # save all planes as single images
-ExportTools.save_singleplanes(imp, sourcedir, MetaInfo,
-                              mode='Z',
-                              format='tiff')
+savestats = ExportTools.save_singleplanes(imp, sourcedir, MetaInfo,
+                                          mode='Z',
+                                          format='tiff',
+                                          nthreads=4)
+log.info('Saved Planes per Second : ' + str(round(savestats['Planes/s'], 1)))
 
 
 featuremodelindex = ["Translation",
@@ -50,10 +50,10 @@ import shutil
 from java.lang.System import getProperty
 sys.path.append(getProperty('fiji.dir') + '/scripts')
 
-from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
+from fijipytools import FilterTools, ImageTools, ImportTools
 from fijipytools import AnalyzeTools, RoiTools, MiscTools, ThresholdTools
 from fijipytools import WaterShedTools, BinaryTools
-from fijipytools import JSONTools
+from fijipytools import JSONTools, WriteBehindQueue
 from ij.measure import ResultsTable
 from ij.gui import Roi, Overlay
 from ij.io import FileSaver
@@ -275,10 +275,13 @@ pastack.show()
 ################ PIPELINE END ###################
 
 log.info('Output Path Particle Stack : ' + outputimagepath)
-savepath_pastack = ExportTools.savedata(pastack,
-                                        outputimagepath,
-                                        extension=saveformat,
-                                        replace=True)
+
+# export in the background while the results are saved
+WRITER = WriteBehindQueue()
+savepath_pastack = WRITER.submit(pastack,
+                                 outputimagepath,
+                                 extension=saveformat,
+                                 replace=True)
 
 if resultsave:
     # save the result table as file
@@ -286,16 +289,21 @@ if resultsave:
                                                         suffix=suffix_rt,
                                                         extension=saveformat_rt)
     # save the results
-    results.saveAs(rtsavelocation)
+    WRITER.submit(results, rtsavelocation)
 
     # check if the saving did actually work
-    filesaveOK = os.path.exists(rtsavelocation)
+    WRITER.flush()
+    filesaveOK = WRITER.isdone(rtsavelocation)
     log.info('FileCheck Result : ' + str(filesaveOK))
     if filesaveOK:
         log.info('Saved Results to : ' + rtsavelocation)
     if not filesaveOK:
         log.info('Saving did not work for : ' + rtsavelocation)
 
+# wait for the export of the particle stack
+WRITER.close()
+log.info('FileCheck Particle Stack : ' + str(WRITER.isdone(savepath_pastack)))
+
 # finish
 log.info('Done.')
 
@@ -15,7 +15,7 @@ sys.path.append(getProperty('fiji.dir') + '/scripts')
 
 from fijipytools import ExportTools, FilterTools, ImageTools, ImportTools
 from fijipytools import AnalyzeTools, RoiTools, MiscTools, ThresholdTools
-from fijipytools import JSONTools
+from fijipytools import JSONTools, WriteBehindQueue
 from ij.measure import ResultsTable
 from ij.gui import Roi, Overlay
 from ij.io import FileSaver
@@ -126,7 +126,8 @@ def run(imagefile, outputpath_orig, convert_orig2copy=False,
                                             lightBackground=LIGHTBACKGROUND,
                                             useParaboloid=USEPARABOLOID,
                                             doPresmooth=DOPRESMOOTH,
-                                            correctCorners=CORRECTCORNERS)
+                                            correctCorners=CORRECTCORNERS,
+                                            binning=RB_BINNING)
 
     # optional filtering
     if FILTERTYPE != 'NONE':
@@ -267,6 +268,8 @@ DOPRESMOOTH = True
 CORRECT_BACKGROUND = False
 #RB_RADIUS = int(INPUT_JSON['RB_RADIUS'])
 RB_RADIUS = 5
+# binning > 1 estimates the background on a binned copy - faster, not exact
+RB_BINNING = 1
 LIGHTBACKGROUND = False
 
 # parameters for filter
@@ -315,6 +318,7 @@ log.info('Channel to Analyse     : ' + str(CHINDEX))
 log.info('-----------------------------------------')
 log.info('Correct Background     : ' + str(CORRECT_BACKGROUND))
 log.info('Rolling Ball Radius    : ' + str(RB_RADIUS))
+log.info('Rolling Ball Binning   : ' + str(RB_BINNING))
 log.info('Light Background       : ' + str(LIGHTBACKGROUND))
 log.info('Use paraboloid         : ' + str(USEPARABOLOID))
 log.info('Doing PreSmooth        : ' + str(DOPRESMOOTH))
@@ -373,15 +377,18 @@ log.info('Saving threshold image ...')
 """
 
 if RESULTSAVE:
+
+    WRITER = WriteBehindQueue()
     # save the result table as file
     rtsavelocation = AnalyzeTools.create_resultfilename(outputimagepath,
                                                         suffix=SUFFIX_RT,
                                                         extension=SAVEFORMAT_RT)
-    # save the results
-    results.saveAs(rtsavelocation)
-    
-    # check if the saving did actually work
-    filesaveOK = os.path.exists(rtsavelocation)   
+    # save the results in the background
+    WRITER.submit(results, rtsavelocation)
+
+    # wait for the writer thread and check if the saving did actually work
+    WRITER.close()
+    filesaveOK = WRITER.isdone(rtsavelocation)
     log.info('FileCheck Result : ' + str(filesaveOK))
     if filesaveOK:
         log.info('Saved Results to : ' + rtsavelocation)